@@ -0,0 +1,73 @@
+"""
+Micro-benchmark for parsing rsync file listings.
+
+Compares `faculty_sync.rsync_output.parse_list_output` with the
+previous, strptime-based, parser on a synthetic listing.
+
+Usage: python benchmarks/rsync_output.py [number-of-lines]
+"""
+
+import random
+import sys
+import time
+from datetime import datetime
+
+from faculty_sync.models import (
+    DirectoryAttrs,
+    FileAttrs,
+    FsObject,
+    FsObjectType,
+)
+from faculty_sync.rsync_output import parse_list_output
+
+
+def strptime_parse(lines):
+    for line in lines:
+        changes, path, mtime_string, size_string = line.split("||")
+        mtime = datetime.strptime(mtime_string, "%Y/%m/%d-%H:%M:%S")
+        if changes[1] == "d":
+            yield FsObject(path, FsObjectType.DIRECTORY, DirectoryAttrs(mtime))
+        else:
+            yield FsObject(
+                path, FsObjectType.FILE, FileAttrs(mtime, int(size_string))
+            )
+
+
+def synthetic_listing(nlines, seed=0):
+    rng = random.Random(seed)
+    start = time.mktime((2015, 1, 1, 0, 0, 0, 0, 0, -1))
+    lines = []
+    for i in range(nlines):
+        mtime = time.localtime(start + rng.randrange(4 * 365 * 24 * 3600))
+        mtime_string = time.strftime("%Y/%m/%d-%H:%M:%S", mtime)
+        if i % 20 == 0:
+            line = "cd+++++++++||dir{}/||{}||4096".format(i, mtime_string)
+        else:
+            line = ">f+++++++++||dir{}/file{}.py||{}||{}".format(
+                i // 20 * 20, i, mtime_string, rng.randrange(100000)
+            )
+        lines.append(line)
+    return lines
+
+
+def measure(parser, lines):
+    start_time = time.perf_counter()
+    count = sum(1 for _ in parser(lines))
+    elapsed = time.perf_counter() - start_time
+    assert count == len(lines)
+    return len(lines) / elapsed
+
+
+def main():
+    nlines = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+    lines = synthetic_listing(nlines)
+    for name, parser in [
+        ("strptime", strptime_parse),
+        ("parse_list_output", parse_list_output),
+    ]:
+        rate = measure(parser, lines)
+        print("{:<20} {:>12,.0f} lines/second".format(name, rate))
+
+
+if __name__ == "__main__":
+    main()
@@ -2,8 +2,12 @@ import argparse
 from pathlib import Path
 
 from .models import Configuration
+from ..models import MoveDetection
 from .projects import resolve_project
+from ..remote_walk import DEFAULT_SFTP_CONCURRENCY
+from ..sync import RemoteListingEngine
 from ..version import version
+from ..watch_sync import DEFAULT_REMOTE_POLL_INTERVAL, DEFAULT_UPLOAD_WORKERS
 from .config import get_config
 from .servers import resolve_server
 
@@ -53,6 +57,82 @@ def parse_command_line(argv=None):
         nargs="+",
         help="Path fragments to ignore (e.g. node_modules, __pycache__).",
     )
+    parser.add_argument(
+        "--detect-moves",
+        default="off",
+        choices=["off", "metadata", "content"],
+        help=(
+            "Detect files and directories that were moved or renamed, "
+            "and move them rather than transfer them again. 'metadata' "
+            "matches them on size and modification time, 'content' also "
+            "checks that their contents are the same. Defaults to 'off'."
+        ),
+    )
+    parser.add_argument(
+        "--upload-workers",
+        type=int,
+        default=DEFAULT_UPLOAD_WORKERS,
+        help=(
+            "Number of changes to upload at the same time in watch mode. "
+            "Defaults to {}.".format(DEFAULT_UPLOAD_WORKERS)
+        ),
+    )
+    parser.add_argument(
+        "--priority",
+        nargs="+",
+        default=[],
+        help=(
+            "Path patterns to upload before others in watch mode "
+            "(e.g. '*.py' src/)."
+        ),
+    )
+    parser.add_argument(
+        "--remote-poll-interval",
+        type=float,
+        default=DEFAULT_REMOTE_POLL_INTERVAL,
+        help=(
+            "Seconds between two checks for remote changes to pull in "
+            "watch mode. Each check lists the whole remote directory, so "
+            "increase this for very large directories, or set it to 0 to "
+            "stop pulling changes. Defaults to {}.".format(
+                DEFAULT_REMOTE_POLL_INTERVAL
+            )
+        ),
+    )
+    parser.add_argument(
+        "--local-walk-workers",
+        type=int,
+        default=None,
+        help=(
+            "Number of threads reading local directories ahead of the walk "
+            "when listing the local directory. This helps for very wide "
+            "directories, or directories on network file systems. By "
+            "default, directories are read one at a time."
+        ),
+    )
+    parser.add_argument(
+        "--remote-listing",
+        default="exec",
+        choices=["exec", "rsync", "sftp"],
+        help=(
+            "How to list the remote directory. 'exec' runs find on the "
+            "server, 'rsync' runs rsync over a new connection and 'sftp' "
+            "lists several directories at the same time over SFTP, which "
+            "helps on slow connections. Defaults to 'exec', which falls "
+            "back to 'rsync' if find on the server does not support it."
+        ),
+    )
+    parser.add_argument(
+        "--remote-walk-concurrency",
+        type=int,
+        default=DEFAULT_SFTP_CONCURRENCY,
+        help=(
+            "Number of remote directories to list at the same time with "
+            "'--remote-listing sftp'. Defaults to {}.".format(
+                DEFAULT_SFTP_CONCURRENCY
+            )
+        ),
+    )
     parser.add_argument(
         "--debug",
         default=False,
@@ -110,7 +190,40 @@ def parse_command_line(argv=None):
     if arguments.ignore is not None:
         ignore += arguments.ignore
 
+    detect_moves = MoveDetection(arguments.detect_moves.upper())
+
+    if arguments.upload_workers < 1:
+        raise ValueError("There must be at least one upload worker.")
+
+    if arguments.remote_poll_interval < 0:
+        raise ValueError("The remote poll interval cannot be negative.")
+
+    if (
+        arguments.local_walk_workers is not None
+        and arguments.local_walk_workers < 1
+    ):
+        raise ValueError("There must be at least one local walk worker.")
+
+    remote_listing_engine = RemoteListingEngine(
+        arguments.remote_listing.upper()
+    )
+
+    if arguments.remote_walk_concurrency < 1:
+        raise ValueError("The remote walk concurrency must be at least one.")
+
     configuration = Configuration(
-        project, server_id, local_dir, remote_dir, arguments.debug, ignore
+        project,
+        server_id,
+        local_dir,
+        remote_dir,
+        arguments.debug,
+        ignore,
+        detect_moves,
+        arguments.upload_workers,
+        arguments.priority,
+        arguments.remote_poll_interval,
+        arguments.local_walk_workers,
+        remote_listing_engine,
+        arguments.remote_walk_concurrency,
     )
     return configuration
@@ -2,5 +2,19 @@ import collections
 
 Configuration = collections.namedtuple(
     "Configuration",
-    ["project", "server_id", "local_dir", "remote_dir", "debug", "ignore"],
+    [
+        "project",
+        "server_id",
+        "local_dir",
+        "remote_dir",
+        "debug",
+        "ignore",
+        "detect_moves",
+        "upload_workers",
+        "priority",
+        "remote_poll_interval",
+        "local_walk_workers",
+        "remote_listing_engine",
+        "remote_walk_concurrency",
+    ],
 )
@@ -6,6 +6,10 @@ import pytest
 from faculty.clients.project import Project
 
 from ... import cli
+from ...models import MoveDetection
+from ...remote_walk import DEFAULT_SFTP_CONCURRENCY
+from ...sync import RemoteListingEngine
+from ...watch_sync import DEFAULT_REMOTE_POLL_INTERVAL, DEFAULT_UPLOAD_WORKERS
 from .. import models
 from ..config import FileConfiguration
 
@@ -46,6 +50,13 @@ def test_no_args():
                     remote_dir=file_config.remote + "/",
                     debug=False,
                     ignore=cli.DEFAULT_IGNORE_PATTERNS,
+                    detect_moves=MoveDetection.OFF,
+                    upload_workers=DEFAULT_UPLOAD_WORKERS,
+                    priority=[],
+                    remote_poll_interval=DEFAULT_REMOTE_POLL_INTERVAL,
+                    local_walk_workers=None,
+                    remote_listing_engine=RemoteListingEngine.EXEC,
+                    remote_walk_concurrency=DEFAULT_SFTP_CONCURRENCY,
                 )
 
                 resolve_project_mock.assert_called_once_with("project-name")
@@ -117,6 +128,94 @@ def test_add_ignore():
                 assert configuration.ignore == expected_ignore_patterns
 
 
+def test_detect_moves():
+    file_config = FileConfiguration(
+        "project-name", "/project/remote/dir", None, []
+    )
+    argv = ["--detect-moves", "content"]
+    server_id = uuid.uuid4()
+    project = Project(uuid.uuid4(), "project-name", uuid.uuid4())
+    with _patched_config(file_config):
+        with _patched_server(server_id):
+            with _patched_project(project):
+                configuration = cli.parse_command_line(argv=argv)
+                assert configuration.detect_moves == MoveDetection.CONTENT
+
+
+def test_upload_workers():
+    file_config = FileConfiguration(
+        "project-name", "/project/remote/dir", None, []
+    )
+    argv = ["--upload-workers", "8"]
+    server_id = uuid.uuid4()
+    project = Project(uuid.uuid4(), "project-name", uuid.uuid4())
+    with _patched_config(file_config):
+        with _patched_server(server_id):
+            with _patched_project(project):
+                configuration = cli.parse_command_line(argv=argv)
+                assert configuration.upload_workers == 8
+
+
+def test_priority():
+    file_config = FileConfiguration(
+        "project-name", "/project/remote/dir", None, []
+    )
+    argv = ["--priority", "*.py", "src/"]
+    server_id = uuid.uuid4()
+    project = Project(uuid.uuid4(), "project-name", uuid.uuid4())
+    with _patched_config(file_config):
+        with _patched_server(server_id):
+            with _patched_project(project):
+                configuration = cli.parse_command_line(argv=argv)
+                assert configuration.priority == ["*.py", "src/"]
+
+
+def test_remote_poll_interval():
+    file_config = FileConfiguration(
+        "project-name", "/project/remote/dir", None, []
+    )
+    argv = ["--remote-poll-interval", "60"]
+    server_id = uuid.uuid4()
+    project = Project(uuid.uuid4(), "project-name", uuid.uuid4())
+    with _patched_config(file_config):
+        with _patched_server(server_id):
+            with _patched_project(project):
+                configuration = cli.parse_command_line(argv=argv)
+                assert configuration.remote_poll_interval == 60.0
+
+
+def test_local_walk_workers():
+    file_config = FileConfiguration(
+        "project-name", "/project/remote/dir", None, []
+    )
+    argv = ["--local-walk-workers", "8"]
+    server_id = uuid.uuid4()
+    project = Project(uuid.uuid4(), "project-name", uuid.uuid4())
+    with _patched_config(file_config):
+        with _patched_server(server_id):
+            with _patched_project(project):
+                configuration = cli.parse_command_line(argv=argv)
+                assert configuration.local_walk_workers == 8
+
+
+def test_remote_listing():
+    file_config = FileConfiguration(
+        "project-name", "/project/remote/dir", None, []
+    )
+    argv = ["--remote-listing", "sftp", "--remote-walk-concurrency", "32"]
+    server_id = uuid.uuid4()
+    project = Project(uuid.uuid4(), "project-name", uuid.uuid4())
+    with _patched_config(file_config):
+        with _patched_server(server_id):
+            with _patched_project(project):
+                configuration = cli.parse_command_line(argv=argv)
+                assert (
+                    configuration.remote_listing_engine
+                    == RemoteListingEngine.SFTP
+                )
+                assert configuration.remote_walk_concurrency == 32
+
+
 def test_no_configuration():
     file_config = FileConfiguration(None, None, None, [])
     argv = ["--project", "project-name"]
@@ -133,6 +232,13 @@ def test_no_configuration():
                     remote_dir=None,
                     debug=False,
                     ignore=cli.DEFAULT_IGNORE_PATTERNS,
+                    detect_moves=MoveDetection.OFF,
+                    upload_workers=DEFAULT_UPLOAD_WORKERS,
+                    priority=[],
+                    remote_poll_interval=DEFAULT_REMOTE_POLL_INTERVAL,
+                    local_walk_workers=None,
+                    remote_listing_engine=RemoteListingEngine.EXEC,
+                    remote_walk_concurrency=DEFAULT_SFTP_CONCURRENCY,
                 )
 
                 resolve_project_mock.assert_called_once_with("project-name")
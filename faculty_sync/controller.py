@@ -1,27 +1,40 @@
 import logging
+import subprocess
 import threading
 import time
 import traceback
 from concurrent.futures import ThreadPoolExecutor
 
 from .file_trees import (
-    compare_file_trees,
+    CompactFileTree,
+    compare_indexed_file_trees,
+    compare_sorted_file_trees,
+    find_moves,
     get_remote_subdirectories,
+    index_file_tree,
     remote_is_dir,
+    sort_file_tree,
 )
+from .models import DifferenceType, MoveDetection
 from .pubsub import Messages
+from .snapshots import Snapshot, SnapshotStore
 from .screens import (
     DifferencesScreen,
+    FileTreeWalk,
     RemoteDirectoryPromptScreen,
     SynchronizationScreen,
     SynchronizationScreenDirection,
     WalkingFileTreesScreen,
     WalkingFileTreesStatus,
+    WalkProgress,
     WatchSyncScreen,
 )
 from .ssh import sftp_from_ssh_details
 from .sync import Synchronizer
-from .watch_sync import WatcherSynchronizer
+from .watch_sync import WatcherSynchronizer, watch_sync_state_from_trees
+
+# Number of objects between two progress updates while walking file trees
+WALK_PROGRESS_INTERVAL = 1000
 
 
 class Controller(object):
@@ -35,9 +48,15 @@ class Controller(object):
         self._current_screen = None
         self._current_screen_subscriptions = []
         self._thread = None
-        self._executor = ThreadPoolExecutor(max_workers=8)
+        # A single worker, so that controller tasks run one at a time
+        self._executor = ThreadPoolExecutor(max_workers=1)
+        # A single writer, so that snapshots are saved in order
+        self._snapshot_executor = ThreadPoolExecutor(max_workers=1)
         self._synchronizer = None
         self._watcher_synchronizer = None
+        self._snapshot_store = None
+        self._snapshot = None
+        self._differences = []
 
     def start(self):
         self._exchange.subscribe(
@@ -55,7 +74,7 @@ class Controller(object):
         )
         self._exchange.subscribe(
             Messages.START_INITIAL_FILE_TREE_WALK,
-            lambda _: self._submit(self._show_differences),
+            lambda _: self._submit(self._show_initial_differences),
         )
         self._exchange.subscribe(
             Messages.DISPLAY_DIFFERENCES,
@@ -75,10 +94,6 @@ class Controller(object):
             Messages.START_WATCH_SYNC,
             lambda _: self._submit(self._start_watch_sync),
         )
-        self._exchange.subscribe(
-            Messages.ERROR_HANDLING_FS_EVENT,
-            lambda _: self._submit(self._restart_watch_sync),
-        )
         self._exchange.subscribe(
             Messages.STOP_WATCH_SYNC,
             lambda _: self._submit(self._stop_watch_sync),
@@ -87,10 +102,17 @@ class Controller(object):
             Messages.DOWN_IN_WATCH_SYNC,
             lambda _: self._submit(self._down_in_watch_sync),
         )
+        self._exchange.subscribe(
+            Messages.RETRY_FAILED_IN_WATCH_SYNC,
+            lambda _: self._submit(self._retry_failed_in_watch_sync),
+        )
 
         def run():
             while not self._stop_event.is_set():
                 time.sleep(0.1)
+            # Let the last snapshot be written in full
+            self._snapshot_executor.shutdown(wait=True)
+            self._close_synchronizer()
 
         self._thread = threading.Thread(target=run)
         self._thread.start()
@@ -100,11 +122,11 @@ class Controller(object):
         )
 
     def _submit(self, fn, *args, **kwargs):
+        # Don't wait for the result: this is called from the exchange's
+        # dispatcher thread, which needs to keep delivering messages
+        # (e.g. progress updates) while the task runs.
         future = self._executor.submit(fn, *args, **kwargs)
-        try:
-            future.result()
-        except Exception:
-            traceback.print_exc()
+        future.add_done_callback(_print_exception)
 
     def _resolve_remote_directory(self, remote_dir):
         if remote_dir is not None:
@@ -113,12 +135,28 @@ class Controller(object):
                     "Setting {} as remote directory".format(remote_dir)
                 )
                 self._remote_dir = remote_dir.rstrip("/") + "/"
+                self._close_synchronizer()
                 self._synchronizer = Synchronizer(
                     self._configuration.local_dir,
                     self._remote_dir,
                     self._ssh_details,
                     self._configuration.ignore,
+                    local_walk_workers=self._configuration.local_walk_workers,
+                    remote_listing_engine=(
+                        self._configuration.remote_listing_engine
+                    ),
+                    remote_walk_concurrency=(
+                        self._configuration.remote_walk_concurrency
+                    ),
+                )
+                self._snapshot_store = SnapshotStore(
+                    self._configuration.project.id,
+                    self._configuration.server_id,
+                    self._configuration.local_dir,
+                    self._remote_dir,
+                    self._configuration.ignore,
                 )
+                self._snapshot = self._snapshot_store.load()
                 self._exchange.publish(
                     Messages.REMOTE_DIRECTORY_SET, self._remote_dir
                 )
@@ -128,6 +166,11 @@ class Controller(object):
         else:
             self._exchange.publish(Messages.PROMPT_FOR_REMOTE_DIRECTORY)
 
+    def _close_synchronizer(self):
+        if self._synchronizer is not None:
+            self._synchronizer.close()
+            self._synchronizer = None
+
     def _prompt_for_remote_directory(self):
         self._clear_current_subscriptions()
         self._current_screen = RemoteDirectoryPromptScreen(
@@ -144,6 +187,7 @@ class Controller(object):
             direction=SynchronizationScreenDirection.DOWN
         )
         self._view.mount(self._current_screen)
+        self._apply_moves(SynchronizationScreenDirection.DOWN)
         self._synchronizer.down(rsync_opts=["--delete"])
         self._show_differences()
 
@@ -153,11 +197,35 @@ class Controller(object):
             direction=SynchronizationScreenDirection.UP
         )
         self._view.mount(self._current_screen)
+        self._apply_moves(SynchronizationScreenDirection.UP)
         self._synchronizer.up(rsync_opts=["--delete"])
         self._show_differences()
 
+    def _apply_moves(self, direction):
+        """
+        Apply moves in the differences shown, ahead of an rsync pass
+
+        Moves that fail are left for rsync, which transfers the object
+        again instead.
+        """
+        for difference in self._differences:
+            if difference.difference_type != DifferenceType.MOVED:
+                continue
+            try:
+                if direction == SynchronizationScreenDirection.UP:
+                    self._synchronizer.move_remote(
+                        difference.right.path, difference.left.path
+                    )
+                else:
+                    self._synchronizer.move_local(
+                        difference.left.path, difference.right.path
+                    )
+            except OSError:
+                logging.exception("Failed to apply move {}".format(difference))
+
     def _display_differences(self, differences):
         self._clear_current_subscriptions()
+        self._differences = differences
         self._current_screen = DifferencesScreen(differences, self._exchange)
         subscription_id = self._exchange.subscribe(
             Messages.REFRESH_DIFFERENCES,
@@ -170,6 +238,30 @@ class Controller(object):
         for subscription_id in self._current_screen_subscriptions:
             self._exchange.unsubscribe(subscription_id)
 
+    def _show_initial_differences(self):
+        """
+        Show differences, starting from the last known state if possible
+
+        Differences between the trees saved in the snapshot are shown
+        straight away, while the trees are walked again to check them.
+        """
+        if self._snapshot is None:
+            self._show_differences()
+            return
+        self._clear_current_subscriptions()
+        cached_differences = list(
+            compare_sorted_file_trees(
+                self._snapshot.local_tree, self._snapshot.remote_tree
+            )
+        )
+        self._current_screen = DifferencesScreen(
+            cached_differences, self._exchange, cached=True
+        )
+        self._view.mount(self._current_screen)
+        differences = self._calculate_differences(publish_progress=False)
+        self._current_screen.stop()
+        self._display_differences(differences)
+
     def _show_differences(self):
         self._clear_current_subscriptions()
         self._current_screen = WalkingFileTreesScreen(
@@ -185,22 +277,46 @@ class Controller(object):
     def _calculate_differences(self, publish_progress=True):
         if publish_progress:
             self._exchange.publish(
-                Messages.WALK_STATUS_CHANGE, WalkingFileTreesStatus.LOCAL_WALK
+                Messages.WALK_STATUS_CHANGE,
+                WalkingFileTreesStatus.WALKING_TREES,
             )
-        local_files = self._synchronizer.list_local()
+        snapshot = self._snapshot
+        if snapshot is not None:
+
+            def iter_remote():
+                return self._synchronizer.iter_remote_changes(
+                    snapshot.remote_tree, snapshot.remote_time
+                )
+
+        else:
+            iter_remote = self._synchronizer.iter_remote
+        # Read the remote clock before walking, so that the next walk
+        # picks up anything that changes during this one.
+        remote_time = self._synchronizer.remote_time()
+        # Both walks are I/O bound, so run them at the same time
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            local_future = executor.submit(
+                self._walk,
+                self._synchronizer.iter_local,
+                FileTreeWalk.LOCAL,
+                publish_progress,
+            )
+            remote_future = executor.submit(
+                self._walk,
+                iter_remote,
+                FileTreeWalk.REMOTE,
+                publish_progress,
+            )
+            local_tree = local_future.result()
+            remote_tree = remote_future.result()
         logging.info(
             "Found {} files locally at path {}.".format(
-                len(local_files), self._configuration.local_dir
+                len(local_tree.fs_objects), self._configuration.local_dir
             )
         )
-        if publish_progress:
-            self._exchange.publish(
-                Messages.WALK_STATUS_CHANGE, WalkingFileTreesStatus.REMOTE_WALK
-            )
-        remote_files = self._synchronizer.list_remote()
         logging.info(
             "Found {} files on Faculty Platform at path {}.".format(
-                len(remote_files), self._configuration.remote_dir
+                len(remote_tree.fs_objects), self._configuration.remote_dir
             )
         )
         if publish_progress:
@@ -208,25 +324,84 @@ class Controller(object):
                 Messages.WALK_STATUS_CHANGE,
                 WalkingFileTreesStatus.CALCULATING_DIFFERENCES,
             )
-        differences = list(compare_file_trees(local_files, remote_files))
+        differences = list(compare_indexed_file_trees(local_tree, remote_tree))
+        if self._configuration.detect_moves != MoveDetection.OFF:
+            differences = self._find_moves(differences)
+        self._save_snapshot(
+            Snapshot(
+                local_tree.fs_objects, remote_tree.fs_objects, remote_time
+            )
+        )
         return differences
 
+    def _find_moves(self, differences):
+        if self._configuration.detect_moves == MoveDetection.CONTENT:
+            same_content = self._synchronizer.same_content
+        else:
+            same_content = None
+        try:
+            return find_moves(differences, same_content)
+        except (OSError, subprocess.CalledProcessError):
+            logging.exception("Failed to detect moves")
+            return differences
+
+    def _save_snapshot(self, snapshot):
+        self._snapshot = snapshot
+        # Writing a large snapshot takes a while: don't make the user
+        # wait for it.
+        future = self._snapshot_executor.submit(
+            self._snapshot_store.save, snapshot
+        )
+        future.add_done_callback(_print_exception)
+
+    def _walk(self, iter_tree, walk, publish_progress):
+        """
+        Consume a stream of file system objects into an indexed listing
+
+        Indexing happens here, rather than when comparing the trees, so
+        that one tree is indexed while the other is still being walked.
+        """
+        fs_objects = iter_tree()
+        if publish_progress:
+            fs_objects = self._publish_walk_progress(fs_objects, walk)
+        return index_file_tree(sort_file_tree(CompactFileTree(fs_objects)))
+
+    def _publish_walk_progress(self, fs_objects, walk):
+        nobjects = 0
+        for fs_object in fs_objects:
+            yield fs_object
+            nobjects += 1
+            if nobjects % WALK_PROGRESS_INTERVAL == 0:
+                self._exchange.publish(
+                    Messages.WALK_PROGRESS,
+                    WalkProgress(walk, nobjects, finished=False),
+                )
+        self._exchange.publish(
+            Messages.WALK_PROGRESS, WalkProgress(walk, nobjects, finished=True)
+        )
+
     def _start_watch_sync(self):
         self._clear_current_subscriptions()
         self._current_screen = WatchSyncScreen(self._exchange)
         self._view.mount(self._current_screen)
+        snapshot = self._snapshot
+        state = None
+        if snapshot is not None:
+            # Start from the trees listed to show the differences
+            state = watch_sync_state_from_trees(
+                snapshot.local_tree, snapshot.remote_tree, snapshot.remote_time
+            )
         self._watcher_synchronizer = WatcherSynchronizer(
-            self._sftp, self._synchronizer, self._exchange
+            self._sftp,
+            self._synchronizer,
+            self._exchange,
+            state,
+            upload_workers=self._configuration.upload_workers,
+            high_priority_patterns=self._configuration.priority,
+            remote_poll_interval=self._configuration.remote_poll_interval,
         )
         self._watcher_synchronizer.start()
 
-    def _restart_watch_sync(self):
-        self._clear_current_subscriptions()
-        if self._watcher_synchronizer is not None:
-            self._watcher_synchronizer.stop()
-        self._synchronizer.up(rsync_opts=["--delete"])
-        self._start_watch_sync()
-
     def _stop_watch_sync(self):
         logging.info("Stopping watch-synchronization loop.")
         if self._watcher_synchronizer is not None:
@@ -236,13 +411,17 @@ class Controller(object):
     def _down_in_watch_sync(self):
         logging.info("Doing down synchronization as part of watch-sync.")
         if self._watcher_synchronizer is not None:
-            self._watcher_synchronizer.stop()
-        self._current_screen = SynchronizationScreen(
-            direction=SynchronizationScreenDirection.DOWN
-        )
-        self._view.mount(self._current_screen)
-        self._synchronizer.down(rsync_opts=["--update"])
-        self._start_watch_sync()
+            self._watcher_synchronizer.down()
+
+    def _retry_failed_in_watch_sync(self):
+        if self._watcher_synchronizer is not None:
+            self._watcher_synchronizer.uploader.retry_failed()
 
     def join(self):
         self._thread.join()
+
+
+def _print_exception(future):
+    exc = future.exception()
+    if exc is not None:
+        traceback.print_exception(type(exc), exc, exc.__traceback__)
@@ -1,8 +1,20 @@
+import collections
+import collections.abc
+import hashlib
 import os
 import stat
+import sys
+from array import array
 from datetime import datetime
 
-from .models import FsObjectType, Difference, DifferenceType
+from .models import (
+    DirectoryAttrs,
+    FileAttrs,
+    FsObject,
+    FsObjectType,
+    Difference,
+    DifferenceType,
+)
 
 
 def get_remote_mtime(path, sftp):
@@ -30,19 +42,149 @@ def _get_mtime(path, oslike):
     return datetime.fromtimestamp(int(oslike.stat(path).st_mtime))
 
 
+def path_sort_key(path):
+    """
+    Key ordering paths depth-first, each directory followed by its contents
+
+    This is the order in which `compare_sorted_file_trees` expects
+    listings.
+    """
+    if path in {".", "./"}:
+        return ""
+    # Ordering by component is the same as ordering by the whole path
+    # with the separator replaced by a character lower than any other.
+    return path.replace("/", "\0")
+
+
+def sort_file_tree(fs_objects):
+    if isinstance(fs_objects, CompactFileTree):
+        return fs_objects.sorted()
+    return sorted(fs_objects, key=lambda obj: path_sort_key(obj.path))
+
+
+class CompactFileTree(collections.abc.Sequence):
+    """
+    Memory-efficient listing of file system objects
+
+    Objects are stored by column rather than as `FsObject`s. The
+    directory part of paths is stored once per directory and the rest is
+    interned, while types, sizes and mtimes (in whole seconds since the
+    epoch) are stored in arrays. This takes a fraction of the memory of
+    a list of `FsObject`s.
+
+    `FsObject`s are created on the fly when objects are accessed, so a
+    tree can be used wherever a sequence of `FsObject`s is expected.
+    """
+
+    def __init__(self, fs_objects=()):
+        self._prefixes = []
+        self._prefix_indices = {}
+        self._parents = array("l")
+        self._names = []
+        self._is_directory = bytearray()
+        self._sizes = array("q")
+        self._mtimes = array("q")
+        for fs_object in fs_objects:
+            self.append(fs_object)
+
+    def append(self, fs_object):
+        path = fs_object.path
+        is_directory = fs_object.is_directory()
+        if is_directory:
+            parent, separator, name = path[:-1].rpartition("/")
+            name += "/"
+        else:
+            parent, separator, name = path.rpartition("/")
+        prefix = parent + separator
+        try:
+            prefix_index = self._prefix_indices[prefix]
+        except KeyError:
+            prefix_index = len(self._prefixes)
+            self._prefixes.append(prefix)
+            self._prefix_indices[prefix] = prefix_index
+        self._parents.append(prefix_index)
+        self._names.append(sys.intern(name))
+        self._is_directory.append(is_directory)
+        self._sizes.append(0 if is_directory else fs_object.attrs.size)
+        self._mtimes.append(int(fs_object.attrs.last_modified.timestamp()))
+
+    def path(self, index):
+        """ Path of the object at `index`, without creating an `FsObject` """
+        return self._prefixes[self._parents[index]] + self._names[index]
+
+    def sorted(self):
+        """ Copy of this tree sorted by `path_sort_key` """
+        order = sorted(
+            range(len(self)), key=lambda index: path_sort_key(self.path(index))
+        )
+        tree = CompactFileTree()
+        tree._prefixes = list(self._prefixes)
+        tree._prefix_indices = dict(self._prefix_indices)
+        tree._parents = array("l", (self._parents[index] for index in order))
+        tree._names = [self._names[index] for index in order]
+        tree._is_directory = bytearray(
+            self._is_directory[index] for index in order
+        )
+        tree._sizes = array("q", (self._sizes[index] for index in order))
+        tree._mtimes = array("q", (self._mtimes[index] for index in order))
+        return tree
+
+    def __len__(self):
+        return len(self._names)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            indices = range(*index.indices(len(self)))
+            return [self._fs_object(i) for i in indices]
+        return self._fs_object(index)
+
+    def __iter__(self):
+        for index in range(len(self)):
+            yield self._fs_object(index)
+
+    def _fs_object(self, index):
+        path = self.path(index)
+        mtime = datetime.fromtimestamp(self._mtimes[index])
+        if self._is_directory[index]:
+            attrs = DirectoryAttrs(mtime)
+            return FsObject(path, FsObjectType.DIRECTORY, attrs)
+        else:
+            attrs = FileAttrs(mtime, self._sizes[index])
+            return FsObject(path, FsObjectType.FILE, attrs)
+
+
 def compare_file_trees(left, right):
-    left_file_paths = {obj.path: obj for obj in left}
-    right_file_paths = {obj.path: obj for obj in right}
-    left_only = [obj for obj in left if obj.path not in right_file_paths]
-    for obj in left_only:
-        yield Difference(DifferenceType.LEFT_ONLY, left=obj, right=None)
-    right_only = [obj for obj in right if obj.path not in left_file_paths]
-    for obj in right_only:
-        yield Difference(DifferenceType.RIGHT_ONLY, left=None, right=obj)
-
-    for left_obj in left:
-        if left_obj.path in right_file_paths:
-            right_obj = right_file_paths[left_obj.path]
+    """ Compare two listings of file system objects, in any order """
+    return compare_sorted_file_trees(
+        sort_file_tree(left), sort_file_tree(right)
+    )
+
+
+def compare_sorted_file_trees(left, right):
+    """
+    Compare two listings sorted by `path_sort_key`
+
+    The listings can be arbitrary iterables. They are consumed in a
+    single pass, and differences are yielded as soon as they are found.
+    """
+    left = iter(left)
+    right = iter(right)
+    left_obj = next(left, None)
+    right_obj = next(right, None)
+    while left_obj is not None and right_obj is not None:
+        left_key = path_sort_key(left_obj.path)
+        right_key = path_sort_key(right_obj.path)
+        if left_key < right_key:
+            yield Difference(
+                DifferenceType.LEFT_ONLY, left=left_obj, right=None
+            )
+            left_obj = next(left, None)
+        elif left_key > right_key:
+            yield Difference(
+                DifferenceType.RIGHT_ONLY, left=None, right=right_obj
+            )
+            right_obj = next(right, None)
+        else:
             if left_obj.obj_type != right_obj.obj_type:
                 yield Difference(
                     DifferenceType.TYPE_DIFFERENT, left_obj, right_obj
@@ -54,3 +196,291 @@ def compare_file_trees(left, right):
                 yield Difference(
                     DifferenceType.ATTRS_DIFFERENT, left_obj, right_obj
                 )
+            left_obj = next(left, None)
+            right_obj = next(right, None)
+    while left_obj is not None:
+        yield Difference(DifferenceType.LEFT_ONLY, left=left_obj, right=None)
+        left_obj = next(left, None)
+    while right_obj is not None:
+        yield Difference(DifferenceType.RIGHT_ONLY, left=None, right=right_obj)
+        right_obj = next(right, None)
+
+
+# Size in bytes of the subtree digests of an `IndexedFileTree`
+DIGEST_SIZE = 16
+
+# A listing sorted by `path_sort_key`, with for each object the index just
+# past its subtree and, for directories, a digest of the subtree.
+IndexedFileTree = collections.namedtuple(
+    "IndexedFileTree", ["fs_objects", "subtree_ends", "digests"]
+)
+
+
+def index_file_tree(fs_objects):
+    """
+    Index a listing sorted by `path_sort_key`
+
+    In that order, the contents of a directory immediately follow the
+    directory itself. A directory's digest covers the name, size and
+    mtime of the files it contains, and the name and digest of its
+    subdirectories. Like `compare_sorted_file_trees`, it ignores the
+    mtimes of directories, so two subtrees with the same digest have no
+    differences.
+
+    Digests are BLAKE2 hashes of an unambiguous encoding of the
+    entries, so subtrees that differ do not share a digest in practice.
+    """
+    if not isinstance(fs_objects, collections.abc.Sequence):
+        fs_objects = list(fs_objects)
+    subtree_ends = list(range(1, len(fs_objects) + 1))
+    digests = [None] * len(fs_objects)
+    # Directories containing the current object, as (index, prefix,
+    # entries) tuples, where entries are encoded as bytes. Everything is
+    # below the root, so its prefix is empty. Entries hold full paths
+    # rather than names: digests are only compared between directories
+    # with the same path.
+    open_directories = []
+
+    def close_directory(end):
+        index, prefix, entries = open_directories.pop()
+        digest = hashlib.blake2b(
+            b"".join(entries), digest_size=DIGEST_SIZE
+        ).digest()
+        subtree_ends[index] = end
+        digests[index] = digest
+        if open_directories:
+            # Paths cannot contain NUL characters, and digests have a
+            # fixed size.
+            open_directories[-1][2].append(
+                _encode_path("D{}\0".format(prefix)) + digest
+            )
+
+    for index, fs_object in enumerate(fs_objects):
+        path = fs_object.path
+        while open_directories and not path.startswith(
+            open_directories[-1][1]
+        ):
+            close_directory(index)
+        if fs_object.obj_type == FsObjectType.DIRECTORY:
+            prefix = "" if path == "./" else path
+            open_directories.append((index, prefix, []))
+        elif open_directories:
+            attrs = fs_object.attrs
+            open_directories[-1][2].append(
+                _encode_path(
+                    "F{}\0{}\0{}\0".format(
+                        path, attrs.last_modified.isoformat(), attrs.size
+                    )
+                )
+            )
+    while open_directories:
+        close_directory(len(fs_objects))
+    return IndexedFileTree(fs_objects, subtree_ends, digests)
+
+
+def _encode_path(text):
+    # Paths that are not valid UTF-8 are decoded with surrogate escapes
+    return text.encode("utf-8", errors="surrogateescape")
+
+
+def compare_indexed_file_trees(left, right):
+    """
+    Compare two `IndexedFileTree`s
+
+    Yields the same differences as `compare_sorted_file_trees`, but
+    steps over directories with the same digest on both sides without
+    looking at their contents.
+    """
+    left_objects, right_objects = left.fs_objects, right.fs_objects
+    nleft, nright = len(left_objects), len(right_objects)
+    left_index = right_index = 0
+    while left_index < nleft and right_index < nright:
+        left_obj = left_objects[left_index]
+        right_obj = right_objects[right_index]
+        left_key = path_sort_key(left_obj.path)
+        right_key = path_sort_key(right_obj.path)
+        if left_key < right_key:
+            yield Difference(
+                DifferenceType.LEFT_ONLY, left=left_obj, right=None
+            )
+            left_index += 1
+        elif left_key > right_key:
+            yield Difference(
+                DifferenceType.RIGHT_ONLY, left=None, right=right_obj
+            )
+            right_index += 1
+        elif (
+            left_obj.is_directory()
+            and right_obj.is_directory()
+            and left.digests[left_index] == right.digests[right_index]
+        ):
+            left_index = left.subtree_ends[left_index]
+            right_index = right.subtree_ends[right_index]
+        else:
+            if left_obj.obj_type != right_obj.obj_type:
+                yield Difference(
+                    DifferenceType.TYPE_DIFFERENT, left_obj, right_obj
+                )
+            elif (
+                left_obj.attrs != right_obj.attrs
+                and left_obj.obj_type == FsObjectType.FILE
+            ):
+                yield Difference(
+                    DifferenceType.ATTRS_DIFFERENT, left_obj, right_obj
+                )
+            left_index += 1
+            right_index += 1
+    for left_obj in left_objects[left_index:]:
+        yield Difference(DifferenceType.LEFT_ONLY, left=left_obj, right=None)
+    for right_obj in right_objects[right_index:]:
+        yield Difference(DifferenceType.RIGHT_ONLY, left=None, right=right_obj)
+
+
+def find_moves(differences, same_content=None):
+    """
+    Replace pairs of one-sided differences that look like a move
+
+    `differences` must be in the order in which the comparison
+    functions yield them. A directory only on the left is matched with a
+    directory only on the right if the paths (relative to each
+    directory), types and file attributes of their contents are the
+    same. Remaining files only on the left are then matched with files
+    only on the right on size and mtime. Only unique matches count, and
+    empty files and directories are never matched, as they are cheap to
+    transfer anyway.
+
+    `same_content`, if given, is called with a list of (left, right)
+    pairs of matched files, and should return a list of booleans saying
+    whether each pair has the same content. Directories are only matched
+    if all of their files have the same content.
+
+    Returns a list of differences, where each match is a single MOVED
+    difference in place of the object only on the left.
+    """
+    differences = list(differences)
+    moves = {}
+    # Indices of differences replaced by a move
+    moved = set()
+
+    def add_move(left_range, right_range):
+        moves[left_range.start] = right_range.start
+        moved.update(left_range)
+        moved.update(right_range)
+
+    subtree_matches = _unique_matches(
+        _one_sided_subtrees(differences, DifferenceType.LEFT_ONLY),
+        _one_sided_subtrees(differences, DifferenceType.RIGHT_ONLY),
+    )
+    for left_range, right_range in subtree_matches:
+        pairs = [
+            (differences[left_index].left, differences[right_index].right)
+            for left_index, right_index in zip(left_range, right_range)
+            if differences[left_index].left.is_file()
+        ]
+        if same_content is None or all(same_content(pairs)):
+            add_move(left_range, right_range)
+
+    file_matches = list(
+        _unique_matches(
+            _one_sided_files(differences, DifferenceType.LEFT_ONLY, moved),
+            _one_sided_files(differences, DifferenceType.RIGHT_ONLY, moved),
+        )
+    )
+    if same_content is not None and file_matches:
+        pairs = [
+            (differences[left_index].left, differences[right_index].right)
+            for (left_index,), (right_index,) in file_matches
+        ]
+        file_matches = [
+            match
+            for match, is_same in zip(file_matches, same_content(pairs))
+            if is_same
+        ]
+    for left_range, right_range in file_matches:
+        add_move(left_range, right_range)
+
+    result = []
+    for index, difference in enumerate(differences):
+        if index in moves:
+            right = differences[moves[index]].right
+            result.append(
+                Difference(DifferenceType.MOVED, difference.left, right)
+            )
+        elif index not in moved:
+            result.append(difference)
+    return result
+
+
+def _one_sided_object(difference, difference_type):
+    if difference.difference_type != difference_type:
+        return None
+    elif difference_type == DifferenceType.LEFT_ONLY:
+        return difference.left
+    else:
+        return difference.right
+
+
+def _one_sided_subtrees(differences, difference_type):
+    """
+    Find directories whose whole subtree is on one side only
+
+    Yields (contents, range) pairs, where `contents` describes the
+    subtree independently of the directory's path and `range` holds the
+    indices of the subtree in `differences`.
+    """
+    start = prefix = entries = None
+
+    def subtree():
+        if any(size for _, _, size, _ in entries):
+            return tuple(entries), range(start, start + len(entries) + 1)
+
+    for index, difference in enumerate(differences):
+        fs_object = _one_sided_object(difference, difference_type)
+        if start is not None:
+            if fs_object is not None and fs_object.path.startswith(prefix):
+                relative_path = fs_object.path[len(prefix) :]
+                if fs_object.is_file():
+                    attrs = fs_object.attrs
+                    entries.append(
+                        (relative_path, True, attrs.size, attrs.last_modified)
+                    )
+                else:
+                    entries.append((relative_path, False, 0, None))
+                continue
+            match = subtree()
+            if match is not None:
+                yield match
+            start = None
+        if fs_object is not None and fs_object.is_directory():
+            start, prefix, entries = index, fs_object.path, []
+    if start is not None:
+        match = subtree()
+        if match is not None:
+            yield match
+
+
+def _one_sided_files(differences, difference_type, excluded_indices):
+    """ Yield (attrs, range) pairs for non-empty files on one side only """
+    for index, difference in enumerate(differences):
+        fs_object = _one_sided_object(difference, difference_type)
+        if (
+            fs_object is not None
+            and fs_object.is_file()
+            and fs_object.attrs.size > 0
+            and index not in excluded_indices
+        ):
+            yield fs_object.attrs, range(index, index + 1)
+
+
+def _unique_matches(left, right):
+    """ Pair up values from (key, value) pairs whose key is unique """
+    left_by_key = collections.defaultdict(list)
+    for key, value in left:
+        left_by_key[key].append(value)
+    right_by_key = collections.defaultdict(list)
+    for key, value in right:
+        right_by_key[key].append(value)
+    for key, left_values in left_by_key.items():
+        right_values = right_by_key.get(key, [])
+        if len(left_values) == 1 and len(right_values) == 1:
+            yield left_values[0], right_values[0]
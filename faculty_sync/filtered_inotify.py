@@ -0,0 +1,138 @@
+import errno
+import functools
+import inspect
+import os
+
+from watchdog.observers.api import DEFAULT_OBSERVER_TIMEOUT, BaseObserver
+from watchdog.observers.inotify import InotifyEmitter
+from watchdog.observers.inotify_buffer import InotifyBuffer
+from watchdog.observers.inotify_c import Inotify
+from watchdog.utils import BaseThread
+from watchdog.utils.delayed_queue import DelayedQueue
+
+from . import path_match
+
+# watchdog's inotify observer places a watch on every directory below
+# the watched path, including ignored directories like node_modules/.
+# On large trees, this exhausts the inotify watch limit. The classes
+# below hook into the internals of that observer to skip ignored
+# directories when building the watch set. This module only imports on
+# Linux, and the internals it relies on only have this shape in recent
+# versions of watchdog: check `is_supported()` before using it.
+
+# Parameters of the watchdog internals that this module overrides or
+# calls
+_EXPECTED_PARAMETERS = [
+    (Inotify, "__init__", ["self", "path", "recursive", "event_mask"]),
+    (Inotify, "_add_dir_watch", ["self", "path", "mask", "recursive"]),
+    (Inotify, "_add_watch", ["self", "path", "mask"]),
+    (InotifyBuffer, "__init__", ["self", "path", "recursive", "event_mask"]),
+    (
+        InotifyEmitter,
+        "__init__",
+        ["self", "event_queue", "watch", "timeout", "event_filter"],
+    ),
+    (InotifyEmitter, "get_event_mask_from_filter", ["self"]),
+]
+
+
+def is_supported():
+    """ Whether the installed watchdog has the internals used here """
+    for cls, name, expected_parameters in _EXPECTED_PARAMETERS:
+        try:
+            function = getattr(cls, name)
+            parameters = list(inspect.signature(function).parameters)
+        except (AttributeError, TypeError, ValueError):
+            return False
+        if parameters != expected_parameters:
+            return False
+    return True
+
+
+class FilteredInotifyObserver(BaseObserver):
+    def __init__(self, ignore_paths, timeout=DEFAULT_OBSERVER_TIMEOUT):
+        """
+        inotify observer that does not watch ignored directories
+
+        Directories matching `ignore_paths`, relative to the watched
+        directory, are not watched and not descended into.
+        """
+        super().__init__(
+            functools.partial(_FilteredInotifyEmitter, ignore_paths),
+            timeout=timeout,
+        )
+
+
+class _FilteredInotifyEmitter(InotifyEmitter):
+    def __init__(self, ignore_paths, event_queue, watch, **kwargs):
+        super().__init__(event_queue, watch, **kwargs)
+        self._ignore_paths = ignore_paths
+
+    def on_thread_start(self):
+        self._inotify = _FilteredInotifyBuffer(
+            os.fsencode(self.watch.path),
+            self._ignore_paths,
+            recursive=self.watch.is_recursive,
+            event_mask=self.get_event_mask_from_filter(),
+        )
+
+
+class _FilteredInotifyBuffer(InotifyBuffer):
+    def __init__(self, path, ignore_paths, recursive=False, event_mask=None):
+        # Same as InotifyBuffer.__init__, with a filtered Inotify
+        BaseThread.__init__(self)
+        self._queue = DelayedQueue(self.delay)
+        self._inotify = _FilteredInotify(
+            path, ignore_paths, recursive=recursive, event_mask=event_mask
+        )
+        self.start()
+
+
+class _FilteredInotify(Inotify):
+    def __init__(self, path, ignore_paths, **kwargs):
+        # Set before calling the parent, which adds the initial watches
+        self._root = os.fsdecode(path)
+        self._ignore_matcher = path_match.PathMatcher(ignore_paths)
+        super().__init__(path, **kwargs)
+        self._wd_for_path = _WatchDescriptors(self._wd_for_path)
+
+    def _add_dir_watch(self, path, mask, recursive):
+        if not os.path.isdir(path):
+            raise OSError(errno.ENOTDIR, os.strerror(errno.ENOTDIR), path)
+        self._add_watch(path, mask)
+        if recursive:
+            for root, dirnames, _ in os.walk(path):
+                dirnames[:] = [
+                    dirname
+                    for dirname in dirnames
+                    if not os.path.islink(os.path.join(root, dirname))
+                    and not self._is_ignored(os.path.join(root, dirname))
+                ]
+                for dirname in dirnames:
+                    self._add_watch(os.path.join(root, dirname), mask)
+
+    def _add_watch(self, path, mask):
+        # Also called for directories created after the observer starts.
+        # watchdog skips directories that cannot be watched.
+        if self._is_ignored(path):
+            raise OSError("Not watching ignored path {}".format(path))
+        return super()._add_watch(path, mask)
+
+    def _is_ignored(self, path):
+        relative_path = os.path.relpath(os.fsdecode(path), self._root)
+        return relative_path != "." and self._ignore_matcher.matches(
+            relative_path
+        )
+
+
+class _WatchDescriptors(dict):
+    """
+    Watch descriptors by path
+
+    When a new directory appears, watchdog emits events for the files
+    already in it, looking up the watch descriptor of their directory.
+    Ignored directories have none.
+    """
+
+    def __missing__(self, path):
+        return None
@@ -0,0 +1,128 @@
+import logging
+import os
+import stat
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+from . import path_match
+from .models import DirectoryAttrs, FileAttrs, FsObject, FsObjectType
+
+
+def walk_local(root, ignore_paths, max_workers=None):
+    """
+    Walk the file tree below `root`
+
+    Yields an `FsObject` for every file and directory, in the same form
+    as an rsync listing of `root`: paths are relative to `root`,
+    directory paths end with a slash and the root itself is './'.
+    Objects are yielded in `file_trees.path_sort_key` order.
+
+    Paths matching `ignore_paths` are skipped, and ignored directories
+    are not descended into.
+
+    If `max_workers` is set, directories are read ahead of the walk by
+    a pool of that many threads. This helps for very wide trees, or
+    trees on network file systems.
+    """
+    ignore_matcher = path_match.PathMatcher(ignore_paths)
+    root_stat = os.stat(root)
+    yield FsObject(
+        "./", FsObjectType.DIRECTORY, DirectoryAttrs(_mtime(root_stat))
+    )
+    if max_workers is None:
+        yield from _walk(root, ignore_matcher)
+    else:
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            yield from _walk(root, ignore_matcher, executor)
+
+
+def _walk(root, ignore_matcher, executor=None):
+    def children_of(relative_directory):
+        """
+        Callable returning the entries of a directory
+
+        With an executor, the directory starts being read straight away.
+        """
+        args = (
+            os.path.join(root, relative_directory),
+            relative_directory,
+            ignore_matcher,
+        )
+        if executor is None:
+            return lambda: _scan_directory(*args)
+        else:
+            return executor.submit(_scan_directory, *args).result
+
+    def with_children(entries):
+        return iter(
+            [
+                (
+                    entry,
+                    children_of(entry.path + "/")
+                    if entry.is_directory
+                    else None,
+                )
+                for entry in entries
+            ]
+        )
+
+    # Depth-first walk, with the entries of each directory sorted by name
+    stack = [with_children(children_of("")())]
+    while stack:
+        try:
+            entry, children = next(stack[-1])
+        except StopIteration:
+            stack.pop()
+            continue
+        yield entry.fs_object
+        if children is not None:
+            stack.append(with_children(children()))
+
+
+class _Entry(object):
+    __slots__ = ("path", "is_directory", "fs_object")
+
+    def __init__(self, path, stat_result):
+        self.path = path
+        self.is_directory = stat.S_ISDIR(stat_result.st_mode)
+        mtime = _mtime(stat_result)
+        if self.is_directory:
+            self.fs_object = FsObject(
+                path + "/", FsObjectType.DIRECTORY, DirectoryAttrs(mtime)
+            )
+        else:
+            self.fs_object = FsObject(
+                path, FsObjectType.FILE, FileAttrs(mtime, stat_result.st_size)
+            )
+
+
+def _scan_directory(directory, relative_directory, ignore_matcher):
+    """
+    List the entries of a directory that are not ignored, sorted by name
+    """
+    try:
+        dir_entries = list(os.scandir(directory))
+    except OSError as exc:
+        logging.warning(
+            "Failed to read directory {}: {}".format(directory, exc)
+        )
+        return []
+    named_entries = []
+    for dir_entry in dir_entries:
+        path = relative_directory + dir_entry.name
+        is_file = not dir_entry.is_dir(follow_symlinks=False)
+        if ignore_matcher.matches(path, is_file=is_file):
+            continue
+        try:
+            # Like rsync -a, don't follow symlinks
+            stat_result = dir_entry.stat(follow_symlinks=False)
+        except FileNotFoundError:
+            # Deleted while we were walking
+            continue
+        named_entries.append((dir_entry.name, _Entry(path, stat_result)))
+    named_entries.sort(key=lambda named_entry: named_entry[0])
+    return [entry for _, entry in named_entries]
+
+
+def _mtime(stat_result):
+    return datetime.fromtimestamp(int(stat_result.st_mtime))
@@ -57,7 +57,22 @@ class DifferenceType(Enum):
     # path exists in both, but they have different attributes
     ATTRS_DIFFERENT = "ATTRS_DIFFERENT"
 
+    # left and right objects are at different paths, but look like the
+    # same object moved
+    MOVED = "MOVED"
+
 
 Difference = collections.namedtuple(
     "Difference", ["difference_type", "left", "right"]
 )
+
+
+class MoveDetection(Enum):
+    # differences never include moves
+    OFF = "OFF"
+
+    # match moved objects on size and mtime
+    METADATA = "METADATA"
+
+    # match moved objects on size and mtime, then check their contents
+    CONTENT = "CONTENT"
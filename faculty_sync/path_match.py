@@ -1,66 +1,150 @@
+import functools
 import os
-from fnmatch import fnmatch
+import re
+from fnmatch import translate
+
+# Number of directories whose verdict a PathMatcher remembers
+MAX_CACHED_DIRECTORIES = 100000
+
+# Pattern component matching any number of path components
+_ANY_DEPTH = "**"
 
 
 def matches(path, pattern):
     """
     Matches rsync-like pattern
 
-    Currently should obey the same rules as rsync, apart from ** patterns
+    Currently should obey the same rules as rsync. A `**` component
+    matches any number of path components, including none. A pattern
+    ending with a slash only matches directories, but paths are assumed
+    to be directories unless told otherwise: see `PathMatcher.matches`.
     """
-    path = os.path.normpath(path)
-    if pattern == "/":
-        return True
-    else:
-        pattern = pattern.rstrip("/")
-        if pattern.startswith("/"):
-            return _anchored_match(path, pattern.lstrip("/"))
-        else:
-            return _floating_match(path, pattern)
+    return _matcher((pattern,)).matches(path)
 
 
 def matches_any_of(path, patterns):
-    for pattern in patterns:
-        if matches(path, pattern):
-            return True
-    return False
+    return _matcher(tuple(patterns)).matches(path)
+
+
+@functools.lru_cache(maxsize=64)
+def _matcher(patterns):
+    return PathMatcher(patterns)
 
 
-def _anchored_match(path, pattern):
-    path_components = _get_path_components(path)
-    pattern_components = _get_path_components(pattern)
-    return _anchored_match_helper(path_components, pattern_components)
+class PathMatcher(object):
+    def __init__(self, patterns):
+        """
+        Match paths against several rsync-like patterns at once
 
+        Equivalent to `matches_any_of` with `patterns`, but the patterns
+        are compiled once. A path that is below a matching directory
+        matches too, so verdicts for directories are remembered and
+        only the last component of a path is matched again.
+        """
+        self._patterns = []
+        self._matches_everything = False
+        for pattern in patterns:
+            if pattern == "/":
+                self._matches_everything = True
+            else:
+                self._patterns.append(_CompiledPattern(pattern))
+        # Path components of a directory -> whether it matches
+        self._directory_verdicts = {}
 
-def _floating_match(path, pattern):
-    path_components = _get_path_components(path)
-    pattern_components = _get_path_components(pattern)
-    for i in range(len(path_components)):
-        subpath_components = path_components[i:]
-        if _anchored_match_helper(subpath_components, pattern_components):
+    def matches(self, path, is_file=False):
+        """
+        Whether `path` matches one of the patterns
+
+        If `is_file` is set, `path` is not a directory, so patterns that
+        end with a slash cannot match it, although they still match its
+        parent directories.
+        """
+        if self._matches_everything:
             return True
-    return False
+        elif not self._patterns:
+            return False
+        components = _get_path_components(path)
+        if not components:
+            return False
+        return self._directory_matches(
+            components[:-1]
+        ) or self._matches_at_end(components, is_file)
+
+    def _directory_matches(self, components):
+        if not components:
+            return False
+        verdict = self._directory_verdicts.get(components)
+        if verdict is None:
+            verdict = self._directory_matches(
+                components[:-1]
+            ) or self._matches_at_end(components, is_file=False)
+            if len(self._directory_verdicts) >= MAX_CACHED_DIRECTORIES:
+                self._directory_verdicts.clear()
+            self._directory_verdicts[components] = verdict
+        return verdict
 
+    def _matches_at_end(self, components, is_file):
+        """
+        Whether a pattern matches components ending with the last one
+        """
+        return any(
+            pattern.matches_at_end(components)
+            for pattern in self._patterns
+            if not (is_file and pattern.directory_only)
+        )
+
+
+class _CompiledPattern(object):
+    def __init__(self, pattern):
+        self.directory_only = pattern.endswith("/")
+        pattern = pattern.rstrip("/")
+        self._anchored = pattern.startswith("/")
+        self._parts = [
+            component if component == _ANY_DEPTH else _compile(component)
+            for component in pattern.split("/")
+            if component
+        ]
+        self._has_any_depth = _ANY_DEPTH in self._parts
+
+    def matches_at_end(self, components):
+        if self._anchored:
+            return _match_components(self._parts, components)
+        elif self._has_any_depth:
+            return any(
+                _match_components(self._parts, components[start:])
+                for start in range(len(components) + 1)
+            )
+        else:
+            start = len(components) - len(self._parts)
+            return start >= 0 and _match_components(
+                self._parts, components[start:]
+            )
+
+
+def _compile(component):
+    return re.compile(translate(component)).match
 
-def _anchored_match_helper(path_components, pattern_components):
-    if len(pattern_components) > len(path_components):
-        return False
-    elif len(pattern_components) == 0:
-        return True
-    elif len(pattern_components) == 1:
-        return fnmatch(path_components[0], pattern_components[0])
+
+def _match_components(parts, components):
+    """ Whether `parts` match the whole of `components` """
+    if not parts:
+        return not components
+    elif parts[0] == _ANY_DEPTH:
+        return any(
+            _match_components(parts[1:], components[start:])
+            for start in range(len(components) + 1)
+        )
     else:
-        return fnmatch(
-            path_components[0], pattern_components[0]
-        ) and _anchored_match_helper(
-            path_components[1:], pattern_components[1:]
+        return (
+            bool(components)
+            and parts[0](components[0]) is not None
+            and _match_components(parts[1:], components[1:])
         )
 
 
 def _get_path_components(path):
-    path_components = []
-    while path and path != "/":
-        path, tail = os.path.split(path)
-        path_components.append(tail)
-    path_components.reverse()
-    return path_components
+    return tuple(
+        component
+        for component in os.path.normpath(path).split(os.path.sep)
+        if component
+    )
@@ -0,0 +1,79 @@
+import math
+import os
+
+from . import path_match
+
+# Priorities are expressed as deadlines: an event arriving at time `t`
+# gets the priority `t + penalty`, and events with the earliest
+# priority are handled first. A penalty of one therefore lets events
+# that arrive up to one second later overtake this one, but no more,
+# so that every event is handled eventually.
+
+# Files up to this size are not penalized
+SMALL_FILE_SIZE = 64 * 1024
+
+# Penalty for each doubling of the size above SMALL_FILE_SIZE
+SIZE_PENALTY = 2.0
+
+# Events for paths that already changed in the last RECENT_PERIOD
+# seconds are likely to be interactive edits, rather than generated
+# files. They get a bonus of RECENT_BONUS.
+RECENT_PERIOD = 600.0
+RECENT_BONUS = 10.0
+
+# Bonus for paths matching the high priority patterns
+PATTERN_BONUS = 30.0
+
+
+class EventPriorities(object):
+    def __init__(self, local_dir, high_priority_patterns=()):
+        """
+        Prioritize filesystem events for synchronization
+
+        Events for small files, for paths that changed recently and for
+        paths matching `high_priority_patterns` are handled first.
+
+        Not thread-safe
+        """
+        self._local_dir = local_dir
+        self._high_priority_matcher = path_match.PathMatcher(
+            high_priority_patterns
+        )
+        # path -> time of last event
+        self._last_touched = {}
+        self._next_prune = 0.0
+
+    def size(self, fs_event):
+        """ Size of the local file touched by `fs_event`, if any """
+        if fs_event.is_directory:
+            return 0
+        path = os.path.join(self._local_dir, fs_event.path)
+        try:
+            return os.lstat(path).st_size
+        except OSError:
+            return 0
+
+    def priority(self, fs_event, size, now):
+        """
+        Priority of an event arriving at `now`, lower is handled first
+        """
+        penalty = 0.0
+        if size > SMALL_FILE_SIZE:
+            penalty += SIZE_PENALTY * math.log2(size / SMALL_FILE_SIZE)
+        last_touched = self._last_touched.get(fs_event.path)
+        if last_touched is not None and now - last_touched < RECENT_PERIOD:
+            penalty -= RECENT_BONUS
+        if self._high_priority_matcher.matches(fs_event.path):
+            penalty -= PATTERN_BONUS
+        self._touch(fs_event.path, now)
+        return now + penalty
+
+    def _touch(self, path, now):
+        self._last_touched[path] = now
+        if now >= self._next_prune:
+            self._last_touched = {
+                path: last_touched
+                for path, last_touched in self._last_touched.items()
+                if now - last_touched < RECENT_PERIOD
+            }
+            self._next_prune = now + RECENT_PERIOD
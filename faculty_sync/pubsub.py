@@ -16,13 +16,15 @@ class Messages(Enum):
 
     STARTING_HANDLING_FS_EVENT = "STARTING_HANDLING_FS_EVENT"
     FINISHED_HANDLING_FS_EVENT = "FINISHED_HANDLING_FS_EVENT"
-    ERROR_HANDLING_FS_EVENT = "ERROR_HANDLING_FS_EVENT"
+    FAILED_HANDLING_FS_EVENT = "FAILED_HANDLING_FS_EVENT"
+    FAILED_FS_EVENTS_CHANGED = "FAILED_FS_EVENTS_CHANGED"
 
     START_WATCH_SYNC_MAIN_LOOP = "START_WATCH_SYNC_MAIN_LOOP"
 
     START_WATCH_SYNC = "START_WATCH_SYNC"
     STOP_WATCH_SYNC = "STOP_WATCH_SYNC"
     DOWN_IN_WATCH_SYNC = "DOWN_IN_WATCH_SYNC"
+    RETRY_FAILED_IN_WATCH_SYNC = "RETRY_FAILED_IN_WATCH_SYNC"
 
     SYNC_PLATFORM_TO_LOCAL = "SYNC_PLATFORM_TO_LOCAL"
     SYNC_LOCAL_TO_PLATFORM = "SYNC_LOCAL_TO_PLATFORM"
@@ -33,6 +35,7 @@ class Messages(Enum):
     START_INITIAL_FILE_TREE_WALK = "START_INITIAL_FILE_TREE_WALK"
 
     WALK_STATUS_CHANGE = "WALK_STATUS_CHANGE"
+    WALK_PROGRESS = "WALK_PROGRESS"
     REMOTE_DIRECTORY_SET = "REMOTE_DIRECTORY_SET"
 
 
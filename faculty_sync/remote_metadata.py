@@ -0,0 +1,184 @@
+import collections
+import logging
+import os
+import posixpath
+import threading
+import time
+from datetime import datetime
+
+import paramiko
+
+# Seconds for which a directory listing answers lookups
+DEFAULT_MAX_AGE = 1.0
+
+# Maximum number of directories of pending paths re-listed in the
+# background before their listing expires. Each costs a `listdir_attr`
+# call every `max_age / 2` seconds while the paths are pending.
+MAX_REFRESHED_DIRECTORIES = 16
+
+
+CacheStats = collections.namedtuple(
+    "CacheStats", ["lookups", "listings", "lookup_time", "listing_time"]
+)
+
+
+class RemoteMetadataCache(object):
+    def __init__(self, sftp, remote_dir, max_age=DEFAULT_MAX_AGE):
+        """
+        Cache of remote mtimes, refreshed a directory at a time
+
+        Looking up a path lists its parent directory with a single
+        `listdir_attr` call, which caches the mtimes of all its entries
+        for `max_age` seconds. Once started, the cache re-lists the
+        directories of the paths returned by the callable passed to
+        `set_pending_paths` in the background, so that looking up paths
+        that are about to be synchronized rarely waits for a round trip.
+        Other directories are only listed when they are looked up.
+
+        The cache uses its own SFTP session on the transport of `sftp`.
+        """
+        self._sftp = paramiko.SFTPClient.from_transport(
+            sftp.get_channel().get_transport()
+        )
+        self._remote_dir = remote_dir
+        self._max_age = max_age
+        self._lock = threading.Lock()
+        # Directory -> (time listed, {name: mtime})
+        self._listings = {}
+        # Returns the paths that are about to be looked up
+        self._pending_paths = None
+        self._stats = CacheStats(0, 0, 0.0, 0.0)
+        self._stop_event = threading.Event()
+        self._thread = None
+
+    def start(self):
+        def run():
+            try:
+                while not self._stop_event.wait(self._max_age / 2):
+                    try:
+                        self._refresh_pending_directories()
+                    except Exception:
+                        logging.exception("Failed to refresh remote metadata")
+            finally:
+                self._sftp.close()
+
+        self._thread = threading.Thread(target=run, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop_event.set()
+        if self._thread is None:
+            self._sftp.close()
+        stats = self.stats()
+        if stats.lookups:
+            logging.info(
+                "Remote metadata cache: {} lookups, {} directory listings, "
+                "{:.1f} ms mean lookup time, {:.1f} ms mean listing "
+                "time".format(
+                    stats.lookups,
+                    stats.listings,
+                    1000 * stats.lookup_time / stats.lookups,
+                    1000 * stats.listing_time / max(stats.listings, 1),
+                )
+            )
+
+    def join(self):
+        if self._thread is not None:
+            self._thread.join()
+
+    def stats(self):
+        """
+        Statistics on lookups and listings so far
+
+        Without the cache, every lookup would be a round trip costing
+        about as much as a listing. Comparing the mean lookup time with
+        the mean listing time therefore measures the latency saved.
+        """
+        with self._lock:
+            return self._stats
+
+    def set_pending_paths(self, pending_paths):
+        """ Refresh the directories of `pending_paths()` in the background """
+        self._pending_paths = pending_paths
+
+    def get_mtime(self, path):
+        """ Remote mtime of `path`, or None if it does not exist """
+        start = time.monotonic()
+        directory, name = posixpath.split(path)
+        with self._lock:
+            listing = self._listings.get(directory)
+        if listing is None or start - listing[0] > self._max_age:
+            entries = self._list(directory)
+        else:
+            _, entries = listing
+        elapsed = time.monotonic() - start
+        with self._lock:
+            self._stats = self._stats._replace(
+                lookups=self._stats.lookups + 1,
+                lookup_time=self._stats.lookup_time + elapsed,
+            )
+        return entries.get(name)
+
+    def update(self, path, mtime):
+        """ Record the mtime of `path`, if its directory is cached """
+        directory, name = posixpath.split(path)
+        with self._lock:
+            listing = self._listings.get(directory)
+            if listing is not None:
+                _, entries = listing
+                entries[name] = mtime
+
+    def refresh(self, paths):
+        """ List the parent directories of `paths` again, now """
+        directories = {posixpath.dirname(path) for path in paths}
+        for directory in directories:
+            self._list(directory)
+
+    def _refresh_pending_directories(self):
+        pending_paths = (
+            [] if self._pending_paths is None else self._pending_paths()
+        )
+        pending_directories = []
+        for path in pending_paths:
+            directory = posixpath.dirname(path)
+            if directory not in pending_directories:
+                pending_directories.append(directory)
+                if len(pending_directories) >= MAX_REFRESHED_DIRECTORIES:
+                    break
+        now = time.monotonic()
+        with self._lock:
+            for directory, (listed, _) in list(self._listings.items()):
+                if (
+                    now - listed > self._max_age
+                    and directory not in pending_directories
+                ):
+                    del self._listings[directory]
+            directories = [
+                directory
+                for directory in pending_directories
+                if directory not in self._listings
+                or now - self._listings[directory][0] > self._max_age / 2
+            ]
+        for directory in directories:
+            self._list(directory)
+
+    def _list(self, directory):
+        start = time.monotonic()
+        try:
+            attributes = self._sftp.listdir_attr(
+                os.path.join(self._remote_dir, directory)
+            )
+        except FileNotFoundError:
+            attributes = []
+        entries = {
+            attrs.filename: datetime.fromtimestamp(int(attrs.st_mtime))
+            for attrs in attributes
+        }
+        end = time.monotonic()
+        with self._lock:
+            self._listings[directory] = (start, entries)
+            self._stats = self._stats._replace(
+                listings=self._stats.listings + 1,
+                listing_time=self._stats.listing_time + end - start,
+            )
+        return entries
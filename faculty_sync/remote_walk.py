@@ -0,0 +1,426 @@
+import logging
+import os
+import stat
+import subprocess
+import threading
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from datetime import datetime
+from shlex import quote
+
+import paramiko
+
+from . import path_match
+from .models import DirectoryAttrs, FileAttrs, FsObject, FsObjectType
+
+# One NUL-terminated record per object: type, mtime, size and path
+# relative to the starting point.
+FIND_FORMAT = "%y\\t%T@\\t%s\\t%P\\0"
+
+# Same as FIND_FORMAT, with the path including the starting point
+FIND_FORMAT_FULL_PATH = "%y\\t%T@\\t%s\\t%p\\0"
+
+# FIND_FORMAT records, prefixed with the time of the last status change
+FIND_FORMAT_WITH_CTIME = "%C@\\t" + FIND_FORMAT
+
+READ_SIZE = 65536
+
+# Number of directories listed at the same time by `walk_remote_sftp`
+DEFAULT_SFTP_CONCURRENCY = 8
+
+
+def walk_remote_exec(transport, root, ignore_paths):
+    """
+    Walk the file tree below `root` on the remote with a single command
+
+    `find` runs in one exec channel on `transport`, which must already
+    be authenticated, and its output is parsed as it arrives. Yields
+    `FsObject`s in the same form as an rsync listing of `root`, in no
+    particular order.
+
+    Single-component ignore patterns (e.g. 'node_modules' or 'dist/')
+    are pruned by `find` itself, so ignored directories are not walked on the
+    remote. Every other pattern is applied to the output.
+    """
+    command = _find_command(root, ignore_paths)
+    ignore_matcher = path_match.PathMatcher(ignore_paths)
+    for record in _run_remote_command(transport, command):
+        try:
+            fs_object = _parse_find_record(record)
+        except ValueError:
+            logging.exception(
+                "Failed to parse find output record {}".format(record)
+            )
+            continue
+        if fs_object.path == "./" or not ignore_matcher.matches(
+            fs_object.path, is_file=fs_object.is_file()
+        ):
+            yield fs_object
+
+
+def walk_remote_exec_incremental(
+    transport, root, ignore_paths, previous_tree, since
+):
+    """
+    Walk the file tree below `root` on the remote, reusing a previous walk
+
+    `previous_tree` is a listing of `root` made when the remote's clock
+    read `since`. Rather than listing everything again, this lists
+    every directory, plus objects whose status changed after `since`.
+    A file's status changes whenever it is written, renamed or has its
+    attributes set, so this catches every modified or added file.
+    Directories whose status changed, e.g. because entries were added
+    or removed, are then listed again to drop deleted files. Everything
+    else is taken from `previous_tree`.
+
+    Returns a list of `FsObject`s in the same form as an rsync listing
+    of `root`, in no particular order.
+    """
+    command = _find_command(
+        root,
+        ignore_paths,
+        ["\\(", "-type", "d", "-o", "-newerct", "@{}".format(since), "\\)"],
+        format=FIND_FORMAT_WITH_CTIME,
+    )
+    ignore_matcher = path_match.PathMatcher(ignore_paths)
+    previous_directories = {
+        fs_object.path
+        for fs_object in previous_tree
+        if fs_object.is_directory()
+    }
+    changed_objects = []
+    current_directories = set()
+    changed_directories = set()
+    for record in _run_remote_command(transport, command):
+        try:
+            ctime_string, record = record.split("\t", 1)
+            ctime = float(ctime_string)
+            fs_object = _parse_find_record(record)
+        except ValueError:
+            logging.exception(
+                "Failed to parse find output record {}".format(record)
+            )
+            continue
+        if fs_object.path != "./" and ignore_matcher.matches(
+            fs_object.path, is_file=fs_object.is_file()
+        ):
+            continue
+        changed_objects.append(fs_object)
+        if fs_object.is_directory():
+            current_directories.add(fs_object.path)
+            # Directory mtimes are no use here, as rsync resets them.
+            if fs_object.path not in previous_directories or ctime >= since:
+                changed_directories.add(fs_object.path)
+    logging.info(
+        "{} objects changed on remote since previous walk, "
+        "listing {} changed directories".format(
+            len(changed_objects), len(changed_directories)
+        )
+    )
+
+    relisted_objects = _list_directory_contents(
+        transport, root, ignore_paths, changed_directories
+    )
+    tree = {
+        fs_object.path: fs_object
+        for fs_object in changed_objects + relisted_objects
+    }
+    for fs_object in previous_tree:
+        if fs_object.is_file() and fs_object.path not in tree:
+            parent = _parent_directory(fs_object.path)
+            if (
+                parent in current_directories
+                and parent not in changed_directories
+            ):
+                tree[fs_object.path] = fs_object
+    return list(tree.values())
+
+
+def walk_remote_exec_changed_files(transport, root, ignore_paths, since):
+    """
+    List files below `root` on the remote whose status changed after `since`
+
+    `since` is a remote time, in seconds since the epoch. This catches
+    files that were written, created or moved in place, but not deleted
+    files.
+    """
+    condition = ["!", "-type", "d", "-newerct", "@{}".format(since)]
+    command = _find_command(root, ignore_paths, condition)
+    records = _run_remote_command(transport, command)
+    return [
+        fs_object
+        for fs_object in _parse_find_output(records, ignore_paths)
+        if fs_object.is_file()
+    ]
+
+
+def supports_exec_walk(transport):
+    """
+    Whether `find` on the remote supports the walks in this module
+
+    They use GNU extensions, such as `-printf` and `-newerct`.
+    """
+    command = "find / -maxdepth 0 -newerct @0 -printf ''"
+    try:
+        list(_run_remote_command(transport, command))
+    except subprocess.CalledProcessError:
+        return False
+    return True
+
+
+def remote_time(transport):
+    """ Current time on the remote, in whole seconds since the epoch """
+    output = list(_run_remote_command(transport, "date +%s", separator=b"\n"))
+    return int(output[0])
+
+
+def remote_sha1sums(transport, root, paths):
+    """
+    SHA-1 digests of files below `root` on the remote, in hex
+
+    Paths are passed on stdin, so any number of them can be checked with
+    a single command.
+    """
+    if not paths:
+        return []
+    command = "cd {} && xargs -0 -r sha1sum --".format(quote(root))
+    input = "".join(path + "\0" for path in paths).encode(
+        "utf-8", errors="surrogateescape"
+    )
+    lines = _run_remote_command(
+        transport, command, separator=b"\n", input=input
+    )
+    # sha1sum prefixes lines for paths that it had to escape with '\'
+    return [line.lstrip("\\")[:40] for line in lines]
+
+
+def walk_remote_sftp(
+    transport, root, ignore_paths, concurrency=DEFAULT_SFTP_CONCURRENCY
+):
+    """
+    Walk the file tree below `root` on the remote with concurrent SFTP calls
+
+    Up to `concurrency` directories are listed at the same time, each
+    through its own SFTP channel on `transport`. On high-latency links,
+    this hides most of the round trips that a sequential walk would
+    wait for. Yields `FsObject`s in the same form as an rsync listing of
+    `root`, as soon as they are found, in no particular order.
+
+    Ignored directories are not descended into.
+    """
+    ignore_matcher = path_match.PathMatcher(ignore_paths)
+    clients = []
+    clients_lock = threading.Lock()
+    local = threading.local()
+
+    def get_sftp():
+        """ SFTP client for the current thread """
+        try:
+            return local.sftp
+        except AttributeError:
+            sftp = local.sftp = _open_sftp(transport)
+            with clients_lock:
+                clients.append(sftp)
+            return sftp
+
+    def list_directory(relative_directory):
+        directory = os.path.join(root, relative_directory)
+        try:
+            return get_sftp().listdir_attr(directory)
+        except IOError as exc:
+            logging.warning(
+                "Failed to read remote directory {}: {}".format(directory, exc)
+            )
+            return []
+
+    executor = ThreadPoolExecutor(max_workers=concurrency)
+    pending = {}
+    try:
+        root_attrs = executor.submit(lambda: get_sftp().stat(root)).result()
+        yield _fs_object_from_attrs("./", root_attrs)
+        pending[executor.submit(list_directory, "")] = ""
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                relative_directory = pending.pop(future)
+                for attrs in future.result():
+                    path = relative_directory + attrs.filename
+                    fs_object = _fs_object_from_attrs(path, attrs)
+                    if ignore_matcher.matches(
+                        path, is_file=fs_object.is_file()
+                    ):
+                        continue
+                    yield fs_object
+                    if fs_object.is_directory():
+                        child_future = executor.submit(
+                            list_directory, fs_object.path
+                        )
+                        pending[child_future] = fs_object.path
+    finally:
+        # Only relevant if the caller stopped consuming the walk early
+        for future in pending:
+            future.cancel()
+        executor.shutdown(wait=True)
+        for sftp in clients:
+            sftp.close()
+
+
+def _open_sftp(transport):
+    return paramiko.SFTPClient.from_transport(transport)
+
+
+def _fs_object_from_attrs(path, attrs):
+    mtime = datetime.fromtimestamp(int(attrs.st_mtime))
+    if stat.S_ISDIR(attrs.st_mode):
+        if path != "./":
+            path += "/"
+        return FsObject(path, FsObjectType.DIRECTORY, DirectoryAttrs(mtime))
+    else:
+        return FsObject(
+            path, FsObjectType.FILE, FileAttrs(mtime, attrs.st_size)
+        )
+
+
+def _find_command(root, ignore_paths, condition=None, format=FIND_FORMAT):
+    """
+    Command listing objects below `root` that match `condition`
+
+    `condition` is a list of `find` expression tokens. The root itself
+    is always listed.
+    """
+    name_patterns = [
+        pattern for pattern in ignore_paths if "/" not in pattern.rstrip("/")
+    ]
+    prune_expression = []
+    for pattern in name_patterns:
+        if prune_expression:
+            prune_expression.append("-o")
+        if pattern.endswith("/"):
+            # Only matches directories, like in rsync
+            prune_expression.extend(
+                ["-name", quote(pattern.rstrip("/")), "-type", "d"]
+            )
+        else:
+            prune_expression.extend(["-name", quote(pattern)])
+    if prune_expression:
+        prune_expression = ["\\(", *prune_expression, "\\)", "-prune", "-o"]
+    condition = [] if condition is None else condition
+    # The root is listed separately so that it can never be pruned.
+    return (
+        "cd {root} && "
+        "find . -maxdepth 0 -printf {format} && "
+        "find . -mindepth 1 {prune} {condition} -printf {format}"
+    ).format(
+        root=quote(root),
+        format=quote(format),
+        prune=" ".join(prune_expression),
+        condition=" ".join(condition),
+    )
+
+
+def _list_directory_contents(transport, root, ignore_paths, directories):
+    """ List the direct children of several directories below `root` """
+    if not directories:
+        return []
+    # Start points are prefixed with './' so that they cannot be mistaken
+    # for options.
+    start_points = [
+        "." if directory == "./" else "./" + directory.rstrip("/")
+        for directory in directories
+    ]
+    # Directories are passed on stdin, as they may not all fit on one
+    # command line.
+    script = 'exec find "$@" -mindepth 1 -maxdepth 1 -printf {}'.format(
+        quote(FIND_FORMAT_FULL_PATH)
+    )
+    command = "cd {} && xargs -0 -r sh -c {} sh".format(
+        quote(root), quote(script)
+    )
+    input = "".join(path + "\0" for path in start_points).encode("utf-8")
+    records = _run_remote_command(transport, command, input=input)
+    return _parse_find_output(records, ignore_paths, full_path=True)
+
+
+def _parse_find_output(records, ignore_paths, full_path=False):
+    ignore_matcher = path_match.PathMatcher(ignore_paths)
+    fs_objects = []
+    for record in records:
+        try:
+            fs_object = _parse_find_record(record, full_path)
+        except ValueError:
+            logging.exception(
+                "Failed to parse find output record {}".format(record)
+            )
+            continue
+        if fs_object.path == "./" or not ignore_matcher.matches(
+            fs_object.path, is_file=fs_object.is_file()
+        ):
+            fs_objects.append(fs_object)
+    return fs_objects
+
+
+def _parent_directory(path):
+    """ Path of the directory containing a file, in rsync listing form """
+    parent, _, _ = path.rpartition("/")
+    return parent + "/" if parent else "./"
+
+
+def _parse_find_record(record, full_path=False):
+    file_type, mtime_string, size_string, path = record.split("\t", 3)
+    if full_path:
+        # Paths start with the './' prefix of the starting point
+        path = path[2:]
+    mtime = datetime.fromtimestamp(int(mtime_string.split(".")[0]))
+    if file_type == "d":
+        path = path + "/" if path else "./"
+        return FsObject(path, FsObjectType.DIRECTORY, DirectoryAttrs(mtime))
+    else:
+        return FsObject(
+            path, FsObjectType.FILE, FileAttrs(mtime, int(size_string))
+        )
+
+
+def _run_remote_command(transport, command, separator=b"\0", input=None):
+    """
+    Run a command on the remote, yielding its output records as they arrive
+
+    `input`, if given, is sent to the command's stdin. Raises
+    `subprocess.CalledProcessError` once the output is exhausted if the
+    command failed.
+    """
+    logging.info("Running remote command {}".format(command))
+    channel = transport.open_session()
+    try:
+        channel.exec_command(command)
+        if input is not None:
+            # Send input in the background, so that the command cannot
+            # block writing output that we are not reading yet.
+            def send_input():
+                channel.sendall(input)
+                channel.shutdown_write()
+
+            threading.Thread(target=send_input, daemon=True).start()
+        stderr_chunks = []
+        buffer = b""
+        while True:
+            data = channel.recv(READ_SIZE)
+            # Keep draining stderr, so that it cannot fill the channel's
+            # window and stall stdout.
+            while channel.recv_stderr_ready():
+                stderr_chunks.append(channel.recv_stderr(READ_SIZE))
+            if not data:
+                break
+            buffer += data
+            *records, buffer = buffer.split(separator)
+            for record in records:
+                yield record.decode("utf-8", errors="surrogateescape")
+        if buffer:
+            yield buffer.decode("utf-8", errors="surrogateescape")
+        exit_status = channel.recv_exit_status()
+        while channel.recv_stderr_ready():
+            stderr_chunks.append(channel.recv_stderr(READ_SIZE))
+    finally:
+        channel.close()
+    if exit_status != 0:
+        raise subprocess.CalledProcessError(
+            exit_status, command, stderr=b"".join(stderr_chunks)
+        )
@@ -0,0 +1,87 @@
+import logging
+from datetime import datetime
+
+from .models import DirectoryAttrs, FileAttrs, FsObject, FsObjectType
+
+# Format passed to rsync's --out-format when listing file trees
+LIST_OUT_FORMAT = "%i||%n||%M||%l"
+
+# Number of distinct timestamps remembered by `parse_mtime`. Files
+# written together (e.g. by a git checkout) tend to share timestamps, so
+# caching avoids both the parsing and a datetime object per file.
+MTIME_CACHE_SIZE = 100000
+
+_mtime_cache = {}
+
+
+def parse_mtime(mtime_string):
+    """
+    Parse a timestamp printed by rsync's %M escape
+
+    The format is always `%Y/%m/%d-%H:%M:%S`, so we can read each field
+    at a fixed offset, which is much faster than `datetime.strptime`.
+    """
+    try:
+        return _mtime_cache[mtime_string]
+    except KeyError:
+        pass
+    if (
+        len(mtime_string) != 19
+        or mtime_string[4] != "/"
+        or mtime_string[7] != "/"
+        or mtime_string[10] != "-"
+        or mtime_string[13] != ":"
+        or mtime_string[16] != ":"
+    ):
+        raise ValueError("Unexpected rsync timestamp {}".format(mtime_string))
+    mtime = datetime(
+        int(mtime_string[0:4]),
+        int(mtime_string[5:7]),
+        int(mtime_string[8:10]),
+        int(mtime_string[11:13]),
+        int(mtime_string[14:16]),
+        int(mtime_string[17:19]),
+    )
+    if len(_mtime_cache) >= MTIME_CACHE_SIZE:
+        _mtime_cache.clear()
+    _mtime_cache[mtime_string] = mtime
+    return mtime
+
+
+def parse_list_output(lines):
+    """
+    Parse rsync output produced with `--out-format LIST_OUT_FORMAT`
+
+    Yields an `FsObject` for each line. Lines that cannot be parsed are
+    logged and skipped. So are messages such as `*deleting` lines,
+    printed with `--delete`, which do not describe an object that
+    exists after the transfer.
+    """
+    directory_type = FsObjectType.DIRECTORY
+    file_type = FsObjectType.FILE
+    for line in lines:
+        if line.startswith("*"):
+            continue
+        try:
+            fields = line.split("||")
+            if len(fields) == 4:
+                changes, path, mtime_string, size_string = fields
+            else:
+                # The path itself contains the separator
+                changes, rest = line.split("||", 1)
+                path, mtime_string, size_string = rest.rsplit("||", 2)
+            mtime = parse_mtime(mtime_string)
+            if changes[1:2] == "d":
+                fs_object = FsObject(
+                    path, directory_type, DirectoryAttrs(mtime)
+                )
+            else:
+                fs_object = FsObject(
+                    path, file_type, FileAttrs(mtime, int(size_string))
+                )
+        except ValueError:
+            logging.exception(
+                "Failed to parse rsync output line {}".format(line)
+            )
+        else:
+            yield fs_object
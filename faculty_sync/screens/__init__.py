@@ -1,7 +1,9 @@
 from .diff import DifferencesScreen  # noqa
 from .walking_trees import (
+    FileTreeWalk,
     WalkingFileTreesScreen,
     WalkingFileTreesStatus,
+    WalkProgress,
 )  # noqa
 from .watch_sync import WatchSyncScreen  # noqa
 from .choose_remote_dir import RemoteDirectoryPromptScreen  # noqa
@@ -96,6 +96,8 @@ ACTION_TEXT = {
     (DifferenceType.TYPE_DIFFERENT, SelectionName.DOWN): "replace local",
     (DifferenceType.ATTRS_DIFFERENT, SelectionName.UP): "replace remote",
     (DifferenceType.ATTRS_DIFFERENT, SelectionName.DOWN): "replace local",
+    (DifferenceType.MOVED, SelectionName.UP): "move remote",
+    (DifferenceType.MOVED, SelectionName.DOWN): "move local",
 }
 
 
@@ -256,6 +258,12 @@ class Details(object):
                 paths.append(difference.left.path)
             elif difference.difference_type == DifferenceType.RIGHT_ONLY:
                 paths.append(difference.right.path)
+            elif difference.difference_type == DifferenceType.MOVED:
+                if direction == SelectionName.UP:
+                    source, destination = difference.right, difference.left
+                else:
+                    source, destination = difference.left, difference.right
+                paths.append("{} -> {}".format(source.path, destination.path))
             else:
                 paths.append(difference.left.path)
 
@@ -314,13 +322,29 @@ class Details(object):
 
 
 class DifferencesScreen(BaseScreen):
-    def __init__(self, differences, exchange):
+    def __init__(self, differences, exchange, cached=False):
+        """
+        Screen showing the differences between the two file trees
+
+        If `cached` is True, the differences were calculated from a
+        snapshot saved by a previous session, and are being checked.
+        They cannot be refreshed until the check is over.
+        """
         super().__init__()
         self._exchange = exchange
-        self._bottom_toolbar = Window(
-            FormattedTextControl(
+        if cached:
+            toolbar_text = (
+                "[arrows] Navigation "
+                "[?] Help  "
+                "[q] Quit  "
+                "(last known state, checking for changes...)"
+            )
+        else:
+            toolbar_text = (
                 "[arrows] Navigation " "[r] Refresh  " "[?] Help  " "[q] Quit"
-            ),
+            )
+        self._bottom_toolbar = Window(
+            FormattedTextControl(toolbar_text),
             height=1,
             style="reverse",
         )
@@ -344,9 +368,11 @@ class DifferencesScreen(BaseScreen):
             else:
                 self._summary.current_selection = SelectionName.UP
 
-        @self.bindings.add("r")  # noqa: F811
-        def _(event):
-            self._exchange.publish(Messages.REFRESH_DIFFERENCES)
+        if not cached:
+
+            @self.bindings.add("r")  # noqa: F811
+            def _(event):
+                self._exchange.publish(Messages.REFRESH_DIFFERENCES)
 
         @self.bindings.add("w")  # noqa: F811
         def _(event):
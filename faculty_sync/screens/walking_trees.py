@@ -1,3 +1,4 @@
+import collections
 import threading
 import time
 from enum import Enum
@@ -15,17 +16,28 @@ from .loading import LoadingIndicator
 class WalkingFileTreesStatus(Enum):
 
     CONNECTING = "CONNECTING"
-    LOCAL_WALK = "LOCAL_WALK"
-    REMOTE_WALK = "REMOTE_WALK"
+    WALKING_TREES = "WALKING_TREES"
     CALCULATING_DIFFERENCES = "CALCULATING_DIFFERENCES"
 
 
+class FileTreeWalk(Enum):
+
+    LOCAL = "LOCAL"
+    REMOTE = "REMOTE"
+
+
+WalkProgress = collections.namedtuple(
+    "WalkProgress", ["walk", "nobjects_walked", "finished"]
+)
+
+
 class WalkingFileTreesScreen(BaseScreen):
     def __init__(self, initial_status, exchange):
         super().__init__()
         self._status_control = FormattedTextControl("")
         self._loading_indicator = LoadingIndicator()
         self._status = None
+        self._progress = {}
         self.set_status(initial_status)
         self._bottom_toolbar = Window(
             FormattedTextControl("[q] Quit"), height=1, style="reverse"
@@ -38,10 +50,16 @@ class WalkingFileTreesScreen(BaseScreen):
             ]
         )
         self._exchange = exchange
-        self._subscription_id = exchange.subscribe(
-            Messages.WALK_STATUS_CHANGE,
-            lambda new_status: self.set_status(new_status),
-        )
+        self._subscription_ids = [
+            exchange.subscribe(
+                Messages.WALK_STATUS_CHANGE,
+                lambda new_status: self.set_status(new_status),
+            ),
+            exchange.subscribe(
+                Messages.WALK_PROGRESS,
+                lambda progress: self.set_progress(progress),
+            ),
+        ]
         self._stop_event = threading.Event()
         self._thread = None
         self._start_updating_loading_indicator()
@@ -50,6 +68,10 @@ class WalkingFileTreesScreen(BaseScreen):
         self._status = status
         self._render()
 
+    def set_progress(self, progress):
+        self._progress[progress.walk] = progress
+        self._render()
+
     def _start_updating_loading_indicator(self):
         def run():
             app = get_app()
@@ -68,13 +90,20 @@ class WalkingFileTreesScreen(BaseScreen):
             self._status_control.text = "  {} Connecting to Faculty Platform server".format(
                 loading_character
             )
-        elif self._status == WalkingFileTreesStatus.LOCAL_WALK:
-            self._status_control.text = "  {} Walking local file tree".format(
-                loading_character
-            )
-        elif self._status == WalkingFileTreesStatus.REMOTE_WALK:
-            self._status_control.text = "  {} Walking file tree on Faculty Platform".format(
-                loading_character
+        elif self._status == WalkingFileTreesStatus.WALKING_TREES:
+            self._status_control.text = "\n".join(
+                [
+                    self._format_walk(
+                        FileTreeWalk.LOCAL,
+                        "Walking local file tree",
+                        loading_character,
+                    ),
+                    self._format_walk(
+                        FileTreeWalk.REMOTE,
+                        "Walking file tree on Faculty Platform",
+                        loading_character,
+                    ),
+                ]
             )
         elif self._status == WalkingFileTreesStatus.CALCULATING_DIFFERENCES:
             self._status_control.text = (
@@ -82,6 +111,20 @@ class WalkingFileTreesScreen(BaseScreen):
                 "local and remote file trees".format(loading_character)
             )
 
+    def _format_walk(self, walk, description, loading_character):
+        progress = self._progress.get(walk)
+        if progress is None:
+            return "  {} {}".format(loading_character, description)
+        elif progress.finished:
+            return "  - {} ({:,} files, done)".format(
+                description, progress.nobjects_walked
+            )
+        else:
+            return "  {} {} ({:,} files walked)".format(
+                loading_character, description, progress.nobjects_walked
+            )
+
     def stop(self):
         self._stop_event.set()
-        self._exchange.unsubscribe(self._subscription_id)
+        for subscription_id in self._subscription_ids:
+            self._exchange.unsubscribe(subscription_id)
@@ -27,12 +27,23 @@ To avoid overwriting changes that you may have made on Faculty Platform
 directly, we avoid pushing changes if the file is modified on
 Faculty Platform while this process is running.
 
+Files modified on Faculty Platform are pulled down automatically, unless
+they have also changed locally. Remote deletions are not pulled.
+
+Changes that fail to sync are retried a few times. If they still fail,
+the directory that contains them is synced as a whole, and if that
+fails too, they are listed as failed.
+
+When many changes happen at once, for instance when switching git
+branches, the directories that contain them are synced as a whole.
+
 Keys:
 
     [s] Stop incremental synchronization and go back to main screen
     [d] Bring all the changes down from Faculty Platform. This only updates
         files that are newer on Faculty Platform than locally. It will not
         delete local files that do not exist on Faculty Platform.
+    [r] Try again to sync changes that failed
     [q] Quit the application
     [?] Toggle this message
 """
@@ -70,34 +81,55 @@ class Loading(object):
         self._stop_event.set()
 
 
+# Maximum number of transfers in progress listed on the screen
+MAX_CURRENT_EVENTS_SHOWN = 10
+
+
 class CurrentlySyncing(object):
     def __init__(self):
-        self._current_event = None
+        self._current_events = []
+        self._lock = threading.Lock()
         self._loading_indicator = LoadingIndicator()
         self._has_synced_at_least_once = False
         self._control = FormattedTextControl("")
-        self.container = Window(self._control, height=1)
+        self.container = Window(self._control, dont_extend_height=True)
         self._stop_event = threading.Event()
         self._thread = None
         self._start_updating_loading_indicator()
 
-    def set_current_event(self, fs_event):
-        self._has_synced_at_least_once = True
-        self._current_event = fs_event
+    def add_event(self, fs_event):
+        with self._lock:
+            self._has_synced_at_least_once = True
+            self._current_events.append(fs_event)
+
+    def remove_event(self, fs_event):
+        with self._lock:
+            try:
+                self._current_events.remove(fs_event)
+            except ValueError:
+                pass
 
     def stop(self):
         self._stop_event.set()
 
     def _render(self):
-        if self._current_event is None and not self._has_synced_at_least_once:
+        with self._lock:
+            current_events = list(self._current_events)
+            has_synced_at_least_once = self._has_synced_at_least_once
+        if not current_events and not has_synced_at_least_once:
             self._control.text = "  Ready and waiting for local changes"
-        elif self._current_event is None:
+        elif not current_events:
             self._control.text = ""
         else:
-            path = self._current_event.path
-            self._control.text = "  {} {}".format(
-                self._loading_indicator.current(), path
-            )
+            indicator = self._loading_indicator.current()
+            lines = [
+                "  {} {}".format(indicator, fs_event.path)
+                for fs_event in current_events[:MAX_CURRENT_EVENTS_SHOWN]
+            ]
+            nhidden = len(current_events) - MAX_CURRENT_EVENTS_SHOWN
+            if nhidden > 0:
+                lines.append("    ... and {} more".format(nhidden))
+            self._control.text = "\n".join(lines)
 
     def _start_updating_loading_indicator(self):
         def run():
@@ -160,6 +192,12 @@ class RecentlySyncedItems(object):
             event_text = "{} -> {}".format(src_path_text, dest_path_text)
         elif event.event_type == ChangeEventType.DELETED:
             event_text = "{} (x)".format(src_path_text)
+        elif event.extra_args and event.extra_args.get("pulled"):
+            event_text = "{} (pulled)".format(src_path_text)
+        elif event.extra_args and "collapsed_events" in event.extra_args:
+            event_text = "{} ({} changes)".format(
+                src_path_text, len(event.extra_args["collapsed_events"])
+            )
         else:
             event_text = "{}".format(src_path_text)
         return event_text
@@ -215,7 +253,7 @@ class HeldFiles(object):
                 self._format_held_paths(self._held_paths),
             ]
         else:
-            self.container.children = Window(dont_extend_height=True)
+            self.container.children = [Window(dont_extend_height=True)]
 
     def _format_held_paths(self, paths):
         paths_text = "\n".join(["    {}".format(path) for path in paths])
@@ -223,6 +261,43 @@ class HeldFiles(object):
         return Window(control)
 
 
+class FailedFiles(object):
+    def __init__(self):
+        self._failed_events = []
+        self.container = HSplit([Window()])
+
+    def set_events(self, fs_events):
+        # Truncate to avoid huge list lengths
+        self._failed_events = list(fs_events)[:100]
+        self._render()
+
+    def _render(self):
+        if self._failed_events:
+            self.container.children = [
+                Window(height=1),
+                Window(char="-", height=1),
+                Window(height=1),
+                Window(
+                    FormattedTextControl(
+                        "  The following changes could not be synced to "
+                        "Faculty. Press [r] to try again:"
+                    ),
+                    dont_extend_height=True,
+                ),
+                Window(height=1),
+                self._format_failed_events(self._failed_events),
+            ]
+        else:
+            self.container.children = [Window(dont_extend_height=True)]
+
+    def _format_failed_events(self, fs_events):
+        paths_text = "\n".join(
+            ["    {}".format(fs_event.path) for fs_event in fs_events]
+        )
+        control = FormattedTextControl(paths_text)
+        return Window(control)
+
+
 class WatchSyncScreen(BaseScreen):
     def __init__(self, exchange):
         super().__init__()
@@ -232,10 +307,12 @@ class WatchSyncScreen(BaseScreen):
         self._currently_syncing_component = None
         self._recently_synced_component = None
         self._held_files_component = None
+        self._failed_files_component = None
 
         self.menu_bar = Window(
             FormattedTextControl(
-                "[s] Stop  [d] Sync files down  [q] Quit  [?] Help"
+                "[s] Stop  [d] Sync files down  [r] Retry failed  [q] Quit  "
+                "[?] Help"
             ),
             height=1,
             style="reverse",
@@ -256,6 +333,10 @@ class WatchSyncScreen(BaseScreen):
                 Messages.HELD_FILES_CHANGED,
                 lambda held_files: self._update_held_files(held_files),
             ),
+            self._exchange.subscribe(
+                Messages.FAILED_FS_EVENTS_CHANGED,
+                lambda fs_events: self._update_failed_events(fs_events),
+            ),
             self._exchange.subscribe(
                 Messages.STARTING_HANDLING_FS_EVENT,
                 lambda event: self._on_start_handling_fs_event(event),
@@ -264,6 +345,10 @@ class WatchSyncScreen(BaseScreen):
                 Messages.FINISHED_HANDLING_FS_EVENT,
                 lambda event: self._on_finish_handling_fs_event(event),
             ),
+            self._exchange.subscribe(
+                Messages.FAILED_HANDLING_FS_EVENT,
+                lambda event: self._on_fail_handling_fs_event(event),
+            ),
         ]
 
         self.bindings = KeyBindings()
@@ -276,6 +361,10 @@ class WatchSyncScreen(BaseScreen):
         def _(event):
             self._exchange.publish(Messages.DOWN_IN_WATCH_SYNC)
 
+        @self.bindings.add("r")
+        def _(event):
+            self._exchange.publish(Messages.RETRY_FAILED_IN_WATCH_SYNC)
+
         @self.bindings.add("?")
         def _(event):
             self._toggle_help()
@@ -298,11 +387,13 @@ class WatchSyncScreen(BaseScreen):
         self._currently_syncing_component = CurrentlySyncing()
         self._recently_synced_component = RecentlySyncedItems()
         self._held_files_component = HeldFiles()
+        self._failed_files_component = FailedFiles()
         self._screen_container.children = [
             Window(height=1),
             self._currently_syncing_component.container,
             self._recently_synced_component.container,
             self._held_files_component.container,
+            self._failed_files_component.container,
             self.menu_bar,
         ]
 
@@ -310,15 +401,23 @@ class WatchSyncScreen(BaseScreen):
         if self._held_files_component:
             self._held_files_component.set_paths(held_files)
 
+    def _update_failed_events(self, fs_events):
+        if self._failed_files_component:
+            self._failed_files_component.set_events(fs_events)
+
     def _on_start_handling_fs_event(self, fs_event):
         if self._currently_syncing_component:
-            self._currently_syncing_component.set_current_event(fs_event)
+            self._currently_syncing_component.add_event(fs_event)
 
     def _on_finish_handling_fs_event(self, fs_event):
         if self._recently_synced_component:
             self._recently_synced_component.add_item(fs_event)
         if self._currently_syncing_component:
-            self._currently_syncing_component.set_current_event(None)
+            self._currently_syncing_component.remove_event(fs_event)
+
+    def _on_fail_handling_fs_event(self, fs_event):
+        if self._currently_syncing_component:
+            self._currently_syncing_component.remove_event(fs_event)
 
     def stop(self):
         self._stop_main_components()
@@ -0,0 +1,120 @@
+import collections
+import gzip
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import threading
+from datetime import datetime
+
+from .dirs import ensure_parent_exists
+from .file_trees import CompactFileTree
+from .models import DirectoryAttrs, FileAttrs, FsObject, FsObjectType
+
+# Like logs, snapshots are 'data' files in the sense of the XDG Base
+# Directory Specification.
+SNAPSHOT_DIRECTORY = os.path.expanduser(
+    "~/.local/share/faculty-sync/snapshots"
+)
+
+# Bump when the on-disk format changes. Snapshots with a different
+# version are ignored.
+SNAPSHOT_FORMAT_VERSION = 1
+
+
+# Last known state of the local and remote file trees. `remote_time` is
+# the time on the remote, in seconds since the epoch, just before the
+# remote tree was walked.
+Snapshot = collections.namedtuple(
+    "Snapshot", ["local_tree", "remote_tree", "remote_time"]
+)
+
+
+class SnapshotStore(object):
+    def __init__(
+        self, project_id, server_id, local_dir, remote_dir, ignore_paths
+    ):
+        """
+        Persist file tree snapshots for one synchronization configuration
+
+        Snapshots are keyed by project, server, local and remote
+        directory, and ignore patterns, so that each configuration has
+        its own. Trees listed with other ignore patterns would not hold
+        the same files.
+        """
+        key = json.dumps(
+            [
+                str(project_id),
+                str(server_id),
+                os.path.abspath(local_dir),
+                remote_dir,
+                sorted(set(ignore_paths)),
+            ]
+        )
+        digest = hashlib.sha1(key.encode("utf-8")).hexdigest()
+        self._path = os.path.join(SNAPSHOT_DIRECTORY, digest + ".json.gz")
+        self._lock = threading.Lock()
+
+    def load(self):
+        """ Return the last snapshot saved, or None """
+        with self._lock:
+            try:
+                with gzip.open(self._path, "rt", encoding="utf-8") as f:
+                    data = json.load(f)
+            except FileNotFoundError:
+                return None
+            except (OSError, ValueError):
+                logging.exception(
+                    "Failed to read snapshot {}".format(self._path)
+                )
+                return None
+        if data.get("version") != SNAPSHOT_FORMAT_VERSION:
+            return None
+        return Snapshot(
+            CompactFileTree(map(_decode_fs_object, data["local_tree"])),
+            CompactFileTree(map(_decode_fs_object, data["remote_tree"])),
+            data["remote_time"],
+        )
+
+    def save(self, snapshot):
+        data = {
+            "version": SNAPSHOT_FORMAT_VERSION,
+            "local_tree": [_encode_fs_object(o) for o in snapshot.local_tree],
+            "remote_tree": [
+                _encode_fs_object(o) for o in snapshot.remote_tree
+            ],
+            "remote_time": snapshot.remote_time,
+        }
+        with self._lock:
+            ensure_parent_exists(self._path)
+            # Write to a temporary file first, so that a crash cannot
+            # leave a truncated snapshot behind. Another session with the
+            # same configuration may be saving too: use a file of our own.
+            fd, temporary_path = tempfile.mkstemp(
+                dir=os.path.dirname(self._path), suffix=".tmp"
+            )
+            try:
+                with open(fd, "wb") as raw_file:
+                    with gzip.open(raw_file, "wt", encoding="utf-8") as f:
+                        json.dump(data, f, separators=(",", ":"))
+                os.replace(temporary_path, self._path)
+            except BaseException:
+                os.remove(temporary_path)
+                raise
+
+
+def _encode_fs_object(fs_object):
+    mtime = int(fs_object.attrs.last_modified.timestamp())
+    if fs_object.is_directory():
+        return [fs_object.path, mtime]
+    else:
+        return [fs_object.path, mtime, fs_object.attrs.size]
+
+
+def _decode_fs_object(row):
+    mtime = datetime.fromtimestamp(row[1])
+    if len(row) == 2:
+        return FsObject(row[0], FsObjectType.DIRECTORY, DirectoryAttrs(mtime))
+    else:
+        return FsObject(row[0], FsObjectType.FILE, FileAttrs(mtime, row[2]))
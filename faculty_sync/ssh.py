@@ -1,14 +1,32 @@
 import contextlib
+import logging
 import os
 import shutil
 import stat
+import subprocess
 import tempfile
+import threading
+import time
 
 import faculty
 import paramiko
 
 from .models import SshDetails
 
+SSH_OPTIONS = [
+    "-o",
+    "IdentitiesOnly=yes",
+    "-o",
+    "StrictHostKeyChecking=no",
+    "-o",
+    "BatchMode=yes",
+]
+
+# How long to wait for the master connection to create its control socket
+# before letting clients go ahead. Clients that start before the socket
+# exists just open their own connection.
+MASTER_STARTUP_TIMEOUT = 10
+
 
 def sftp_from_ssh_details(ssh_details):
     transport = paramiko.Transport((ssh_details.hostname, ssh_details.port))
@@ -22,6 +40,110 @@ def sftp_from_ssh_details(ssh_details):
     return sftp
 
 
+class SshMaster(object):
+    def __init__(self, ssh_details):
+        """
+        Persistent SSH connection shared by every ssh client we spawn.
+
+        Clients opt in by passing the options returned by
+        `client_options` to ssh. If the master connection dies, it is
+        restarted the next time `ensure_running` is called. Clients
+        that cannot reach the control socket fall back to opening a
+        connection of their own.
+        """
+        self._ssh_details = ssh_details
+        self._process = None
+        self._control_dir = None
+        self._lock = threading.Lock()
+
+    @property
+    def control_path(self):
+        if self._control_dir is None:
+            return None
+        return os.path.join(self._control_dir, "master.sock")
+
+    def start(self):
+        with self._lock:
+            self._start()
+
+    def ensure_running(self):
+        with self._lock:
+            if self._process is None or self._process.poll() is not None:
+                if self._process is not None:
+                    logging.warning(
+                        "SSH master connection exited with code {}. "
+                        "Restarting.".format(self._process.returncode)
+                    )
+                self._start()
+
+    def stop(self):
+        with self._lock:
+            if self._process is not None:
+                logging.info("Stopping SSH master connection.")
+                self._process.terminate()
+                try:
+                    self._process.wait(timeout=5)
+                except subprocess.TimeoutExpired:
+                    self._process.kill()
+                    self._process.wait()
+                self._process = None
+            if self._control_dir is not None:
+                shutil.rmtree(self._control_dir, ignore_errors=True)
+                self._control_dir = None
+
+    def client_options(self):
+        if self.control_path is None:
+            return []
+        return [
+            "-o",
+            "ControlMaster=no",
+            "-o",
+            "ControlPath={}".format(self.control_path),
+        ]
+
+    def _start(self):
+        if self._control_dir is None:
+            self._control_dir = tempfile.mkdtemp()
+        control_path = self.control_path
+        if os.path.exists(control_path):
+            # Stale socket left by a master that died
+            os.remove(control_path)
+        argv = [
+            "ssh",
+            *SSH_OPTIONS,
+            "-o",
+            "ControlMaster=yes",
+            "-o",
+            "ControlPath={}".format(control_path),
+            "-o",
+            "ServerAliveInterval=15",
+            "-N",
+            "-p",
+            str(self._ssh_details.port),
+            "-i",
+            self._ssh_details.key_file,
+            "{}@{}".format(
+                self._ssh_details.username, self._ssh_details.hostname
+            ),
+        ]
+        logging.info("Starting SSH master connection {}".format(argv))
+        self._process = subprocess.Popen(
+            argv,
+            stdin=subprocess.DEVNULL,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+        )
+        deadline = time.time() + MASTER_STARTUP_TIMEOUT
+        while not os.path.exists(control_path) and time.time() < deadline:
+            if self._process.poll() is not None:
+                logging.warning(
+                    "SSH master connection failed to start. "
+                    "Falling back to one connection per command."
+                )
+                break
+            time.sleep(0.05)
+
+
 @contextlib.contextmanager
 def get_ssh_details(configuration):
     client = faculty.client("server")
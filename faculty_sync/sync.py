@@ -1,26 +1,52 @@
 import errno
+import hashlib
 import logging
 import os.path
 import subprocess
+import tempfile
 import time
-from datetime import datetime
+from enum import Enum
 from shlex import quote
 
-from .models import DirectoryAttrs, FileAttrs, FsObject, FsObjectType
-from .ssh import sftp_from_ssh_details
+from .file_trees import CompactFileTree
+from .local_walk import walk_local
+from .remote_walk import (
+    DEFAULT_SFTP_CONCURRENCY,
+    remote_sha1sums,
+    remote_time,
+    supports_exec_walk,
+    walk_remote_exec,
+    walk_remote_exec_changed_files,
+    walk_remote_exec_incremental,
+    walk_remote_sftp,
+)
+from .rsync_output import LIST_OUT_FORMAT, parse_list_output
+from .ssh import SSH_OPTIONS, SshMaster, sftp_from_ssh_details
 
-SSH_OPTIONS = [
-    "-o",
-    "IdentitiesOnly=yes",
-    "-o",
-    "StrictHostKeyChecking=no",
-    "-o",
-    "BatchMode=yes",
-]
+
+class RemoteListingEngine(Enum):
+    # rsync --dry-run over a new ssh connection
+    RSYNC = "RSYNC"
+
+    # `find` in an exec channel on the existing SFTP connection. Needs
+    # GNU find on the remote: falls back to RSYNC without it.
+    EXEC = "EXEC"
+
+    # Concurrent SFTP directory listings on the existing SFTP connection
+    SFTP = "SFTP"
 
 
 class Synchronizer(object):
-    def __init__(self, local_dir, remote_dir, ssh_details, ignore_paths):
+    def __init__(
+        self,
+        local_dir,
+        remote_dir,
+        ssh_details,
+        ignore_paths,
+        local_walk_workers=None,
+        remote_listing_engine=RemoteListingEngine.EXEC,
+        remote_walk_concurrency=DEFAULT_SFTP_CONCURRENCY,
+    ):
         self.hostname = ssh_details.hostname
         self.port = ssh_details.port
         self.username = ssh_details.username
@@ -28,7 +54,23 @@ class Synchronizer(object):
         self.local_dir = local_dir
         self.remote_dir = remote_dir
         self.ignore_paths = ignore_paths
+        # Number of threads reading local directories in parallel while
+        # walking the local tree. None to walk in the calling thread.
+        self.local_walk_workers = local_walk_workers
+        self.remote_listing_engine = remote_listing_engine
+        # Number of remote directories listed at the same time by the
+        # SFTP listing engine
+        self.remote_walk_concurrency = remote_walk_concurrency
+        # Whether the remote can run the EXEC engine's commands, once
+        # checked
+        self._exec_walk_supported = None
         self._sftp = sftp_from_ssh_details(ssh_details)
+        self._ssh_master = SshMaster(ssh_details)
+        self._ssh_master.start()
+
+    def close(self):
+        self._ssh_master.stop()
+        self._sftp.close()
 
     def up(self, path="", rsync_opts=None):
         if os.path.isabs(path):
@@ -42,6 +84,108 @@ class Synchronizer(object):
         )
         return self._rsync(path_from, path_to, rsync_opts)
 
+    def up_directory(self, path, rsync_opts=None):
+        """
+        Mirror a local directory on the remote
+
+        Remote files that do not exist locally are deleted. Returns the
+        `FsObject`s that rsync reports transferring, with paths relative
+        to the local directory.
+        """
+        directory = path.strip("/")
+        rsync_opts = [] if rsync_opts is None else rsync_opts
+        process = self.up(
+            directory + "/" if directory else "",
+            rsync_opts=[
+                "--delete",
+                "--out-format",
+                LIST_OUT_FORMAT,
+                *rsync_opts,
+            ],
+        )
+        lines = process.stdout.decode("utf-8").splitlines()
+        return [
+            fs_object._replace(path=_join_path(directory, fs_object.path))
+            for fs_object in parse_list_output(lines)
+        ]
+
+    def up_files(self, paths, rsync_opts=None):
+        """
+        Upload several files in a single rsync transfer.
+
+        Paths are relative to the local directory. Parent directories
+        are created on the remote as needed.
+
+        Returns the `FsObject`s that rsync reports transferring, with
+        the attributes it set on the remote. Files that were already up
+        to date are not included.
+
+        Files that no longer exist locally are skipped, as rsync fails
+        the whole transfer for a missing file. Their deletion is
+        replicated when its own event is handled.
+        """
+        for path in paths:
+            if os.path.isabs(path):
+                raise ValueError("paths must be relative paths")
+        paths = [
+            path
+            for path in paths
+            if os.path.lexists(os.path.join(self.local_dir, path))
+        ]
+        if not paths:
+            return []
+        rsync_opts = [] if rsync_opts is None else rsync_opts
+        escaped_remote = quote(self.remote_dir)
+        path_to = "{}@{}:{}".format(
+            self.username, self.hostname, escaped_remote
+        )
+        files_from = "".join(path + "\0" for path in paths)
+        process = self._rsync(
+            self.local_dir,
+            path_to,
+            [
+                "--from0",
+                "--files-from=-",
+                "--out-format",
+                LIST_OUT_FORMAT,
+                *rsync_opts,
+            ],
+            input=files_from.encode("utf-8"),
+        )
+        lines = process.stdout.decode("utf-8").splitlines()
+        return list(parse_list_output(lines))
+
+    def down_files(self, paths, rsync_opts=None):
+        """
+        Download several files in a single rsync transfer.
+
+        Paths are relative to the remote directory. Returns the
+        `FsObject`s that rsync reports transferring.
+        """
+        for path in paths:
+            if os.path.isabs(path):
+                raise ValueError("paths must be relative paths")
+        rsync_opts = [] if rsync_opts is None else rsync_opts
+        escaped_remote = quote(self.remote_dir)
+        path_from = "{}@{}:{}".format(
+            self.username, self.hostname, escaped_remote
+        )
+        files_from = "".join(path + "\0" for path in paths)
+        process = self._rsync(
+            path_from,
+            self.local_dir,
+            [
+                "--from0",
+                "--files-from=-",
+                "--out-format",
+                LIST_OUT_FORMAT,
+                *rsync_opts,
+            ],
+            input=files_from.encode("utf-8"),
+        )
+        lines = process.stdout.decode("utf-8").splitlines()
+        return list(parse_list_output(lines))
+
     def down(self, path="", rsync_opts=None):
         if os.path.isabs(path):
             raise ValueError("path must be a relative path")
@@ -55,14 +199,106 @@ class Synchronizer(object):
         return self._rsync(path_from, path_to, rsync_opts)
 
     def list_remote(self, path="", rsync_opts=None):
+        return CompactFileTree(self.iter_remote(path, rsync_opts))
+
+    def iter_remote(self, path="", rsync_opts=None):
+        """
+        Stream the remote file tree
+
+        Objects are yielded in the order the listing engine finds them.
+        `rsync_opts` only applies to the rsync engine.
+        """
         remote = os.path.join(self.remote_dir, path)
+        transport = self._sftp.get_channel().get_transport()
+        engine = self._listing_engine()
+        if engine == RemoteListingEngine.EXEC:
+            return walk_remote_exec(transport, remote, self.ignore_paths)
+        elif engine == RemoteListingEngine.SFTP:
+            return walk_remote_sftp(
+                transport,
+                remote,
+                self.ignore_paths,
+                concurrency=self.remote_walk_concurrency,
+            )
         escaped_remote = quote(remote)
-        path = u"{}@{}:{}".format(self.username, self.hostname, escaped_remote)
+        path = "{}@{}:{}".format(self.username, self.hostname, escaped_remote)
         return self._rsync_list(path, rsync_opts)
 
-    def list_local(self, path="", rsync_opts=None):
+    def iter_remote_changes(self, previous_tree, since, path=""):
+        """
+        List the remote file tree, reusing a previous listing
+
+        `previous_tree` must be a listing of `path` made when the remote
+        time returned by `remote_time` was `since`. Only the exec engine
+        can list changes: other engines list the whole tree again.
+        """
+        if self._listing_engine() != RemoteListingEngine.EXEC:
+            return self.iter_remote(path)
+        remote = os.path.join(self.remote_dir, path)
+        transport = self._sftp.get_channel().get_transport()
+        return walk_remote_exec_incremental(
+            transport, remote, self.ignore_paths, previous_tree, since
+        )
+
+    def iter_remote_changed_files(self, since, path=""):
+        """
+        List remote files modified or created after `since`
+
+        `since` is a time returned by `remote_time`. Only the exec
+        engine can list changes: other engines list every file.
+        """
+        if self._listing_engine() != RemoteListingEngine.EXEC:
+            return (
+                fs_object
+                for fs_object in self.iter_remote(path)
+                if fs_object.is_file()
+            )
+        remote = os.path.join(self.remote_dir, path)
+        transport = self._sftp.get_channel().get_transport()
+        return walk_remote_exec_changed_files(
+            transport, remote, self.ignore_paths, since
+        )
+
+    def _listing_engine(self):
+        """
+        Engine to list the remote tree with
+
+        This is `remote_listing_engine`, unless it is the exec engine
+        and the remote cannot run its commands, in which case rsync is
+        used instead.
+        """
+        engine = self.remote_listing_engine
+        if engine == RemoteListingEngine.EXEC:
+            if self._exec_walk_supported is None:
+                self._exec_walk_supported = supports_exec_walk(
+                    self._sftp.get_channel().get_transport()
+                )
+                if not self._exec_walk_supported:
+                    logging.warning(
+                        "find on the remote does not support the options "
+                        "needed to list files, falling back to rsync"
+                    )
+            if not self._exec_walk_supported:
+                engine = RemoteListingEngine.RSYNC
+        return engine
+
+    def remote_time(self):
+        """ Current time on the remote, in seconds since the epoch """
+        return remote_time(self._sftp.get_channel().get_transport())
+
+    def list_local(self, path=""):
+        return CompactFileTree(self.iter_local(path))
+
+    def iter_local(self, path=""):
+        """
+        Stream the local file tree
+
+        The tree is walked in-process, in `path_sort_key` order.
+        """
         path = os.path.join(self.local_dir, path)
-        return self._rsync_list(path, rsync_opts)
+        return walk_local(
+            path, self.ignore_paths, max_workers=self.local_walk_workers
+        )
 
     def mkdir_remote(self, path):
         self._sftp.mkdir(os.path.join(self.remote_dir, path))
@@ -97,7 +333,68 @@ class Synchronizer(object):
             os.path.join(self.remote_dir, dest_path),
         )
 
-    def _rsync(self, path_from, path_to, rsync_opts=None):
+    def move_remote(self, src_path, dest_path):
+        """
+        Move a file or directory on the remote, creating parent directories
+
+        Raises `FileExistsError` rather than replace `dest_path`.
+        """
+        src = os.path.join(self.remote_dir, src_path.rstrip("/"))
+        dest = os.path.join(self.remote_dir, dest_path.rstrip("/"))
+        logging.info("Moving remote {} to {}.".format(src, dest))
+        try:
+            self._sftp.lstat(dest)
+        except FileNotFoundError:
+            pass
+        else:
+            raise FileExistsError(errno.EEXIST, "File exists", dest)
+        self._makedirs_remote(os.path.dirname(dest))
+        self._sftp.rename(src, dest)
+
+    def move_local(self, src_path, dest_path):
+        """
+        Move a local file or directory, creating parent directories
+
+        Raises `FileExistsError` rather than replace `dest_path`.
+        """
+        src = os.path.join(self.local_dir, src_path.rstrip("/"))
+        dest = os.path.join(self.local_dir, dest_path.rstrip("/"))
+        logging.info("Moving local {} to {}.".format(src, dest))
+        if os.path.lexists(dest):
+            raise FileExistsError(errno.EEXIST, "File exists", dest)
+        os.makedirs(os.path.dirname(dest), exist_ok=True)
+        os.rename(src, dest)
+
+    def same_content(self, pairs):
+        """
+        Check whether pairs of local and remote files have the same content
+
+        `pairs` is a list of (local, remote) `FsObject`s. Returns a list
+        of booleans, one per pair.
+        """
+        local_digests = [
+            _sha1sum(os.path.join(self.local_dir, local.path))
+            for local, _ in pairs
+        ]
+        transport = self._sftp.get_channel().get_transport()
+        remote_digests = remote_sha1sums(
+            transport, self.remote_dir, [remote.path for _, remote in pairs]
+        )
+        return [
+            local_digest == remote_digest
+            for local_digest, remote_digest in zip(
+                local_digests, remote_digests
+            )
+        ]
+
+    def _makedirs_remote(self, directory):
+        try:
+            self._sftp.stat(directory)
+        except FileNotFoundError:
+            self._makedirs_remote(os.path.dirname(directory))
+            self._sftp.mkdir(directory)
+
+    def _rsync(self, path_from, path_to, rsync_opts=None, input=None):
         rsync_opts = [] if rsync_opts is None else rsync_opts
         ssh_cmd = self._get_ssh_cmd()
         exclude_list = self._get_exclude_list()
@@ -114,7 +411,7 @@ class Synchronizer(object):
             path_to,
         ]
 
-        process = _run_ssh_cmd(rsync_cmd)
+        process = _run_ssh_cmd(rsync_cmd, input=input)
         return process
 
     def _rsync_list(self, path, rsync_opts=None):
@@ -129,19 +426,18 @@ class Synchronizer(object):
             "--itemize-changes",
             "--dry-run",
             "--out-format",
-            "%i||%n||%M||%l",
+            LIST_OUT_FORMAT,
             *exclude_list,
             *rsync_opts,
             path,
             "/dev/false",
         ]
-        process = _run_ssh_cmd(rsync_cmd)
-        process_output = process.stdout.decode("utf-8")
-        fs_objects = self._parse_rsync_list_result(process_output)
-        return fs_objects
+        lines = _stream_ssh_cmd(rsync_cmd)
+        return parse_list_output(lines)
 
     def _get_ssh_cmd(self):
-        ssh_options = " ".join(SSH_OPTIONS)
+        self._ssh_master.ensure_running()
+        ssh_options = " ".join(SSH_OPTIONS + self._ssh_master.client_options())
         cmd = "ssh {} -p {} -i {}".format(
             ssh_options, self.port, self.key_file
         )
@@ -153,42 +449,68 @@ class Synchronizer(object):
             exclude_list.extend(["--exclude", _path])
         return exclude_list
 
-    def _parse_rsync_list_result(self, stdout):
-        fs_objects = []
-        for line in stdout.splitlines():
-            try:
-                changes, path, mtime_string, size_string = line.split("||")
-                try:
-                    is_directory = changes[1] == "d"
-                except IndexError:
-                    is_directory = False
-                mtime = datetime.strptime(mtime_string, "%Y/%m/%d-%H:%M:%S")
-                if is_directory:
-                    fs_object = FsObject(
-                        path, FsObjectType.DIRECTORY, DirectoryAttrs(mtime)
-                    )
-                else:
-                    size = int(size_string)
-                    fs_object = FsObject(
-                        path, FsObjectType.FILE, FileAttrs(mtime, size)
-                    )
-                fs_objects.append(fs_object)
-            except Exception as e:
-                logging.exception(
-                    "Failed to parse rsync output line {}".format(line)
-                )
-        return fs_objects
 
+def _join_path(directory, path):
+    """ Path relative to the local directory of `path` in `directory` """
+    if not directory:
+        return path
+    elif path == "./":
+        return directory + "/"
+    else:
+        return directory + "/" + path
+
+
+def _sha1sum(path):
+    digest = hashlib.sha1()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(65536), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
 
-def _run_ssh_cmd(argv):
+
+def _run_ssh_cmd(argv, input=None):
     """Run a command and print a message when a string is matched."""
     logging.info("Running command {}".format(argv))
     start_time = time.time()
     process = subprocess.run(
-        argv, stdout=subprocess.PIPE, stderr=subprocess.PIPE
+        argv, input=input, stdout=subprocess.PIPE, stderr=subprocess.PIPE
     )
     logging.info(
         "Command took {:.2f} seconds to run".format(time.time() - start_time)
     )
     process.check_returncode()
     return process
+
+
+def _stream_ssh_cmd(argv):
+    """
+    Run a command, yielding lines of its output as they arrive
+
+    Raises `subprocess.CalledProcessError` once the output is exhausted
+    if the command failed.
+    """
+    logging.info("Running command {}".format(argv))
+    start_time = time.time()
+    # Send stderr to a file, rather than a pipe, so that a command
+    # writing a lot to stderr cannot block while we read stdout.
+    with tempfile.TemporaryFile() as stderr:
+        process = subprocess.Popen(argv, stdout=subprocess.PIPE, stderr=stderr)
+        try:
+            for line in process.stdout:
+                yield line.decode("utf-8").rstrip("\n")
+        finally:
+            process.stdout.close()
+            if process.poll() is None:
+                # The caller stopped consuming output early
+                process.kill()
+            returncode = process.wait()
+        logging.info(
+            "Command took {:.2f} seconds to run".format(
+                time.time() - start_time
+            )
+        )
+        if returncode != 0:
+            stderr.seek(0)
+            raise subprocess.CalledProcessError(
+                returncode, argv, stderr=stderr.read()
+            )
@@ -0,0 +1,36 @@
+import os
+from datetime import datetime
+
+import pytest
+
+MTIME = datetime(2018, 1, 2, 3, 4, 5)
+
+
+def _write(path, content=""):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "w") as f:
+        f.write(content)
+
+
+def _set_mtimes(root):
+    timestamp = MTIME.timestamp()
+    for directory, dirnames, filenames in os.walk(root):
+        for name in dirnames + filenames:
+            os.utime(
+                os.path.join(directory, name),
+                (timestamp, timestamp),
+                follow_symlinks=False,
+            )
+    os.utime(root, (timestamp, timestamp))
+
+
+@pytest.fixture
+def tree(tmpdir):
+    root = str(tmpdir)
+    _write(os.path.join(root, "a.txt"), "hello")
+    _write(os.path.join(root, "a", "b.txt"), "hi")
+    _write(os.path.join(root, "a", "node_modules", "c.js"))
+    _write(os.path.join(root, "z", "d.pyc"))
+    os.symlink("a.txt", os.path.join(root, "link"))
+    _set_mtimes(root)
+    return root
@@ -0,0 +1,13 @@
+from unittest.mock import Mock
+
+import pytest
+
+from faculty_sync.screens.diff import DifferencesScreen
+
+
+@pytest.mark.parametrize("cached,refreshable", [(False, True), (True, False)])
+def test_only_checked_differences_can_be_refreshed(cached, refreshable):
+    screen = DifferencesScreen([], Mock(), cached=cached)
+    keys = [binding.keys for binding in screen.bindings.bindings]
+    screen.stop()
+    assert (("r",) in keys) == refreshable
@@ -0,0 +1,256 @@
+from datetime import datetime
+
+import pytest
+
+from faculty_sync.file_trees import (
+    DIGEST_SIZE,
+    CompactFileTree,
+    compare_file_trees,
+    compare_indexed_file_trees,
+    compare_sorted_file_trees,
+    find_moves,
+    index_file_tree,
+    sort_file_tree,
+)
+from faculty_sync.models import (
+    Difference,
+    DifferenceType,
+    DirectoryAttrs,
+    FileAttrs,
+    FsObject,
+    FsObjectType,
+)
+
+OLD = datetime(2018, 1, 1)
+NEW = datetime(2018, 6, 1)
+
+
+def _file(path, mtime=OLD, size=10):
+    return FsObject(path, FsObjectType.FILE, FileAttrs(mtime, size))
+
+
+def _directory(path, mtime=OLD):
+    return FsObject(path, FsObjectType.DIRECTORY, DirectoryAttrs(mtime))
+
+
+def test_sort_file_tree_orders_directory_contents_after_directory():
+    tree = [
+        _file("a.txt"),
+        _file("a/b"),
+        _directory("a/"),
+        _file("a-b"),
+        _directory("./"),
+    ]
+    assert [obj.path for obj in sort_file_tree(tree)] == [
+        "./",
+        "a/",
+        "a/b",
+        "a-b",
+        "a.txt",
+    ]
+
+
+def test_compare_file_trees():
+    left = [
+        _directory("./"),
+        _directory("dir/"),
+        _file("dir/same"),
+        _file("dir/changed", mtime=NEW),
+        _file("left-only"),
+    ]
+    right = [
+        _file("right-only"),
+        _file("dir/changed"),
+        _file("dir/same"),
+        _directory("dir/", mtime=NEW),
+        _directory("./"),
+    ]
+    differences = set(compare_file_trees(left, right))
+    assert differences == {
+        Difference(DifferenceType.LEFT_ONLY, _file("left-only"), None),
+        Difference(DifferenceType.RIGHT_ONLY, None, _file("right-only")),
+        Difference(
+            DifferenceType.ATTRS_DIFFERENT,
+            _file("dir/changed", mtime=NEW),
+            _file("dir/changed"),
+        ),
+    }
+
+
+def test_compare_file_trees_type_different():
+    left = [_file("a")]
+    right = [_directory("a")]
+    assert list(compare_file_trees(left, right)) == [
+        Difference(DifferenceType.TYPE_DIFFERENT, left[0], right[0])
+    ]
+
+
+def test_compare_sorted_file_trees_consumes_iterators():
+    left = iter([_file("a"), _file("c")])
+    right = iter([_file("b"), _file("c", size=20)])
+    assert list(compare_sorted_file_trees(left, right)) == [
+        Difference(DifferenceType.LEFT_ONLY, _file("a"), None),
+        Difference(DifferenceType.RIGHT_ONLY, None, _file("b")),
+        Difference(
+            DifferenceType.ATTRS_DIFFERENT, _file("c"), _file("c", size=20)
+        ),
+    ]
+
+
+def _tree(*fs_objects):
+    return sort_file_tree([_directory("./"), *fs_objects])
+
+
+def test_index_file_tree():
+    tree = index_file_tree(
+        _tree(_directory("a/"), _file("a/b"), _directory("a/c/"), _file("d"))
+    )
+    assert tree.subtree_ends == [5, 4, 3, 4, 5]
+    assert len(tree.digests[0]) == DIGEST_SIZE
+    assert tree.digests[2] is None
+
+
+def test_index_file_tree_digests_ignore_directory_mtimes():
+    left = index_file_tree(_tree(_directory("a/"), _file("a/b")))
+    right = index_file_tree(_tree(_directory("a/", mtime=NEW), _file("a/b")))
+    assert left.digests == right.digests
+
+
+@pytest.mark.parametrize(
+    "right",
+    [
+        _tree(_directory("a/"), _file("a/b", size=20)),
+        _tree(_directory("a/"), _file("a/b", mtime=NEW)),
+        _tree(_directory("a/"), _file("a/c")),
+        _tree(_directory("a/"), _file("a/\udcff")),
+        _tree(_directory("a/"), _directory("a/b/")),
+        _tree(_directory("a/")),
+    ],
+)
+def test_index_file_tree_digests_change(right):
+    left = index_file_tree(_tree(_directory("a/"), _file("a/b")))
+    right = index_file_tree(right)
+    assert left.digests[0] != right.digests[0]
+    assert left.digests[1] != right.digests[1]
+
+
+@pytest.mark.parametrize(
+    "left, right",
+    [
+        (
+            _tree(_directory("a/"), _directory("a/x/"), _file("a/x/y")),
+            _tree(_directory("a/"), _directory("a/x/"), _file("a/x/y")),
+        ),
+        (
+            _tree(
+                _directory("a/"), _file("a/b"), _directory("c/"), _file("c/d")
+            ),
+            _tree(
+                _directory("a/"),
+                _file("a/b", size=20),
+                _directory("c/"),
+                _file("c/d"),
+            ),
+        ),
+        (
+            _tree(_directory("a/"), _file("a/b"), _file("z")),
+            _tree(_directory("a/", mtime=NEW), _file("a/b"), _file("y")),
+        ),
+        (
+            _tree(_file("a"), _directory("b/"), _file("b/c")),
+            _tree(_directory("a/"), _file("a/x"), _directory("b/")),
+        ),
+    ],
+)
+def test_compare_indexed_file_trees(left, right):
+    assert list(
+        compare_indexed_file_trees(
+            index_file_tree(left), index_file_tree(right)
+        )
+    ) == list(compare_sorted_file_trees(left, right))
+
+
+def _differences(left, right):
+    return compare_sorted_file_trees(_tree(*left), _tree(*right))
+
+
+def test_find_moves_renamed_directory():
+    contents = [_file("x", size=1), _directory("y/"), _file("y/z", size=2)]
+    left = [_directory("new/")] + [
+        obj._replace(path="new/" + obj.path) for obj in contents
+    ]
+    right = [_directory("old/", mtime=NEW)] + [
+        obj._replace(path="old/" + obj.path) for obj in contents
+    ]
+    assert find_moves(_differences(left, right)) == [
+        Difference(DifferenceType.MOVED, left[0], right[0])
+    ]
+
+
+def test_find_moves_renamed_file():
+    left = [_directory("a/"), _file("a/new", size=1), _file("b", size=2)]
+    right = [_file("old", size=1), _file("c", size=3)]
+    assert find_moves(_differences(left, right)) == [
+        Difference(DifferenceType.LEFT_ONLY, _directory("a/"), None),
+        Difference(DifferenceType.MOVED, _file("a/new", size=1), right[0]),
+        Difference(DifferenceType.LEFT_ONLY, _file("b", size=2), None),
+        Difference(DifferenceType.RIGHT_ONLY, None, _file("c", size=3)),
+    ]
+
+
+@pytest.mark.parametrize(
+    "left, right",
+    [
+        # Ambiguous matches
+        ([_file("a"), _file("b")], [_file("c")]),
+        # Empty files
+        ([_file("a", size=0)], [_file("b", size=0)]),
+        # Empty directories
+        ([_directory("a/")], [_directory("b/")]),
+        # Different attributes
+        ([_file("a")], [_file("b", mtime=NEW)]),
+    ],
+)
+def test_find_moves_no_match(left, right):
+    differences = list(_differences(left, right))
+    assert find_moves(differences) == differences
+
+
+def test_find_moves_checks_content():
+    left = [_file("a"), _file("b", size=20)]
+    right = [_file("c"), _file("d", size=20)]
+    differences = find_moves(
+        _differences(left, right),
+        same_content=lambda pairs: [left.path == "a" for left, _ in pairs],
+    )
+    assert differences == [
+        Difference(DifferenceType.MOVED, _file("a"), _file("c")),
+        Difference(DifferenceType.LEFT_ONLY, _file("b", size=20), None),
+        Difference(DifferenceType.RIGHT_ONLY, None, _file("d", size=20)),
+    ]
+
+
+def test_compact_file_tree():
+    fs_objects = [
+        _file("a.txt"),
+        _directory("a/b/", mtime=NEW),
+        _file("a/b/c", size=2**40),
+        _directory("./"),
+        _file("a/b/d"),
+    ]
+    tree = CompactFileTree(fs_objects)
+    assert len(tree) == 5
+    assert list(tree) == fs_objects
+    assert tree[1] == fs_objects[1]
+    assert tree[-1] == fs_objects[-1]
+    assert tree[1:3] == fs_objects[1:3]
+    assert tree.path(2) == "a/b/c"
+    assert list(sort_file_tree(tree)) == sort_file_tree(fs_objects)
+
+
+def test_compare_file_trees_compact():
+    left = [_directory("./"), _file("a"), _file("b", size=20)]
+    right = [_directory("./"), _file("b"), _file("c")]
+    assert list(
+        compare_file_trees(CompactFileTree(left), CompactFileTree(right))
+    ) == list(compare_file_trees(left, right))
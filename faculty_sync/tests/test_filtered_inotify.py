@@ -0,0 +1,78 @@
+import os
+import sys
+from unittest.mock import patch
+
+import pytest
+
+pytestmark = pytest.mark.skipif(
+    not sys.platform.startswith("linux"),
+    reason="inotify is only available on Linux",
+)
+
+
+@pytest.fixture
+def inotify(tmpdir):
+    from faculty_sync.filtered_inotify import _FilteredInotify
+
+    for directory in ["src/pkg", "node_modules/lib", "src/__pycache__"]:
+        os.makedirs(os.path.join(str(tmpdir), directory))
+    inotify = _FilteredInotify(
+        os.fsencode(str(tmpdir)),
+        ["node_modules", "__pycache__"],
+        recursive=True,
+    )
+    yield inotify
+    inotify.close()
+
+
+def _watched_paths(inotify, root):
+    return sorted(
+        os.path.relpath(os.fsdecode(path), str(root))
+        for path in inotify._wd_for_path
+    )
+
+
+def test_ignored_directories_are_not_watched(inotify, tmpdir):
+    assert _watched_paths(inotify, tmpdir) == [".", "src", "src/pkg"]
+
+
+def test_ignored_directories_in_new_directories_are_not_watched(
+    inotify, tmpdir
+):
+    new_directory = os.path.join(str(tmpdir), "new")
+    os.makedirs(os.path.join(new_directory, "node_modules", "lib"))
+    open(os.path.join(new_directory, "node_modules", "lib", "a"), "w").close()
+    open(os.path.join(new_directory, "b"), "w").close()
+    events = inotify.read_events()
+    assert _watched_paths(inotify, tmpdir) == [
+        ".",
+        "new",
+        "src",
+        "src/pkg",
+    ]
+    created_paths = {
+        os.path.relpath(os.fsdecode(event.src_path), str(tmpdir))
+        for event in events
+        if event.is_create
+    }
+    assert "new/b" in created_paths
+
+
+def test_supported_by_installed_watchdog():
+    from faculty_sync.filtered_inotify import is_supported
+
+    assert is_supported()
+
+
+def test_falls_back_to_default_observer_on_other_watchdog_versions():
+    from watchdog.observers.inotify_c import Inotify
+
+    from faculty_sync.filtered_inotify import FilteredInotifyObserver
+    from faculty_sync.watch_sync import _observer
+
+    def _add_dir_watch(self, path, recursive, mask):
+        pass
+
+    assert isinstance(_observer([]), FilteredInotifyObserver)
+    with patch.object(Inotify, "_add_dir_watch", _add_dir_watch):
+        assert not isinstance(_observer([]), FilteredInotifyObserver)
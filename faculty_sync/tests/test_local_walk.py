@@ -0,0 +1,51 @@
+from unittest.mock import patch
+
+import pytest
+
+from faculty_sync import local_walk
+from faculty_sync.file_trees import sort_file_tree
+from faculty_sync.local_walk import walk_local
+from faculty_sync.models import (
+    DirectoryAttrs,
+    FileAttrs,
+    FsObject,
+    FsObjectType,
+)
+
+from .conftest import MTIME
+
+
+def _directory(path):
+    return FsObject(path, FsObjectType.DIRECTORY, DirectoryAttrs(MTIME))
+
+
+def _file(path, size):
+    return FsObject(path, FsObjectType.FILE, FileAttrs(MTIME, size))
+
+
+EXPECTED = [
+    _directory("./"),
+    _directory("a/"),
+    _file("a/b.txt", 2),
+    _file("a.txt", 5),
+    _file("link", 5),
+    _directory("z/"),
+]
+
+
+@pytest.mark.parametrize("max_workers", [None, 4])
+def test_walk_local(tree, max_workers):
+    fs_objects = list(
+        walk_local(tree, ["node_modules", "*.pyc"], max_workers=max_workers)
+    )
+    assert fs_objects == EXPECTED
+    assert fs_objects == sort_file_tree(fs_objects)
+
+
+def test_walk_local_does_not_descend_into_ignored_directories(tree):
+    with patch.object(
+        local_walk, "_scan_directory", wraps=local_walk._scan_directory
+    ) as scan_mock:
+        list(walk_local(tree, ["node_modules"]))
+    scanned = {call_args[0][1] for call_args in scan_mock.call_args_list}
+    assert scanned == {"", "a/", "z/"}
@@ -1,6 +1,6 @@
 import pytest
 
-from faculty_sync.path_match import matches
+from faculty_sync.path_match import PathMatcher, matches
 
 
 @pytest.mark.parametrize(
@@ -36,3 +36,52 @@ def test_should_match(path, pattern):
 )
 def test_should_not_match(path, pattern):
     assert not matches(path, pattern)
+
+
+@pytest.mark.parametrize(
+    "path,pattern,expected",
+    [
+        ("/hello/world.ipynb", "**/*.ipynb", True),
+        ("/world.ipynb", "**/*.ipynb", True),
+        ("/hello/world.py", "**/*.ipynb", False),
+        ("/hello/a/b/world", "/hello/**/world", True),
+        ("/hello/world", "/hello/**/world", True),
+        ("/bye/hello/world", "/hello/**/world", False),
+        ("/a/hello/b/world/c", "hello/**/world", True),
+        ("/hello/world", "/hello/**", True),
+        ("/hello", "/hello/**", True),
+    ],
+)
+def test_double_star(path, pattern, expected):
+    assert matches(path, pattern) == expected
+
+
+def test_path_matcher():
+    matcher = PathMatcher(["node_modules", "/docs/build/", "*.pkl"])
+    assert matcher.matches("node_modules")
+    assert matcher.matches("src/node_modules/lib/index.js")
+    assert matcher.matches("docs/build/")
+    assert matcher.matches("docs/build/index.html")
+    assert matcher.matches("data/a.pkl")
+    assert not matcher.matches("docs/source/index.rst")
+    assert not matcher.matches("src/build/index.html")
+    # Verdicts for directories are remembered
+    assert not matcher.matches("docs/source/conf.py")
+    assert matcher.matches("src/node_modules/lib/package.json")
+
+
+def test_path_matcher_with_directory_patterns():
+    matcher = PathMatcher(["dist/"])
+    assert matcher.matches("dist")
+    assert matcher.matches("dist/")
+    assert matcher.matches("dist/index.js", is_file=True)
+    assert not matcher.matches("dist", is_file=True)
+    assert not matcher.matches("src/dist", is_file=True)
+
+
+def test_path_matcher_without_patterns():
+    assert not PathMatcher([]).matches("hello/world")
+
+
+def test_path_matcher_with_root():
+    assert PathMatcher(["/"]).matches("hello/world")
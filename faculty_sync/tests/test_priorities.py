@@ -0,0 +1,43 @@
+from faculty_sync.models import ChangeEventType, FsChangeEvent
+from faculty_sync.priorities import (
+    PATTERN_BONUS,
+    RECENT_BONUS,
+    RECENT_PERIOD,
+    SIZE_PENALTY,
+    SMALL_FILE_SIZE,
+    EventPriorities,
+)
+
+
+def _event(path):
+    return FsChangeEvent(ChangeEventType.MODIFIED, False, path, None)
+
+
+def test_large_files_are_penalized():
+    priorities = EventPriorities("/nonexistent/")
+    assert priorities.priority(_event("small"), SMALL_FILE_SIZE, 100) == 100
+    large_priority = priorities.priority(
+        _event("large"), 4 * SMALL_FILE_SIZE, 100
+    )
+    assert large_priority == 100 + 2 * SIZE_PENALTY
+
+
+def test_recently_changed_paths_get_a_bonus():
+    priorities = EventPriorities("/nonexistent/")
+    assert priorities.priority(_event("a"), 0, 100) == 100
+    assert priorities.priority(_event("a"), 0, 110) == 110 - RECENT_BONUS
+    later = 110 + RECENT_PERIOD
+    assert priorities.priority(_event("a"), 0, later) == later
+
+
+def test_high_priority_patterns_get_a_bonus():
+    priorities = EventPriorities("/nonexistent/", ["*.py"])
+    assert priorities.priority(_event("src/a.py"), 0, 100) == (
+        100 - PATTERN_BONUS
+    )
+    assert priorities.priority(_event("data.csv"), 0, 100) == 100
+
+
+def test_size_of_missing_file():
+    priorities = EventPriorities("/nonexistent/")
+    assert priorities.size(_event("missing")) == 0
@@ -0,0 +1,87 @@
+from datetime import datetime
+from unittest.mock import Mock, patch
+
+import paramiko
+import pytest
+
+from faculty_sync.remote_metadata import RemoteMetadataCache
+
+MTIME = 1514862245
+
+
+def _attributes(filename):
+    attrs = paramiko.SFTPAttributes()
+    attrs.filename = filename
+    attrs.st_mtime = MTIME
+    return attrs
+
+
+@pytest.fixture
+def sftp():
+    sftp = Mock()
+    sftp.listdir_attr.return_value = [_attributes("a"), _attributes("b")]
+    with patch.object(
+        paramiko.SFTPClient, "from_transport", return_value=sftp
+    ):
+        yield sftp
+
+
+def test_lookups_in_one_directory_share_a_listing(sftp):
+    cache = RemoteMetadataCache(Mock(), "/remote/", max_age=60)
+    assert cache.get_mtime("dir/a") == datetime.fromtimestamp(MTIME)
+    assert cache.get_mtime("dir/b") == datetime.fromtimestamp(MTIME)
+    assert cache.get_mtime("dir/missing") is None
+    sftp.listdir_attr.assert_called_once_with("/remote/dir")
+    assert cache.stats().lookups == 3
+    assert cache.stats().listings == 1
+
+
+def test_expired_listings_are_refreshed(sftp):
+    cache = RemoteMetadataCache(Mock(), "/remote/", max_age=0)
+    cache.get_mtime("a")
+    cache.get_mtime("b")
+    assert sftp.listdir_attr.call_count == 2
+
+
+def test_refresh(sftp):
+    cache = RemoteMetadataCache(Mock(), "/remote/", max_age=60)
+    cache.get_mtime("a")
+    cache.refresh(["a", "b", "dir/c"])
+    assert sftp.listdir_attr.call_count == 3
+
+
+def test_missing_directory(sftp):
+    sftp.listdir_attr.side_effect = FileNotFoundError
+    cache = RemoteMetadataCache(Mock(), "/remote/")
+    assert cache.get_mtime("dir/a") is None
+
+
+def test_update(sftp):
+    cache = RemoteMetadataCache(Mock(), "/remote/", max_age=60)
+    cache.get_mtime("dir/a")
+    cache.update("dir/a", datetime(2019, 1, 1))
+    cache.update("other/b", datetime(2019, 1, 1))
+    assert cache.get_mtime("dir/a") == datetime(2019, 1, 1)
+    assert sftp.listdir_attr.call_count == 1
+
+
+def test_only_directories_of_pending_paths_are_refreshed(sftp):
+    cache = RemoteMetadataCache(Mock(), "/remote/", max_age=60)
+    cache.get_mtime("looked-up/a")
+    cache.set_pending_paths(lambda: ["pending/a", "pending/b", "c"])
+    cache._refresh_pending_directories()
+    listed = [call[0][0] for call in sftp.listdir_attr.call_args_list]
+    assert sorted(listed) == [
+        "/remote/",
+        "/remote/looked-up",
+        "/remote/pending",
+    ]
+    cache._refresh_pending_directories()
+    assert sftp.listdir_attr.call_count == 3
+
+
+def test_nothing_is_refreshed_without_pending_paths(sftp):
+    cache = RemoteMetadataCache(Mock(), "/remote/", max_age=0)
+    cache.get_mtime("dir/a")
+    cache._refresh_pending_directories()
+    assert sftp.listdir_attr.call_count == 1
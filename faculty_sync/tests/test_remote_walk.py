@@ -0,0 +1,183 @@
+import hashlib
+import os
+import subprocess
+import time
+from unittest.mock import patch
+
+import paramiko
+import pytest
+
+from faculty_sync import remote_walk
+from faculty_sync.file_trees import sort_file_tree
+from faculty_sync.local_walk import walk_local
+from faculty_sync.remote_walk import (
+    remote_sha1sums,
+    remote_time,
+    walk_remote_exec,
+    walk_remote_exec_changed_files,
+    walk_remote_exec_incremental,
+    walk_remote_sftp,
+)
+
+from .conftest import _write
+
+
+class LocalChannel(object):
+    """ Stand-in for a paramiko channel, running commands locally """
+
+    def __init__(self):
+        self._process = None
+
+    def exec_command(self, command):
+        self._process = subprocess.Popen(
+            command,
+            shell=True,
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+        )
+
+    def sendall(self, data):
+        self._process.stdin.write(data)
+
+    def shutdown_write(self):
+        self._process.stdin.close()
+
+    def recv(self, nbytes):
+        return self._process.stdout.read1(nbytes)
+
+    def recv_stderr_ready(self):
+        return False
+
+    def recv_exit_status(self):
+        return self._process.wait()
+
+    def close(self):
+        if not self._process.stdin.closed:
+            self._process.stdin.close()
+        self._process.stdout.close()
+        self._process.wait()
+
+
+class LocalTransport(object):
+    def open_session(self):
+        return LocalChannel()
+
+
+@pytest.mark.parametrize(
+    "ignore_paths",
+    [
+        [],
+        ["node_modules", "*.pyc"],
+        ["/a/node_modules", "a/b.txt"],
+        ["a.txt/", "link/", "z/"],
+    ],
+)
+def test_walk_remote_exec_matches_local_walk(tree, ignore_paths):
+    fs_objects = walk_remote_exec(LocalTransport(), tree, ignore_paths)
+    assert sort_file_tree(fs_objects) == list(walk_local(tree, ignore_paths))
+
+
+def test_walk_remote_exec_missing_directory(tmpdir):
+    with pytest.raises(subprocess.CalledProcessError):
+        list(walk_remote_exec(LocalTransport(), str(tmpdir / "x"), []))
+
+
+def test_walk_remote_exec_incremental(tree):
+    ignore_paths = ["node_modules"]
+    previous_tree = sort_file_tree(
+        walk_remote_exec(LocalTransport(), tree, ignore_paths)
+    )
+    # Make sure nothing in the tree changed in the second of `since`
+    time.sleep(1.1)
+    since = remote_time(LocalTransport())
+
+    # Files in unchanged directories should be taken from the previous
+    # tree. Tamper with one to check that it is.
+    previous_tree = _tamper_with_size(previous_tree, "z/d.pyc")
+    _write(os.path.join(tree, "a.txt"), "modified in place")
+    _write(os.path.join(tree, "a", "new.txt"))
+    os.remove(os.path.join(tree, "a", "b.txt"))
+    _write(os.path.join(tree, "y", "e.txt"))
+
+    fs_objects = walk_remote_exec_incremental(
+        LocalTransport(), tree, ignore_paths, previous_tree, since
+    )
+
+    expected = _tamper_with_size(walk_local(tree, ignore_paths), "z/d.pyc")
+    assert sort_file_tree(fs_objects) == expected
+
+
+def _tamper_with_size(fs_objects, path):
+    return [
+        fs_object._replace(attrs=fs_object.attrs._replace(size=42))
+        if fs_object.path == path
+        else fs_object
+        for fs_object in fs_objects
+    ]
+
+
+def test_walk_remote_exec_changed_files(tree):
+    time.sleep(1.1)
+    since = remote_time(LocalTransport())
+    _write(os.path.join(tree, "a.txt"), "modified in place")
+    _write(os.path.join(tree, "a", "new.txt"))
+    os.remove(os.path.join(tree, "a", "b.txt"))
+
+    fs_objects = walk_remote_exec_changed_files(
+        LocalTransport(), tree, [], since
+    )
+
+    assert sorted(fs_object.path for fs_object in fs_objects) == [
+        "a.txt",
+        "a/new.txt",
+    ]
+
+
+def test_supports_exec_walk():
+    assert remote_walk.supports_exec_walk(LocalTransport())
+
+
+def test_does_not_support_exec_walk_without_gnu_find():
+    error = subprocess.CalledProcessError(1, "find")
+    with patch.object(remote_walk, "_run_remote_command", side_effect=error):
+        assert not remote_walk.supports_exec_walk(LocalTransport())
+
+
+def test_remote_sha1sums(tree):
+    digests = remote_sha1sums(LocalTransport(), tree, ["a/b.txt", "a.txt"])
+    assert digests == [
+        hashlib.sha1(b"hi").hexdigest(),
+        hashlib.sha1(b"hello").hexdigest(),
+    ]
+
+
+class LocalSftp(object):
+    """ Stand-in for a paramiko SFTP client, reading the local disk """
+
+    def stat(self, path):
+        return paramiko.SFTPAttributes.from_stat(os.stat(path))
+
+    def listdir_attr(self, path):
+        return [
+            paramiko.SFTPAttributes.from_stat(
+                os.lstat(os.path.join(path, filename)), filename
+            )
+            for filename in os.listdir(path)
+        ]
+
+    def close(self):
+        pass
+
+
+@pytest.mark.parametrize("concurrency", [1, 4])
+@pytest.mark.parametrize(
+    "ignore_paths",
+    [[], ["node_modules", "*.pyc"], ["/a/node_modules"], ["a.txt/", "z/"]],
+)
+def test_walk_remote_sftp_matches_local_walk(tree, ignore_paths, concurrency):
+    with patch.object(remote_walk, "_open_sftp", return_value=LocalSftp()):
+        fs_objects = list(
+            walk_remote_sftp(None, tree, ignore_paths, concurrency)
+        )
+    assert sort_file_tree(fs_objects) == list(walk_local(tree, ignore_paths))
@@ -0,0 +1,79 @@
+from datetime import datetime
+
+import pytest
+
+from faculty_sync.models import (
+    DirectoryAttrs,
+    FileAttrs,
+    FsObject,
+    FsObjectType,
+)
+from faculty_sync.rsync_output import parse_list_output, parse_mtime
+
+
+@pytest.mark.parametrize(
+    "mtime_string,expected",
+    [
+        ("2018/01/02-03:04:05", datetime(2018, 1, 2, 3, 4, 5)),
+        ("1999/12/31-23:59:59", datetime(1999, 12, 31, 23, 59, 59)),
+    ],
+)
+def test_parse_mtime(mtime_string, expected):
+    assert parse_mtime(mtime_string) == expected
+    assert parse_mtime(mtime_string) == expected  # cached
+
+
+@pytest.mark.parametrize(
+    "mtime_string",
+    ["2018/01/02 03:04:05", "2018/1/2-03:04:05", "2018/13/02-03:04:05"],
+)
+def test_parse_invalid_mtime(mtime_string):
+    with pytest.raises(ValueError):
+        parse_mtime(mtime_string)
+
+
+def test_parse_list_output():
+    lines = [
+        "cd+++++++++||./||2018/01/02-03:04:05||4096",
+        ">f+++++++++||dir/file.txt||2018/01/02-03:04:06||123",
+        "cL+++++++++||link||2018/01/02-03:04:07||6",
+        ">f+++++++++||with||separator||2018/01/02-03:04:08||1",
+        "not an rsync line",
+    ]
+    assert list(parse_list_output(lines)) == [
+        FsObject(
+            "./",
+            FsObjectType.DIRECTORY,
+            DirectoryAttrs(datetime(2018, 1, 2, 3, 4, 5)),
+        ),
+        FsObject(
+            "dir/file.txt",
+            FsObjectType.FILE,
+            FileAttrs(datetime(2018, 1, 2, 3, 4, 6), 123),
+        ),
+        FsObject(
+            "link",
+            FsObjectType.FILE,
+            FileAttrs(datetime(2018, 1, 2, 3, 4, 7), 6),
+        ),
+        FsObject(
+            "with||separator",
+            FsObjectType.FILE,
+            FileAttrs(datetime(2018, 1, 2, 3, 4, 8), 1),
+        ),
+    ]
+
+
+def test_parse_list_output_with_deletions():
+    lines = [
+        "*deleting  ||dir/||2018/01/02-03:04:05||4096",
+        "*deleting  ||old.txt||2018/01/02-03:04:05||12",
+        ">f.st......||new.txt||2018/01/02-03:04:06||123",
+    ]
+    assert list(parse_list_output(lines)) == [
+        FsObject(
+            "new.txt",
+            FsObjectType.FILE,
+            FileAttrs(datetime(2018, 1, 2, 3, 4, 6), 123),
+        )
+    ]
@@ -0,0 +1,26 @@
+import os
+from unittest.mock import patch
+
+from faculty_sync import snapshots
+from faculty_sync.local_walk import walk_local
+from faculty_sync.snapshots import Snapshot, SnapshotStore
+
+
+def test_snapshot_round_trip(tree, tmpdir):
+    fs_objects = list(walk_local(tree, []))
+    snapshot = Snapshot(fs_objects, fs_objects[:2], 1514862245)
+    with patch.object(snapshots, "SNAPSHOT_DIRECTORY", str(tmpdir / "s")):
+        store = SnapshotStore("project", "server", tree, "/project/", ["a"])
+        assert store.load() is None
+        store.save(snapshot)
+        loaded = store.load()
+        assert list(loaded.local_tree) == snapshot.local_tree
+        assert list(loaded.remote_tree) == snapshot.remote_tree
+        assert loaded.remote_time == snapshot.remote_time
+        other_store = SnapshotStore(
+            "project", "server", tree, "/other/", ["a"]
+        )
+        assert other_store.load() is None
+        other_store = SnapshotStore("project", "server", tree, "/project/", [])
+        assert other_store.load() is None
+        assert os.listdir(str(tmpdir / "s")) == [os.path.basename(store._path)]
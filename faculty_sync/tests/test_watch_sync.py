@@ -0,0 +1,696 @@
+import os
+import queue
+import threading
+import time
+from datetime import datetime
+from unittest.mock import Mock, call, patch
+
+import paramiko
+import pytest
+
+from faculty_sync.models import (
+    ChangeEventType,
+    FileAttrs,
+    FsChangeEvent,
+    FsObject,
+    FsObjectType,
+)
+from faculty_sync.priorities import EventPriorities
+from faculty_sync.pubsub import Messages
+from faculty_sync.watch_sync import (
+    BURST_QUEUE_DEPTH,
+    MAX_RETRIES,
+    EchoRegistry,
+    EventCoalescer,
+    HeldFilesMonitor,
+    RemotePoller,
+    Uploader,
+    WatcherSynchronizer,
+    _collapse_directories,
+    _subtree_event,
+    watch_sync_state_from_trees,
+)
+
+
+def _event(event_type, path, is_directory=False, extra_args=None):
+    return FsChangeEvent(event_type, is_directory, path, extra_args)
+
+
+class DeferredExecutor(object):
+    """ Stand-in for a thread pool, running tasks when asked to """
+
+    def __init__(self):
+        self.tasks = []
+
+    def submit(self, fn, *args):
+        self.tasks.append((fn, args))
+
+    def run_all(self):
+        while self.tasks:
+            fn, args = self.tasks.pop(0)
+            fn(*args)
+
+
+def _uploader():
+    synchronizer = Mock(local_dir="/nonexistent/")
+    monitor = Mock()
+    monitor.should_sync.return_value = True
+    uploader = Uploader(Mock(), synchronizer, monitor, Mock())
+    uploader._executor = DeferredExecutor()
+    return uploader, synchronizer, monitor
+
+
+def _handle_events(uploader, events):
+    uploader._handle_events(events)
+    uploader._executor.run_all()
+
+
+def _submitted_events(uploader):
+    return [
+        [pending_event.fs_event for pending_event in pending_events]
+        for _, (pending_events,) in uploader._executor.tasks
+    ]
+
+
+def _retry_now(uploader):
+    uploader._waiting = [
+        pending_event._replace(not_before=0)
+        for pending_event in uploader._waiting
+    ]
+    uploader._dispatch()
+    uploader._executor.run_all()
+
+
+def test_consecutive_uploads_are_batched():
+    uploader, synchronizer, monitor = _uploader()
+    events = [
+        _event(ChangeEventType.CREATED, "a"),
+        _event(ChangeEventType.MODIFIED, "b"),
+        _event(ChangeEventType.MODIFIED, "a"),
+    ]
+    _handle_events(uploader, events)
+    synchronizer.up_files.assert_called_once_with(["a", "b"])
+    monitor.have_synced.assert_called_once_with(
+        [events[0], events[2], events[1]], synchronizer.up_files.return_value
+    )
+
+
+def test_events_for_other_paths_go_ahead():
+    uploader, synchronizer, monitor = _uploader()
+    events = [
+        _event(ChangeEventType.MODIFIED, "a"),
+        _event(ChangeEventType.DELETED, "b"),
+        _event(ChangeEventType.MODIFIED, "c"),
+    ]
+    _handle_events(uploader, events)
+    assert synchronizer.mock_calls == [
+        call.up_files(["a", "c"]),
+        call.rmfile_remote("b"),
+    ]
+
+
+def test_overlapping_events_are_ordered():
+    uploader, synchronizer, monitor = _uploader()
+    events = [
+        _event(ChangeEventType.MODIFIED, "large"),
+        _event(ChangeEventType.DELETED, "dir", is_directory=True),
+        _event(ChangeEventType.CREATED, "dir/a"),
+        _event(ChangeEventType.MODIFIED, "small"),
+    ]
+    uploader._handle_events(events)
+    # The upload into `dir` waits for the deletion of `dir`
+    assert _submitted_events(uploader) == [
+        [events[0], events[3]],
+        [events[1]],
+    ]
+    uploader._executor.run_all()
+    assert synchronizer.mock_calls == [
+        call.up_files(["large", "small"]),
+        call.rmdir_remote("dir"),
+        call.up_files(["dir/a"]),
+    ]
+
+
+def test_small_files_overtake_large_files(tmpdir):
+    uploader, synchronizer, monitor = _uploader()
+    uploader._workers = 1
+    uploader._priorities = EventPriorities(str(tmpdir))
+    for name, size in [("large", 10 * 1024 * 1024), ("small", 10)]:
+        with open(os.path.join(str(tmpdir), name), "wb") as f:
+            f.truncate(size)
+    busy = _event(ChangeEventType.DELETED, "busy")
+    uploader._handle_events([busy])
+    large = _event(ChangeEventType.MODIFIED, "large")
+    small = _event(ChangeEventType.MODIFIED, "small")
+    uploader._handle_events([large, small])
+    # Only one worker is available
+    assert _submitted_events(uploader) == [[busy]]
+    uploader._executor.run_all()
+    assert synchronizer.mock_calls == [
+        call.rmfile_remote("busy"),
+        call.up_files(["small"]),
+        call.up_files(["large"]),
+    ]
+
+
+def test_pending_paths_are_those_of_waiting_events():
+    uploader, synchronizer, monitor = _uploader()
+    uploader._workers = 1
+    uploader._handle_events([_event(ChangeEventType.DELETED, "busy")])
+    uploader._handle_events(
+        [
+            _event(ChangeEventType.MODIFIED, "a"),
+            _event(
+                ChangeEventType.MOVED, "dir/b", extra_args={"dest_path": "c"}
+            ),
+        ]
+    )
+    assert uploader.pending_paths() == ["a", "dir/b", "c"]
+    uploader._executor.run_all()
+    assert uploader.pending_paths() == []
+
+
+def test_held_files_are_not_uploaded():
+    uploader, synchronizer, monitor = _uploader()
+    monitor.should_sync.side_effect = lambda event: event.path != "held"
+    events = [
+        _event(ChangeEventType.MODIFIED, "a"),
+        _event(ChangeEventType.MODIFIED, "held"),
+    ]
+    _handle_events(uploader, events)
+    synchronizer.up_files.assert_called_once_with(["a"])
+    monitor.have_synced.assert_called_once_with(
+        [events[0]], synchronizer.up_files.return_value
+    )
+
+
+def test_failed_events_are_retried():
+    uploader, synchronizer, monitor = _uploader()
+    synchronizer.up_files.side_effect = [IOError, []]
+    event = _event(ChangeEventType.MODIFIED, "a")
+    _handle_events(uploader, [event])
+    # Events for the same path wait for the retry
+    later_event = _event(ChangeEventType.MODIFIED, "a")
+    _handle_events(uploader, [later_event])
+    assert synchronizer.up_files.call_count == 1
+    _retry_now(uploader)
+    assert synchronizer.up_files.call_count == 2
+    monitor.have_synced.assert_called_once_with([event, later_event], [])
+    assert uploader._failed_attempts == {}
+
+
+def test_directory_is_synced_when_retries_are_exhausted(tmpdir):
+    uploader, synchronizer, monitor = _uploader()
+    os.makedirs(os.path.join(str(tmpdir), "dir"))
+    synchronizer.local_dir = str(tmpdir)
+    synchronizer.up_files.side_effect = IOError
+    monitor.held_paths.return_value = frozenset(["dir/held", "other"])
+    event = _event(ChangeEventType.MODIFIED, "dir/a")
+    _handle_events(uploader, [event])
+    for _ in range(MAX_RETRIES):
+        _retry_now(uploader)
+    synchronizer.up_directory.assert_called_once_with(
+        "dir", ["--exclude=/held"]
+    )
+    monitor.have_synced.assert_called_once_with(
+        [event], synchronizer.up_directory.return_value
+    )
+
+
+def test_directory_is_synced_once_for_a_failed_batch(tmpdir):
+    uploader, synchronizer, monitor = _uploader()
+    os.makedirs(os.path.join(str(tmpdir), "dir"))
+    synchronizer.local_dir = str(tmpdir)
+    synchronizer.up_files.side_effect = IOError
+    monitor.held_paths.return_value = frozenset()
+    events = [
+        _event(ChangeEventType.MODIFIED, "dir/a"),
+        _event(ChangeEventType.MODIFIED, "dir/b"),
+    ]
+    _handle_events(uploader, events)
+    for _ in range(MAX_RETRIES):
+        _retry_now(uploader)
+    synchronizer.up_directory.assert_called_once_with("dir", [])
+    monitor.have_synced.assert_called_once_with(
+        events, synchronizer.up_directory.return_value
+    )
+
+
+def test_events_are_retried_when_checking_the_remote_fails():
+    uploader, synchronizer, monitor = _uploader()
+    monitor.should_sync.side_effect = [IOError, True]
+    synchronizer.up_files.return_value = []
+    event = _event(ChangeEventType.MODIFIED, "a")
+    _handle_events(uploader, [event])
+    synchronizer.up_files.assert_not_called()
+    _retry_now(uploader)
+    synchronizer.up_files.assert_called_once_with(["a"])
+
+
+def test_events_fail_when_directory_sync_fails(tmpdir):
+    uploader, synchronizer, monitor = _uploader()
+    os.makedirs(os.path.join(str(tmpdir), "dir"))
+    synchronizer.local_dir = str(tmpdir)
+    synchronizer.up_files.side_effect = IOError
+    synchronizer.up_directory.side_effect = IOError
+    monitor.held_paths.return_value = frozenset()
+    event = _event(ChangeEventType.MODIFIED, "dir/a")
+    _handle_events(uploader, [event])
+    for _ in range(MAX_RETRIES):
+        _retry_now(uploader)
+    synchronizer.up_directory.assert_called_once_with("dir", [])
+    uploader._exchange.publish.assert_called_with(
+        Messages.FAILED_FS_EVENTS_CHANGED, [event]
+    )
+    uploader.retry_failed()
+    assert uploader._queue.put.call_args_list == [call(event)]
+
+
+@pytest.mark.parametrize(
+    "event",
+    [
+        _event(ChangeEventType.MODIFIED, "a"),
+        _event(ChangeEventType.MODIFIED, "missing/a"),
+        _event(ChangeEventType.MOVED, "dir/a", extra_args={"dest_path": "b"}),
+    ],
+)
+def test_events_fail_when_parent_cannot_be_synced(tmpdir, event):
+    uploader, synchronizer, monitor = _uploader()
+    os.makedirs(os.path.join(str(tmpdir), "dir"))
+    synchronizer.local_dir = str(tmpdir)
+    synchronizer.up_files.side_effect = IOError
+    synchronizer.mvfile_remote.side_effect = IOError
+    _handle_events(uploader, [event])
+    for _ in range(MAX_RETRIES):
+        _retry_now(uploader)
+    synchronizer.up_directory.assert_not_called()
+    uploader._exchange.publish.assert_called_with(
+        Messages.FAILED_FS_EVENTS_CHANGED, [event]
+    )
+
+
+def test_directory_resync_waits_for_events_below_it(tmpdir):
+    uploader, synchronizer, monitor = _uploader()
+    os.makedirs(os.path.join(str(tmpdir), "dir"))
+    synchronizer.local_dir = str(tmpdir)
+    synchronizer.up_files.side_effect = IOError
+    synchronizer.up_directory.return_value = []
+    monitor.held_paths.return_value = frozenset()
+    event = _event(ChangeEventType.MODIFIED, "dir/a")
+    _handle_events(uploader, [event])
+    for _ in range(MAX_RETRIES - 1):
+        _retry_now(uploader)
+    # Fail the last retry, without running the resync it queues
+    uploader._waiting = [
+        pending_event._replace(not_before=0)
+        for pending_event in uploader._waiting
+    ]
+    uploader._dispatch()
+    fn, args = uploader._executor.tasks.pop(0)
+    fn(*args)
+    (resync,) = _submitted_events(uploader)
+    assert resync[0].path == "dir/"
+    later_event = _event(ChangeEventType.DELETED, "dir/b")
+    uploader._handle_events([later_event])
+    assert _submitted_events(uploader) == [resync]
+    uploader._executor.run_all()
+    assert synchronizer.mock_calls[-2:] == [
+        call.up_directory("dir", []),
+        call.rmfile_remote("dir/b"),
+    ]
+
+
+def test_duplicate_events_use_one_attempt():
+    uploader, synchronizer, monitor = _uploader()
+    synchronizer.up_files.side_effect = [IOError, []]
+    events = [
+        _event(ChangeEventType.MODIFIED, "a"),
+        _event(ChangeEventType.MODIFIED, "a"),
+    ]
+    _handle_events(uploader, events)
+    assert uploader._failed_attempts == {"a": 1}
+    _retry_now(uploader)
+    synchronizer.up_files.assert_called_with(["a"])
+    assert uploader._failed_attempts == {}
+
+
+def test_held_paths_are_excluded_literally():
+    uploader, synchronizer, monitor = _uploader()
+    synchronizer.up_directory.return_value = []
+    monitor.held_paths.return_value = frozenset(
+        ["dir/a[1].txt", "dir/b*", "dir/c d", "other"]
+    )
+    event = _subtree_event("dir", [_event(ChangeEventType.MODIFIED, "dir/e")])
+    _handle_events(uploader, [event])
+    assert synchronizer.up_directory.call_args_list == [
+        call(
+            "dir",
+            ["--exclude=/a\\[1].txt", "--exclude=/b\\*", "--exclude=/c d"],
+        )
+    ]
+    assert monitor.mock_calls[0] == call.hold_remote_changes("dir")
+
+
+def test_bursts_are_synced_by_subtree(tmpdir):
+    uploader, synchronizer, monitor = _uploader()
+    for directory in ["a/x", "a/y", "b"]:
+        os.makedirs(os.path.join(str(tmpdir), directory))
+    synchronizer.local_dir = str(tmpdir)
+    synchronizer.up_directory.return_value = []
+    monitor.held_paths.return_value = frozenset(["a/x/held"])
+    events = [
+        _event(ChangeEventType.MODIFIED, "{}/{}".format(directory, index))
+        for index in range(BURST_QUEUE_DEPTH // 2 + 1)
+        for directory in ["a/x", "a/y", "b"]
+    ]
+    with patch("faculty_sync.watch_sync.MAX_BURST_SUBTREES", 2):
+        _handle_events(uploader, events)
+    assert synchronizer.up_directory.call_args_list == [
+        call("a", ["--exclude=/x/held"]),
+        call("b", []),
+    ]
+    synchronizer.up_files.assert_not_called()
+    synced_events = [
+        fs_event
+        for (fs_events, _), _ in monitor.have_synced.call_args_list
+        for fs_event in fs_events
+    ]
+    assert sorted(synced_events) == sorted(events)
+    # Once the burst is over, events are handled one by one again
+    uploader._arrival_times.clear()
+    _handle_events(uploader, [_event(ChangeEventType.MODIFIED, "b/c")])
+    synchronizer.up_files.assert_called_once_with(["b/c"])
+
+
+@pytest.mark.parametrize(
+    "directories,max_subtrees,expected",
+    [
+        ({"a/b", "a/c", "d"}, 3, ["a/b", "a/c", "d"]),
+        ({"a/b", "a/c", "d"}, 2, ["a", "d"]),
+        ({"a/b", "a/c", "d"}, 1, [""]),
+        ({"a", "a/b/c", "d/e"}, 2, ["a", "d/e"]),
+        ({"", "a/b"}, 8, [""]),
+    ],
+)
+def test_collapse_directories(directories, max_subtrees, expected):
+    assert _collapse_directories(directories, max_subtrees) == expected
+
+
+def _coalesce(events):
+    output = queue.Queue()
+    coalescer = EventCoalescer(output)
+    for event in events:
+        coalescer.put(event)
+    coalescer.flush()
+    return list(output.queue)
+
+
+def _move(src_path, dest_path, is_directory=False):
+    return _event(
+        ChangeEventType.MOVED,
+        src_path,
+        is_directory=is_directory,
+        extra_args={"dest_path": dest_path},
+    )
+
+
+@pytest.mark.parametrize(
+    "events,expected",
+    [
+        (
+            [
+                _event(ChangeEventType.CREATED, "a"),
+                _event(ChangeEventType.MODIFIED, "a"),
+                _event(ChangeEventType.MODIFIED, "a"),
+            ],
+            [_event(ChangeEventType.CREATED, "a")],
+        ),
+        (
+            [
+                _event(ChangeEventType.CREATED, "a"),
+                _event(ChangeEventType.DELETED, "a"),
+            ],
+            [],
+        ),
+        (
+            [
+                _event(ChangeEventType.MODIFIED, "a"),
+                _event(ChangeEventType.DELETED, "a"),
+            ],
+            [_event(ChangeEventType.DELETED, "a")],
+        ),
+        (
+            [
+                _event(ChangeEventType.DELETED, "a"),
+                _event(ChangeEventType.CREATED, "a"),
+            ],
+            [_event(ChangeEventType.MODIFIED, "a")],
+        ),
+        (
+            # Editor writing to a temporary file, then renaming it
+            [
+                _event(ChangeEventType.CREATED, "a.tmp"),
+                _event(ChangeEventType.MODIFIED, "a.tmp"),
+                _move("a.tmp", "a"),
+            ],
+            [_event(ChangeEventType.CREATED, "a")],
+        ),
+        (
+            [_move("a", "b"), _move("b", "c")],
+            [_move("a", "c")],
+        ),
+        ([_move("a", "b"), _move("b", "a")], []),
+        (
+            [_move("a", "b"), _event(ChangeEventType.DELETED, "b")],
+            [_event(ChangeEventType.DELETED, "a")],
+        ),
+        (
+            [_move("a", "b"), _event(ChangeEventType.MODIFIED, "b")],
+            [_move("a", "b"), _event(ChangeEventType.MODIFIED, "b")],
+        ),
+        (
+            [_move("a", "b"), _event(ChangeEventType.CREATED, "a")],
+            [_move("a", "b"), _event(ChangeEventType.CREATED, "a")],
+        ),
+        (
+            [_move("a", "c"), _move("b", "c")],
+            [_event(ChangeEventType.DELETED, "a"), _move("b", "c")],
+        ),
+        (
+            [_event(ChangeEventType.DELETED, "c"), _move("b", "c")],
+            [_event(ChangeEventType.DELETED, "c"), _move("b", "c")],
+        ),
+        (
+            [_event(ChangeEventType.MODIFIED, "c"), _move("b", "c")],
+            [_event(ChangeEventType.DELETED, "c"), _move("b", "c")],
+        ),
+        (
+            [_event(ChangeEventType.CREATED, "c"), _move("b", "c")],
+            [_move("b", "c")],
+        ),
+        (
+            [
+                _event(ChangeEventType.MODIFIED, "a"),
+                _event(ChangeEventType.CREATED, "d", is_directory=True),
+                _event(ChangeEventType.MODIFIED, "a"),
+            ],
+            [
+                _event(ChangeEventType.MODIFIED, "a"),
+                _event(ChangeEventType.CREATED, "d", is_directory=True),
+                _event(ChangeEventType.MODIFIED, "a"),
+            ],
+        ),
+    ],
+)
+def test_coalesce_events(events, expected):
+    assert _coalesce(events) == expected
+
+
+def test_coalescer_waits_for_quiet_period():
+    output = queue.Queue()
+    coalescer = EventCoalescer(output, quiet_period=10)
+    coalescer.put(_event(ChangeEventType.MODIFIED, "a"))
+    coalescer._flush_ready(time.monotonic())
+    assert output.empty()
+    coalescer._flush_ready(time.monotonic() + 10)
+    assert list(output.queue) == [_event(ChangeEventType.MODIFIED, "a")]
+
+
+SYNCED_MTIME = 1514862245
+
+
+def _file(path, size, mtime):
+    attrs = FileAttrs(datetime.fromtimestamp(mtime), size)
+    return FsObject(path, FsObjectType.FILE, attrs)
+
+
+@pytest.fixture
+def monitor(tmpdir):
+    local_dir = str(tmpdir) + "/"
+    for name in ["unchanged", "changed"]:
+        path = os.path.join(local_dir, name)
+        with open(path, "w") as f:
+            f.write("data")
+        os.utime(path, (SYNCED_MTIME, SYNCED_MTIME))
+    synced_files = [
+        _file("unchanged", 4, SYNCED_MTIME),
+        _file("changed", 4, SYNCED_MTIME),
+    ]
+    synchronizer = Mock(local_dir=local_dir, remote_dir="/remote/")
+    with patch.object(paramiko.SFTPClient, "from_transport"):
+        monitor = HeldFilesMonitor(
+            synchronizer,
+            Mock(),
+            Mock(),
+            watch_sync_state_from_trees(synced_files, synced_files, 0),
+        )
+    # Modify one file locally, after the initial listing
+    with open(os.path.join(local_dir, "changed"), "w") as f:
+        f.write("local data")
+    return monitor
+
+
+def test_remote_changes_to_unmodified_files_are_pulled(monitor):
+    remote_files = [
+        _file("unchanged", 11, SYNCED_MTIME + 10),
+        _file("changed", 11, SYNCED_MTIME + 10),
+        _file("new", 3, SYNCED_MTIME + 10),
+    ]
+    assert monitor.changes_to_pull(remote_files) == ["unchanged", "new"]
+    # Locally modified files are held rather than overwritten
+    assert monitor._held_paths == {"changed"}
+
+
+def test_remote_changes_are_pulled_once(monitor):
+    remote_files = [_file("new", 3, SYNCED_MTIME + 10)]
+    transferred = [_file("new", 3, SYNCED_MTIME + 10)]
+    assert monitor.changes_to_pull(remote_files) == ["new"]
+    monitor.have_pulled(transferred)
+    assert monitor.changes_to_pull(remote_files) == []
+
+
+def test_pulled_files_are_released(monitor):
+    remote_files = [_file("changed", 11, SYNCED_MTIME + 10)]
+    assert monitor.changes_to_pull(remote_files) == []
+    assert monitor.held_paths() == {"changed"}
+    monitor.have_pulled(remote_files)
+    assert monitor.held_paths() == frozenset()
+    monitor._exchange.publish.assert_called_with(
+        Messages.HELD_FILES_CHANGED, frozenset()
+    )
+
+
+def test_unseen_remote_changes_are_held_before_mirroring(monitor):
+    monitor._synchronizer.iter_remote.return_value = [
+        FsObject("./", FsObjectType.DIRECTORY, None),
+        _file("unchanged", 4, SYNCED_MTIME),
+        _file("changed", 11, SYNCED_MTIME + 10),
+        _file("new", 3, SYNCED_MTIME + 10),
+    ]
+    monitor.hold_remote_changes("")
+    monitor._synchronizer.iter_remote.assert_called_once_with("")
+    assert monitor.held_paths() == {"changed", "new"}
+    monitor._exchange.publish.assert_called_with(
+        Messages.HELD_FILES_CHANGED, frozenset(["changed", "new"])
+    )
+
+
+def test_remote_lookups_do_not_hold_the_lock(monitor):
+    def lock_is_free():
+        acquired = []
+
+        def try_lock():
+            if monitor._lock.acquire(blocking=False):
+                monitor._lock.release()
+                acquired.append(True)
+
+        thread = threading.Thread(target=try_lock)
+        thread.start()
+        thread.join()
+        return bool(acquired)
+
+    def get_mtime(path):
+        assert lock_is_free()
+        return None
+
+    monitor._remote_metadata = Mock()
+    monitor._remote_metadata.get_mtime.side_effect = get_mtime
+    monitor._remote_metadata.refresh.side_effect = lambda paths: get_mtime(
+        None
+    )
+    assert monitor.should_sync(_event(ChangeEventType.MODIFIED, "new"))
+    monitor.have_synced([_event(ChangeEventType.MODIFIED, "new")])
+    assert monitor._remote_metadata.get_mtime.call_count == 2
+
+
+def test_initial_state_holds_remote_changes():
+    local_tree = [
+        _file("older_remotely", 4, SYNCED_MTIME + 10),
+        _file("newer_remotely", 4, SYNCED_MTIME),
+        _file("local_only", 4, SYNCED_MTIME),
+    ]
+    remote_tree = [
+        _file("older_remotely", 4, SYNCED_MTIME),
+        _file("newer_remotely", 4, SYNCED_MTIME + 10),
+        _file("remote_only", 4, SYNCED_MTIME),
+    ]
+    state = watch_sync_state_from_trees(local_tree, remote_tree, 0)
+    assert state.held_paths == {"newer_remotely", "remote_only"}
+    remote_mtime = state.remote_timestamps.get("remote_only")
+    assert remote_mtime == datetime.fromtimestamp(SYNCED_MTIME)
+
+
+def test_echoes_of_our_own_writes_are_dropped(tmpdir):
+    local_dir = str(tmpdir)
+    for name in ["pulled", "edited"]:
+        with open(os.path.join(local_dir, name), "w") as f:
+            f.write("data")
+        os.utime(os.path.join(local_dir, name), (SYNCED_MTIME, SYNCED_MTIME))
+    echo_registry = EchoRegistry(local_dir)
+    output = queue.Queue()
+    coalescer = EventCoalescer(output, echo_registry=echo_registry)
+
+    echo_registry.begin()
+    for name in ["pulled", "edited"]:
+        coalescer.put(_event(ChangeEventType.CREATED, name))
+    coalescer.flush()
+    # Events are held back until the transfer ends
+    assert output.empty()
+    with open(os.path.join(local_dir, "edited"), "w") as f:
+        f.write("edited locally")
+    echo_registry.end(
+        [_file("pulled", 4, SYNCED_MTIME), _file("edited", 4, SYNCED_MTIME)]
+    )
+    coalescer.flush()
+
+    assert list(output.queue) == [_event(ChangeEventType.CREATED, "edited")]
+
+
+def test_failed_pulls_are_reported():
+    synchronizer = Mock()
+    synchronizer.down_files.side_effect = IOError
+    exchange = Mock()
+    poller = RemotePoller(synchronizer, Mock(), Mock(), exchange, 0)
+    with pytest.raises(IOError):
+        poller._pull(["a"])
+    pulled_event = _event(
+        ChangeEventType.MODIFIED, "a", extra_args={"pulled": True}
+    )
+    assert exchange.publish.call_args_list == [
+        call(Messages.STARTING_HANDLING_FS_EVENT, pulled_event),
+        call(Messages.FAILED_HANDLING_FS_EVENT, pulled_event),
+    ]
+
+
+def test_failed_down_is_reported():
+    # Skip the constructor, which connects to the remote
+    watcher = WatcherSynchronizer.__new__(WatcherSynchronizer)
+    watcher._exchange = Mock()
+    watcher._synchronizer = Mock()
+    watcher._synchronizer.down.side_effect = IOError
+    watcher.echo_registry = Mock()
+    with pytest.raises(IOError):
+        watcher.down()
+    (message, fs_event), _ = watcher._exchange.publish.call_args
+    assert message == Messages.FAILED_HANDLING_FS_EVENT
+    watcher.echo_registry.end.assert_called_once_with([])
@@ -0,0 +1,18 @@
+from faculty_sync.models import ChangeEventType, FsChangeEvent
+from faculty_sync.screens.watch_sync import FailedFiles, HeldFiles
+
+
+def test_failed_files_renders_empty_list():
+    failed_files = FailedFiles()
+    failed_files.set_events(
+        [FsChangeEvent(ChangeEventType.MODIFIED, False, "a", None)]
+    )
+    failed_files.set_events([])
+    assert failed_files.container.preferred_height(80, 24) is not None
+
+
+def test_held_files_renders_empty_list():
+    held_files = HeldFiles()
+    held_files.set_paths(["a"])
+    held_files.set_paths([])
+    assert held_files.container.preferred_height(80, 24) is not None
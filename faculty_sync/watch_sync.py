@@ -1,16 +1,106 @@
+import collections
 import logging
 import os
 import queue
+import re
+import stat
 import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 
 import watchdog.events
 import watchdog.observers
 
 from . import path_match
-from .file_trees import compare_file_trees, get_remote_mtime
-from .models import ChangeEventType, FsChangeEvent
+from .file_trees import compare_file_trees
+from .models import ChangeEventType, DifferenceType, FsChangeEvent
+from .priorities import EventPriorities
 from .pubsub import Messages
+from .remote_metadata import RemoteMetadataCache
+from .rsync_output import LIST_OUT_FORMAT, parse_list_output
+
+try:
+    from . import filtered_inotify
+except Exception:
+    # watchdog's inotify observer is only available on Linux
+    filtered_inotify = None
+
+# Maximum number of queued events handled together. Consecutive file
+# uploads within a batch are sent in a single rsync transfer.
+MAX_UPLOAD_BATCH_SIZE = 1000
+
+# Events for a path are merged until the path has been quiet for this
+# many seconds.
+DEFAULT_QUIET_PERIOD = 0.5
+
+# Seconds between two checks for changes on the remote. Each check runs
+# `find` over the whole remote directory, so very large remote trees may
+# warrant a longer interval.
+DEFAULT_REMOTE_POLL_INTERVAL = 5.0
+
+# Maximum total size of the files sent in a single rsync transfer, so
+# that small files are not held back by large ones. A larger file is
+# sent on its own.
+MAX_UPLOAD_BATCH_BYTES = 8 * 1024 * 1024
+
+# Number of threads handling events in watch mode
+DEFAULT_UPLOAD_WORKERS = 4
+
+# Number of recent events used to report synchronization latency
+LATENCY_SAMPLES = 1000
+
+# Events that fail are tried again up to MAX_RETRIES times, waiting
+# RETRY_DELAY seconds before the first retry and doubling the wait each
+# time. After that, the parent directory of the event is synchronized as
+# a whole, unless it is the root.
+MAX_RETRIES = 3
+RETRY_DELAY = 1.0
+
+# Bursts of events, as caused by switching git branches, are not
+# handled one by one. When more than BURST_QUEUE_DEPTH events are
+# waiting, or when more than BURST_RATE events arrived in the last
+# second, waiting events are collapsed into at most MAX_BURST_SUBTREES
+# directories, each mirrored with a single rsync transfer.
+BURST_QUEUE_DEPTH = 500
+BURST_RATE = 200
+MAX_BURST_SUBTREES = 8
+
+
+WatchSyncState = collections.namedtuple(
+    "WatchSyncState",
+    ["local_timestamps", "remote_timestamps", "held_paths", "remote_time"],
+)
+
+
+def watch_sync_state_from_trees(local_tree, remote_tree, remote_time):
+    """
+    Initial state of watch mode, from listings of both directories
+
+    `remote_time` is the remote time read before listing the remote
+    directory: changes made on the remote after it are picked up by the
+    remote poller.
+    """
+    return WatchSyncState(
+        TimestampDatabase.from_fs_objects(local_tree),
+        TimestampDatabase.from_fs_objects(remote_tree),
+        set(_initial_held_paths(local_tree, remote_tree)),
+        remote_time,
+    )
+
+
+def _initial_held_paths(local_tree, remote_tree):
+    for difference in compare_file_trees(local_tree, remote_tree):
+        if difference.difference_type == DifferenceType.RIGHT_ONLY:
+            yield difference.right.path
+        elif difference.difference_type == DifferenceType.TYPE_DIFFERENT:
+            yield difference.left.path
+        elif difference.difference_type == DifferenceType.ATTRS_DIFFERENT:
+            local_mtime = difference.left.attrs.last_modified
+            remote_mtime = difference.right.attrs.last_modified
+            if remote_mtime > local_mtime:
+                # Hold only if remote file was modified after current
+                yield difference.left.path
 
 
 class TimestampDatabase(object):
@@ -61,6 +151,295 @@ class ListableQueue(queue.Queue):
         return [item for item in self.queue]
 
 
+class EventCoalescer(object):
+    def __init__(
+        self, queue, quiet_period=DEFAULT_QUIET_PERIOD, echo_registry=None
+    ):
+        """
+        Merge filesystem events for the same path.
+
+        Events are held back until their path has seen no new event for
+        `quiet_period` seconds, then the merged event is put on `queue`.
+        For instance, CREATED followed by MODIFIED becomes a single
+        CREATED, CREATED followed by DELETED disappears and chains of
+        moves are folded into one move.
+
+        Directory events are not merged: they flush every pending event
+        to preserve ordering.
+
+        If `echo_registry` is given, merged events are held back while
+        we write to the local directory, then events caused by our own
+        writes are dropped.
+        """
+        self._queue = queue
+        self._quiet_period = quiet_period
+        self._echo_registry = echo_registry
+        # Merged events waiting for writes to the local directory to end
+        self._held = []
+        # path -> (event, time of last change), oldest change first
+        self._pending = collections.OrderedDict()
+        # source path of pending moves -> destination path
+        self._move_sources = {}
+        self._lock = threading.Lock()
+        self._stop_event = threading.Event()
+        self._thread = None
+
+    def put(self, fs_event):
+        with self._lock:
+            if fs_event.is_directory:
+                self._flush_all()
+                self._emit(fs_event)
+            elif fs_event.event_type == ChangeEventType.MOVED:
+                self._add_move(fs_event)
+            else:
+                self._add(fs_event)
+
+    def flush(self):
+        with self._lock:
+            self._flush_all()
+            self._release_held()
+
+    def start(self):
+        def run():
+            while not self._stop_event.wait(self._quiet_period / 5):
+                with self._lock:
+                    self._flush_ready(time.monotonic())
+                    self._release_held()
+
+        self._thread = threading.Thread(target=run, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop_event.set()
+
+    def join(self):
+        if self._thread is not None:
+            self._thread.join()
+
+    def _add(self, fs_event):
+        path = fs_event.path
+        self._flush_moves_from(path)
+        previous = self._pop(path)
+        if previous is None:
+            self._set(path, fs_event)
+        elif previous.event_type == ChangeEventType.MOVED:
+            if fs_event.event_type == ChangeEventType.DELETED:
+                # The file was moved then deleted: just delete the source
+                self._set(
+                    previous.path, _replace_event(fs_event, previous.path)
+                )
+            else:
+                # The move has to happen before the new content is uploaded
+                self._emit(previous)
+                self._set(path, fs_event)
+        else:
+            merged_event_type = _merge_event_types(
+                previous.event_type, fs_event.event_type
+            )
+            if merged_event_type is not None:
+                self._set(
+                    path, fs_event._replace(event_type=merged_event_type)
+                )
+
+    def _add_move(self, fs_event):
+        src_path = fs_event.path
+        dest_path = fs_event.extra_args["dest_path"]
+        self._flush_moves_from(src_path)
+        previous = self._pop(src_path)
+        self._flush_moves_from(dest_path)
+        if previous is None:
+            event = fs_event
+        elif previous.event_type == ChangeEventType.CREATED:
+            event = _replace_event(previous, dest_path)
+        elif previous.event_type == ChangeEventType.MODIFIED:
+            # The remote only has the old content under the source path
+            self._set(
+                src_path,
+                previous._replace(event_type=ChangeEventType.DELETED),
+            )
+            event = _replace_event(previous, dest_path)._replace(
+                event_type=ChangeEventType.CREATED
+            )
+        elif previous.event_type == ChangeEventType.MOVED:
+            if previous.path == dest_path:
+                # Moved back to where it started
+                event = None
+            else:
+                event = fs_event._replace(path=previous.path)
+        else:
+            self._emit(previous)
+            event = fs_event
+
+        superseded = self._pop(dest_path)
+        if (
+            superseded is not None
+            and superseded.event_type == ChangeEventType.MOVED
+        ):
+            # The earlier move into `dest_path` never reached the remote,
+            # so its source still exists there.
+            self._set(
+                superseded.path,
+                _replace_event(superseded, superseded.path)._replace(
+                    event_type=ChangeEventType.DELETED
+                ),
+            )
+        elif superseded is not None and superseded.event_type in {
+            ChangeEventType.MODIFIED,
+            ChangeEventType.DELETED,
+        }:
+            # The remote still has a file at `dest_path`, and renaming
+            # onto it fails: delete it before the move.
+            self._emit(superseded._replace(event_type=ChangeEventType.DELETED))
+        if event is not None:
+            self._set(dest_path, event)
+
+    def _flush_moves_from(self, path):
+        """ Emit the pending move whose source is `path`, if any """
+        dest_path = self._move_sources.get(path)
+        if dest_path is not None:
+            self._emit(self._pop(dest_path))
+
+    def _set(self, path, fs_event):
+        self._pop(path)
+        self._pending[path] = (fs_event, time.monotonic())
+        if fs_event.event_type == ChangeEventType.MOVED:
+            self._move_sources[fs_event.path] = path
+
+    def _pop(self, path):
+        try:
+            fs_event, _ = self._pending.pop(path)
+        except KeyError:
+            return None
+        if fs_event.event_type == ChangeEventType.MOVED:
+            del self._move_sources[fs_event.path]
+        return fs_event
+
+    def _flush_ready(self, now):
+        while self._pending:
+            path, (_, last_changed) = next(iter(self._pending.items()))
+            if now - last_changed < self._quiet_period:
+                break
+            self._emit(self._pop(path))
+
+    def _flush_all(self):
+        for path in list(self._pending.keys()):
+            self._emit(self._pop(path))
+
+    def _emit(self, fs_event):
+        if self._echo_registry is None:
+            self._queue.put(fs_event)
+        else:
+            self._held.append(fs_event)
+            self._release_held()
+
+    def _release_held(self):
+        if not self._held or self._echo_registry.is_writing():
+            return
+        for fs_event in self._held:
+            if self._echo_registry.is_echo(fs_event):
+                logging.info(
+                    "Ignoring echo of our own write {}".format(fs_event)
+                )
+            else:
+                self._queue.put(fs_event)
+        self._held = []
+
+
+class EchoRegistry(object):
+    def __init__(self, local_dir):
+        """
+        Keep track of paths written by our own transfers from the remote
+
+        While a transfer is in progress, `is_writing` is true. Once it
+        ends, the attributes of each path written are recorded. Events
+        for that path are echoes of our own write for as long as the
+        local file still matches.
+        """
+        self._local_dir = local_dir
+        self._lock = threading.Lock()
+        self._writers = 0
+        # path -> (is directory, size, mtime)
+        self._written = {}
+
+    def begin(self):
+        with self._lock:
+            self._writers += 1
+
+    def end(self, written):
+        """ Record the `FsObject`s written by a transfer """
+        with self._lock:
+            self._writers -= 1
+            for fs_object in written:
+                if fs_object.is_file():
+                    attrs = (
+                        False,
+                        fs_object.attrs.size,
+                        fs_object.attrs.last_modified,
+                    )
+                else:
+                    attrs = (True, None, None)
+                self._written[fs_object.path.rstrip("/")] = attrs
+
+    def is_writing(self):
+        with self._lock:
+            return self._writers > 0
+
+    def is_echo(self, fs_event):
+        if fs_event.event_type == ChangeEventType.MOVED:
+            path = fs_event.extra_args["dest_path"]
+        else:
+            path = fs_event.path
+        path = path.rstrip("/")
+        with self._lock:
+            expected_attrs = self._written.get(path)
+            if expected_attrs is None:
+                return False
+            if fs_event.event_type != ChangeEventType.DELETED:
+                local_stat = _lstat_or_none(
+                    os.path.join(self._local_dir, path)
+                )
+                if _echo_attrs(local_stat) == expected_attrs:
+                    return True
+            # Changed since we wrote it
+            del self._written[path]
+            return False
+
+
+def _echo_attrs(stat_result):
+    if stat_result is None:
+        return None
+    elif stat.S_ISDIR(stat_result.st_mode):
+        return (True, None, None)
+    else:
+        return (False, stat_result.st_size, _mtime(stat_result))
+
+
+def _merge_event_types(previous, current):
+    """
+    Event type equivalent to `previous` followed by `current`.
+
+    Returns None if the two events cancel out.
+    """
+    if previous == ChangeEventType.CREATED:
+        if current == ChangeEventType.DELETED:
+            return None
+        return ChangeEventType.CREATED
+    elif previous == ChangeEventType.MODIFIED:
+        return current
+    elif previous == ChangeEventType.DELETED:
+        if current == ChangeEventType.DELETED:
+            return ChangeEventType.DELETED
+        return ChangeEventType.MODIFIED
+    raise ValueError("Cannot merge {} events".format(previous))
+
+
+def _replace_event(fs_event, path):
+    """ Event of the same type as `fs_event`, for a non-move at `path` """
+    return FsChangeEvent(
+        fs_event.event_type, fs_event.is_directory, path, extra_args=None
+    )
+
+
 class FileSystemChangeHandler(watchdog.events.FileSystemEventHandler):
 
     watchdog_event_lookup = {
@@ -73,14 +452,18 @@ class FileSystemChangeHandler(watchdog.events.FileSystemEventHandler):
     def __init__(self, queue, local_dir, excluded_patterns):
         self.queue = queue
         self.local_dir = local_dir
-        self._excluded_patterns = excluded_patterns
+        self._excluded_matcher = path_match.PathMatcher(excluded_patterns)
 
     def on_any_event(self, watchdog_event):
+        if watchdog_event.event_type not in self.watchdog_event_lookup:
+            # Newer versions of watchdog also report files being opened
+            # and closed
+            return
         logging.info("Registered filesystem event {}".format(watchdog_event))
         event_type = self.watchdog_event_lookup[watchdog_event.event_type]
         is_directory = watchdog_event.is_directory
         path = self._relpath(watchdog_event.src_path)
-        if path_match.matches_any_of(path, self._excluded_patterns):
+        if self._excluded_matcher.matches(path, is_file=not is_directory):
             logging.info(
                 "Ignoring change event {} as it is in list of excluded patterns.".format(
                     watchdog_event
@@ -119,38 +502,536 @@ class FileSystemChangeHandler(watchdog.events.FileSystemEventHandler):
         return os.path.relpath(path, start=self.local_dir)
 
 
+PendingEvent = collections.namedtuple(
+    "PendingEvent", ["fs_event", "not_before", "priority", "size", "queued_at"]
+)
+
+
 class Uploader(object):
-    def __init__(self, queue, synchronizer, monitor, exchange):
+    def __init__(
+        self,
+        queue,
+        synchronizer,
+        monitor,
+        exchange,
+        workers=DEFAULT_UPLOAD_WORKERS,
+        high_priority_patterns=(),
+    ):
+        """
+        Replicate filesystem events on the remote with a pool of workers
+
+        Events that touch the same path, or a directory and paths below
+        it, are handled in the order in which they happened. Other
+        events are handled concurrently by up to `workers` threads.
+        When every worker is busy, events are handed out by priority:
+        see `EventPriorities`.
+        """
         self._queue = queue
         self._synchronizer = synchronizer
         self._stop_event = threading.Event()
         self._monitor = monitor
         self._thread = None
         self._exchange = exchange
+        self._workers = workers
+        self._executor = ThreadPoolExecutor(max_workers=workers)
+        self._priorities = EventPriorities(
+            synchronizer.local_dir, high_priority_patterns
+        )
+        self._lock = threading.RLock()
+        # Events not handed to a worker yet, in the order they happened.
+        # Failed events wait here until they are retried.
+        self._waiting = []
+        # Paths touched by the events that workers are handling
+        self._in_flight = PathClaims()
+        self._running_tasks = 0
+        # Number of failed attempts for each path
+        self._failed_attempts = {}
+        # Events that could not be synchronized at all
+        self._failed_events = []
+        # Seconds between queuing and synchronizing recent events
+        self._latencies = collections.deque(maxlen=LATENCY_SAMPLES)
+        # Arrival times of the last BURST_RATE events
+        self._arrival_times = collections.deque(maxlen=BURST_RATE)
+        self._in_burst = False
 
     def stop(self):
         self._stop_event.set()
+        self._executor.shutdown(wait=False)
+        with self._lock:
+            latencies = sorted(self._latencies)
+        if latencies:
+            logging.info(
+                "Synchronized the last {} events with a median latency of "
+                "{:.2f} s and a maximum latency of {:.2f} s".format(
+                    len(latencies),
+                    latencies[len(latencies) // 2],
+                    latencies[-1],
+                )
+            )
 
     def start(self):
         def run():
             while not self._stop_event.is_set():
                 try:
-                    fs_event = self._queue.get(timeout=1)
+                    fs_events = self._get_pending_events(
+                        self._time_to_next_retry()
+                    )
                 except queue.Empty:
-                    continue
-                if self._monitor.should_sync(fs_event):
-                    try:
-                        self._handle_sync(fs_event)
-                        self._monitor.has_synced(fs_event)
-                    except Exception as exc:
-                        logging.exception(exc)
-                        self._exchange.publish(
-                            Messages.ERROR_HANDLING_FS_EVENT
-                        )
+                    fs_events = []
+                self._handle_events(fs_events)
 
         self._thread = threading.Thread(target=run)
         self._thread.start()
 
+    def retry_failed(self):
+        """ Try the events that could not be synchronized again """
+        with self._lock:
+            fs_events = self._failed_events
+            self._failed_events = []
+        self._exchange.publish(Messages.FAILED_FS_EVENTS_CHANGED, [])
+        for fs_event in fs_events:
+            self._queue.put(fs_event)
+
+    def pending_paths(self):
+        """ Paths of the events waiting for a worker, oldest first """
+        with self._lock:
+            return [
+                path
+                for pending_event in self._waiting
+                if not _is_subtree_sync(pending_event.fs_event)
+                for path in _event_paths(pending_event.fs_event)
+            ]
+
+    def _get_pending_events(self, timeout=1):
+        """
+        Block until at least one event is available, then drain the queue
+        """
+        fs_events = [self._queue.get(timeout=timeout)]
+        while len(fs_events) < MAX_UPLOAD_BATCH_SIZE:
+            try:
+                fs_events.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return fs_events
+
+    def _handle_events(self, fs_events):
+        now = time.monotonic()
+        with self._lock:
+            for fs_event in fs_events:
+                size = self._priorities.size(fs_event)
+                priority = self._priorities.priority(fs_event, size, now)
+                self._waiting.append(
+                    PendingEvent(fs_event, 0, priority, size, now)
+                )
+                self._arrival_times.append(now)
+            if fs_events and self._is_burst(now):
+                self._collapse_waiting(now)
+        self._dispatch()
+
+    def _is_burst(self, now):
+        burst = len(self._waiting) > BURST_QUEUE_DEPTH or (
+            len(self._arrival_times) == BURST_RATE
+            and now - self._arrival_times[0] < 1.0
+        )
+        if burst != self._in_burst:
+            self._in_burst = burst
+            logging.info(
+                "{} burst of events".format("Detected" if burst else "End of")
+            )
+        return burst
+
+    def _collapse_waiting(self, now):
+        """
+        Replace waiting events with subtree synchronizations
+
+        Events waiting for a retry and directories being synchronized
+        after running out of retries are left alone. The other events,
+        including those of earlier subtree synchronizations that have
+        not started yet, are grouped by the subtree containing them.
+        """
+        local_dir = self._synchronizer.local_dir
+        retries = [
+            pending_event
+            for pending_event in self._waiting
+            if pending_event.not_before > now
+            or _is_resync(pending_event.fs_event)
+        ]
+        collapsible = [
+            (pending_event, fs_event, _common_directory(local_dir, fs_event))
+            for pending_event in self._waiting
+            if pending_event.not_before <= now
+            and not _is_resync(pending_event.fs_event)
+            for fs_event in _collapsed_events(pending_event.fs_event)
+        ]
+        subtrees = set(
+            _collapse_directories(
+                {directory for _, _, directory in collapsible},
+                MAX_BURST_SUBTREES,
+            )
+        )
+        groups = collections.OrderedDict()
+        for pending_event, fs_event, directory in collapsible:
+            subtree = next(
+                path
+                for path in [directory] + _ancestors(directory)
+                if path in subtrees
+            )
+            groups.setdefault(subtree, []).append((pending_event, fs_event))
+        self._waiting = retries
+        for subtree, group in groups.items():
+            self._waiting.append(
+                PendingEvent(
+                    _subtree_event(
+                        subtree, [fs_event for _, fs_event in group]
+                    ),
+                    0,
+                    min(pending_event.priority for pending_event, _ in group),
+                    0,
+                    min(pending_event.queued_at for pending_event, _ in group),
+                )
+            )
+        logging.info(
+            "Collapsed {} events into {} subtrees".format(
+                len(collapsible), len(groups)
+            )
+        )
+
+    def _dispatch(self):
+        """ Hand the events that can be handled now to idle workers """
+        if self._stop_event.is_set():
+            return
+        with self._lock:
+            tasks = self._take_tasks(time.monotonic())
+            self._running_tasks += len(tasks)
+        for pending_events in tasks:
+            self._executor.submit(self._run_task, pending_events)
+
+    def _take_tasks(self, now):
+        """
+        Group the events that can be handled now into tasks
+
+        An event is ready unless it overlaps an event being handled, or
+        an earlier event that is still waiting. Ready events are taken
+        by priority, as long as there are idle workers. File uploads
+        that can go ahead are sent together in rsync transfers of up to
+        MAX_UPLOAD_BATCH_BYTES.
+        """
+        blocked = PathClaims()
+        ready_claims = PathClaims()
+        # Ready events, grouped with later uploads of the same file
+        ready_groups = []
+        upload_groups = {}
+        for pending_event in self._waiting:
+            fs_event = pending_event.fs_event
+            paths = _event_paths(fs_event)
+            if (
+                pending_event.not_before > now
+                or blocked.overlaps(paths)
+                or self._in_flight.overlaps(paths)
+            ):
+                blocked.add(paths)
+            elif _is_file_upload(fs_event) and paths[0] in upload_groups:
+                # Uploading the same file twice in a transfer is harmless
+                upload_groups[paths[0]].append(pending_event)
+            elif ready_claims.overlaps(paths):
+                blocked.add(paths)
+            else:
+                group = [pending_event]
+                ready_groups.append(group)
+                ready_claims.add(paths)
+                if _is_file_upload(fs_event):
+                    upload_groups[paths[0]] = group
+
+        idle_workers = self._workers - self._running_tasks
+        tasks = []
+        batch = None
+        batch_bytes = 0
+        taken = set()
+        ready_groups.sort(key=lambda group: group[0].priority)
+        for group in ready_groups:
+            if _is_file_upload(group[0].fs_event):
+                size = group[0].size
+                if (
+                    batch is not None
+                    and batch_bytes + size <= MAX_UPLOAD_BATCH_BYTES
+                    and len(batch) + len(group) <= MAX_UPLOAD_BATCH_SIZE
+                ):
+                    batch.extend(group)
+                    batch_bytes += size
+                elif idle_workers > 0:
+                    batch = list(group)
+                    batch_bytes = size
+                    tasks.append(batch)
+                    idle_workers -= 1
+                else:
+                    continue
+            elif idle_workers > 0:
+                tasks.append(group)
+                idle_workers -= 1
+            else:
+                continue
+            for pending_event in group:
+                taken.add(id(pending_event))
+                self._in_flight.add(_event_paths(pending_event.fs_event))
+        self._waiting = [
+            pending_event
+            for pending_event in self._waiting
+            if id(pending_event) not in taken
+        ]
+        return tasks
+
+    def _run_task(self, pending_events):
+        try:
+            try:
+                to_sync, synced = self._sync_pending_events(pending_events)
+            except Exception:
+                # For instance, failing to look up remote metadata
+                logging.exception(
+                    "Failed to handle {} events".format(len(pending_events))
+                )
+                to_sync, synced = pending_events, False
+            if synced:
+                now = time.monotonic()
+                with self._lock:
+                    for pending_event in to_sync:
+                        self._failed_attempts.pop(
+                            pending_event.fs_event.path, None
+                        )
+                        self._latencies.append(now - pending_event.queued_at)
+            else:
+                self._handle_failures(to_sync)
+        except Exception:
+            logging.exception(
+                "Failed to record the outcome of {} events".format(
+                    len(pending_events)
+                )
+            )
+        finally:
+            with self._lock:
+                self._running_tasks -= 1
+                for pending_event in pending_events:
+                    self._in_flight.remove(
+                        _event_paths(pending_event.fs_event)
+                    )
+            self._dispatch()
+
+    def _sync_pending_events(self, pending_events):
+        """
+        Replicate the events of a task
+
+        Returns the events that were not held back, and whether they
+        were replicated.
+        """
+        fs_event = pending_events[0].fs_event
+        if _is_subtree_sync(fs_event):
+            return pending_events, self._sync_subtree(fs_event)
+        to_sync = [
+            pending_event
+            for pending_event in pending_events
+            if self._monitor.should_sync(pending_event.fs_event)
+        ]
+        if _is_file_upload(fs_event):
+            synced = self._upload_files(
+                [pending_event.fs_event for pending_event in to_sync]
+            )
+        else:
+            synced = all(
+                self._sync_event(pending_event.fs_event)
+                for pending_event in to_sync
+            )
+        return to_sync, synced
+
+    def _upload_files(self, fs_events):
+        """ Upload files, returning whether the transfer succeeded """
+        if not fs_events:
+            return True
+        # Deduplicate paths, preserving order
+        paths = list(
+            collections.OrderedDict.fromkeys(
+                fs_event.path for fs_event in fs_events
+            )
+        )
+        logging.info("Uploading {} files".format(len(paths)))
+        for fs_event in fs_events:
+            self._exchange.publish(
+                Messages.STARTING_HANDLING_FS_EVENT, fs_event
+            )
+        try:
+            transferred = self._synchronizer.up_files(paths)
+            self._monitor.have_synced(fs_events, transferred)
+        except Exception as exc:
+            logging.exception(exc)
+            return False
+        for fs_event in fs_events:
+            self._exchange.publish(
+                Messages.FINISHED_HANDLING_FS_EVENT, fs_event
+            )
+        return True
+
+    def _sync_event(self, fs_event):
+        """ Replicate a single event, returning whether it succeeded """
+        try:
+            self._handle_sync(fs_event)
+            self._monitor.has_synced(fs_event)
+        except Exception as exc:
+            logging.exception(exc)
+            return False
+        return True
+
+    def _time_to_next_retry(self, maximum=1):
+        now = time.monotonic()
+        with self._lock:
+            retry_times = [
+                pending_event.not_before
+                for pending_event in self._waiting
+                if pending_event.not_before > now
+            ]
+        if not retry_times:
+            return maximum
+        return min(min(retry_times) - now, maximum)
+
+    def _handle_failures(self, pending_events):
+        for pending_event in pending_events:
+            self._exchange.publish(
+                Messages.FAILED_HANDLING_FS_EVENT, pending_event.fs_event
+            )
+        now = time.monotonic()
+        retries = []
+        exhausted = []
+        failed = []
+        with self._lock:
+            # Paths can appear several times in a batch
+            attempted_paths = collections.OrderedDict.fromkeys(
+                pending_event.fs_event.path
+                for pending_event in pending_events
+                if not _is_resync(pending_event.fs_event)
+            )
+            for path in attempted_paths:
+                self._failed_attempts[path] = (
+                    self._failed_attempts.get(path, 0) + 1
+                )
+            for pending_event in pending_events:
+                fs_event = pending_event.fs_event
+                if _is_resync(fs_event):
+                    failed.extend(fs_event.extra_args["failed_events"])
+                    continue
+                attempts = self._failed_attempts[fs_event.path]
+                if attempts <= MAX_RETRIES:
+                    delay = RETRY_DELAY * 2 ** (attempts - 1)
+                    logging.info(
+                        "Retrying {} in {} seconds".format(fs_event, delay)
+                    )
+                    retries.append(
+                        pending_event._replace(not_before=now + delay)
+                    )
+                else:
+                    exhausted.append(pending_event)
+            for path in attempted_paths:
+                if self._failed_attempts[path] > MAX_RETRIES:
+                    del self._failed_attempts[path]
+            resyncs, unsyncable = self._resyncs(exhausted, now)
+            failed.extend(unsyncable)
+            # Retries happened before anything still waiting
+            self._waiting[:0] = retries + resyncs
+            if failed:
+                self._failed_events.extend(failed)
+                failed_events = list(self._failed_events)
+        if failed:
+            self._exchange.publish(
+                Messages.FAILED_FS_EVENTS_CHANGED, failed_events
+            )
+
+    def _resyncs(self, pending_events, now):
+        """
+        Synchronize directories as a whole for events out of retries
+
+        Returns pending subtree synchronizations, one for each parent
+        directory of the events, and the events that cannot be resynced
+        that way. Subtree synchronizations claim their directory, so no
+        other event below it is handled at the same time.
+        """
+        # Events of a batch often share their directory
+        by_directory = collections.OrderedDict()
+        unsyncable = []
+        for pending_event in pending_events:
+            fs_event = pending_event.fs_event
+            directory = None
+            if not _is_subtree_sync(fs_event):
+                directory = _parent_directory(
+                    self._synchronizer.local_dir, fs_event
+                )
+            if directory is None:
+                unsyncable.append(fs_event)
+            else:
+                by_directory.setdefault(directory, []).append(pending_event)
+        resyncs = []
+        for directory, group in by_directory.items():
+            fs_events = [pending_event.fs_event for pending_event in group]
+            logging.info(
+                "Synchronizing directory {} after failing to sync {} "
+                "events".format(directory, len(fs_events))
+            )
+            resyncs.append(
+                PendingEvent(
+                    _subtree_event(directory, fs_events, resync=True),
+                    0,
+                    min(pending_event.priority for pending_event in group),
+                    0,
+                    min(pending_event.queued_at for pending_event in group),
+                )
+            )
+        return resyncs, unsyncable
+
+    def _sync_subtree(self, fs_event):
+        """ Mirror a subtree that events were collapsed into """
+        collapsed_events = fs_event.extra_args["collapsed_events"]
+        logging.info(
+            "Synchronizing {} as a whole for {} events".format(
+                fs_event.path, len(collapsed_events)
+            )
+        )
+        self._exchange.publish(Messages.STARTING_HANDLING_FS_EVENT, fs_event)
+        if not self._sync_directory(fs_event.path, collapsed_events):
+            return False
+        self._exchange.publish(Messages.FINISHED_HANDLING_FS_EVENT, fs_event)
+        return True
+
+    def _sync_directory(self, directory, fs_events):
+        """
+        Mirror `directory` on the remote for `fs_events`
+
+        Held files are left out, so that their remote version is kept.
+        This includes remote changes that the poller has not seen yet.
+        Returns whether the transfer succeeded.
+        """
+        directory = _normalize_path(directory)
+        try:
+            self._monitor.hold_remote_changes(directory)
+        except Exception as exc:
+            logging.exception(exc)
+            return False
+        held_paths = self._monitor.held_paths()
+        prefix = directory + "/" if directory else ""
+        excludes = [
+            _exclude_option(path[len(prefix) :])
+            for path in sorted(held_paths)
+            if path.startswith(prefix)
+        ]
+        try:
+            transferred = self._synchronizer.up_directory(directory, excludes)
+            self._monitor.have_synced(
+                [
+                    fs_event
+                    for fs_event in fs_events
+                    if fs_event.path not in held_paths
+                ],
+                transferred,
+            )
+        except Exception as exc:
+            logging.exception(exc)
+            return False
+        return True
+
     def _handle_sync(self, fs_event):
         logging.info("Processing file system event {}".format(fs_event))
         self._exchange.publish(Messages.STARTING_HANDLING_FS_EVENT, fs_event)
@@ -185,74 +1066,293 @@ class Uploader(object):
     def join(self):
         if self._thread is not None:
             self._thread.join()
+        self._executor.shutdown(wait=True)
+
+
+class PathClaims(object):
+    def __init__(self):
+        """
+        Multiset of paths touched by events
+
+        A path overlaps the claims if it is claimed itself, or if it is
+        an ancestor or a descendant of a claimed path.
+        """
+        self._paths = collections.Counter()
+        self._ancestors = collections.Counter()
+
+    def add(self, paths):
+        for path in paths:
+            self._paths[path] += 1
+            for ancestor in _ancestors(path):
+                self._ancestors[ancestor] += 1
+
+    def remove(self, paths):
+        for path in paths:
+            _decrement(self._paths, path)
+            for ancestor in _ancestors(path):
+                _decrement(self._ancestors, ancestor)
+
+    def overlaps(self, paths):
+        for path in paths:
+            if path in self._paths or path in self._ancestors:
+                return True
+            for ancestor in _ancestors(path):
+                if ancestor in self._paths:
+                    return True
+        return False
+
+
+def _ancestors(path):
+    """
+    Proper ancestors of a relative path
+
+    For instance, "" (the root), "a" and "a/b" for "a/b/c".
+    """
+    if not path:
+        return []
+    parts = path.split("/")
+    return ["/".join(parts[:index]) for index in range(len(parts))]
+
+
+def _decrement(counter, key):
+    counter[key] -= 1
+    if counter[key] <= 0:
+        del counter[key]
+
+
+def _event_paths(fs_event):
+    """ Paths touched by `fs_event`, without trailing slashes """
+    paths = [_normalize_path(fs_event.path)]
+    if fs_event.event_type == ChangeEventType.MOVED:
+        paths.append(_normalize_path(fs_event.extra_args["dest_path"]))
+    return paths
+
+
+def _normalize_path(path):
+    """ Strip trailing slashes, with the root as "" """
+    path = path.rstrip("/")
+    return "" if path == "." else path
+
+
+def _subtree_event(directory, fs_events, resync=False):
+    """
+    Event standing for the synchronization of a whole subtree
+
+    If `resync` is set, `fs_events` are events that could not be
+    synchronized on their own, and fail for good if this fails too.
+    """
+    extra_args = {
+        "collapsed_events": [
+            collapsed_event
+            for fs_event in fs_events
+            for collapsed_event in _collapsed_events(fs_event)
+        ]
+    }
+    if resync:
+        extra_args["failed_events"] = fs_events
+    return FsChangeEvent(
+        ChangeEventType.MODIFIED,
+        True,
+        directory + "/" if directory else "./",
+        extra_args,
+    )
+
+
+def _is_subtree_sync(fs_event):
+    return bool(fs_event.extra_args) and (
+        "collapsed_events" in fs_event.extra_args
+    )
+
+
+def _is_resync(fs_event):
+    return _is_subtree_sync(fs_event) and (
+        "failed_events" in fs_event.extra_args
+    )
+
+
+def _collapsed_events(fs_event):
+    """ Events that `fs_event` stands for """
+    if _is_subtree_sync(fs_event):
+        return fs_event.extra_args["collapsed_events"]
+    return [fs_event]
+
+
+def _collapse_directories(directories, max_subtrees):
+    """
+    Smallest subtrees that cover `directories`, at most `max_subtrees`
+
+    Directories are cut to the deepest level at which no more than
+    `max_subtrees` subtrees remain. Subtrees that are inside another
+    subtree are dropped. The root is returned as "".
+    """
+    depths = [len(directory.split("/")) for directory in directories]
+    for depth in range(max(depths, default=0), -1, -1):
+        cut = {
+            "/".join(directory.split("/")[:depth]) for directory in directories
+        }
+        subtrees = sorted(
+            path
+            for path in cut
+            if not any(ancestor in cut for ancestor in _ancestors(path))
+        )
+        if len(subtrees) <= max_subtrees:
+            return subtrees
+    return [""]
+
+
+def _common_directory(local_dir, fs_event):
+    """
+    Closest directory that contains every path touched by `fs_event`
+
+    The directory exists locally. The root is returned as "".
+    """
+    paths = [fs_event.path]
+    if fs_event.event_type == ChangeEventType.MOVED:
+        paths.append(fs_event.extra_args["dest_path"])
+    directory = os.path.commonpath(
+        [os.path.dirname(path.rstrip("/")) for path in paths]
+    )
+    while directory and not os.path.isdir(os.path.join(local_dir, directory)):
+        directory = os.path.dirname(directory)
+    return directory
+
+
+def _parent_directory(local_dir, fs_event):
+    """
+    Directory to mirror for an event that cannot be replicated alone
+
+    This is the parent directory of the paths touched by `fs_event`.
+    Returns None if they have different parents, if the parent is the
+    root, or if it no longer exists locally: mirroring the whole tree
+    is too costly.
+    """
+    directories = {os.path.dirname(path) for path in _event_paths(fs_event)}
+    if len(directories) != 1:
+        return None
+    (directory,) = directories
+    if not directory or not os.path.isdir(os.path.join(local_dir, directory)):
+        return None
+    return directory
+
+
+def _exclude_option(path):
+    """
+    rsync option excluding exactly the relative path `path`
+
+    rsync reads `*`, `?` and `[` in patterns as wildcards. A backslash
+    escapes them, but is only read as an escape when the pattern
+    contains a wildcard.
+    """
+    if any(character in path for character in "*?["):
+        path = re.sub(r"([\\*?[])", r"\\\1", path)
+    return "--exclude=/{}".format(path)
+
+
+def _lstat_or_none(path):
+    try:
+        return os.lstat(path)
+    except FileNotFoundError:
+        return None
+
+
+def _mtime(stat_result):
+    """ mtime of a stat result, with the resolution used for remote files """
+    return datetime.fromtimestamp(int(stat_result.st_mtime))
+
+
+def _is_file_upload(fs_event):
+    return not fs_event.is_directory and fs_event.event_type in {
+        ChangeEventType.CREATED,
+        ChangeEventType.MODIFIED,
+    }
+
+
+def _observer(ignore_paths):
+    """ Observer that does not watch ignored directories, if possible """
+    if filtered_inotify is None or not filtered_inotify.is_supported():
+        return watchdog.observers.Observer()
+    return filtered_inotify.FilteredInotifyObserver(ignore_paths)
 
 
 class HeldFilesMonitor(object):
-    def __init__(self, synchronizer, sftp, exchange):
+    def __init__(self, synchronizer, sftp, exchange, state):
         self._synchronizer = synchronizer
         self._local_dir = synchronizer.local_dir
         self._remote_dir = synchronizer.remote_dir
         self._sftp = sftp
         self._exchange = exchange
-        _local_tree = self._synchronizer.list_local()
-        _remote_tree = self._synchronizer.list_remote()
-        self._local_timestamps = TimestampDatabase.from_fs_objects(_local_tree)
-        self._remote_timestamps = TimestampDatabase.from_fs_objects(
-            _remote_tree
-        )
-        self._held_paths = set(
-            self._get_initial_help_paths(_local_tree, _remote_tree)
-        )
+        self._remote_metadata = RemoteMetadataCache(sftp, self._remote_dir)
+        # Called from both the uploader and the remote poller
+        self._lock = threading.RLock()
+        self._local_timestamps = state.local_timestamps
+        self._remote_timestamps = state.remote_timestamps
+        self._held_paths = set(state.held_paths)
         self._exchange.publish(
             Messages.HELD_FILES_CHANGED, frozenset(self._held_paths)
         )
 
-    def _get_initial_help_paths(self, local_tree, remote_tree):
-        for difference in compare_file_trees(local_tree, remote_tree):
-            if difference[0] in {"RIGHT_ONLY", "TYPE_DIFFERENT"}:
-                yield difference[1].path
-            elif difference[0] == "ATTRS_DIFFERENT":
-                local_mtime = difference[1].attrs.last_modified
-                remote_mtime = difference[2].attrs.last_modified
-                if remote_mtime > local_mtime:
-                    # Hold only if remote file was modified after current
-                    yield difference[1].path
+    def held_paths(self):
+        with self._lock:
+            return frozenset(self._held_paths)
 
     def should_sync(self, fs_event):
+        paths = [fs_event.path]
+        if fs_event.event_type == ChangeEventType.MOVED:
+            paths.append(fs_event.extra_args["dest_path"])
+        with self._lock:
+            if fs_event.path in self._held_paths:
+                return False
+        # Looking up remote mtimes may list directories on the remote:
+        # don't hold up other workers meanwhile.
+        remote_mtimes = {
+            path: self._remote_metadata.get_mtime(path) for path in paths
+        }
+        with self._lock:
+            return self._should_sync(fs_event, remote_mtimes)
+
+    def _should_sync(self, fs_event, remote_mtimes):
         path = fs_event.path
         if path in self._held_paths:
             return False
         else:
             if fs_event.event_type == ChangeEventType.MOVED:
                 dest_path = fs_event.extra_args["dest_path"]
-                if self._has_path_changed(path):
+                if self._has_path_changed(path, remote_mtimes[path]):
                     self._add_to_held_paths(path)
                     src_path_unchanged = False
                 else:
                     src_path_unchanged = True
-                if self._has_path_changed(dest_path):
+                if self._has_path_changed(dest_path, remote_mtimes[dest_path]):
                     self._add_to_held_paths(dest_path)
                     dest_path_unchanged = False
                 else:
                     dest_path_unchanged = True
                 return src_path_unchanged and dest_path_unchanged
             else:
-                if self._has_path_changed(path):
+                if self._has_path_changed(path, remote_mtimes[path]):
                     self._add_to_held_paths(path)
                     return False
                 else:
                     return True
 
-    def _has_path_changed(self, path):
+    def set_pending_paths(self, pending_paths):
+        """ Keep remote metadata fresh for the paths `pending_paths()` """
+        self._remote_metadata.set_pending_paths(pending_paths)
+
+    def start(self):
+        self._remote_metadata.start()
+
+    def stop(self):
+        self._remote_metadata.stop()
+
+    def join(self):
+        self._remote_metadata.join()
+
+    def _has_path_changed(self, path, current_timestamp):
         last_known_timestamp = self._remote_timestamps.get(path)
-        try:
-            current_timestamp = get_remote_mtime(
-                os.path.join(self._remote_dir, path), self._sftp
-            )
-            has_changed = last_known_timestamp != current_timestamp
-            return has_changed
-        except FileNotFoundError:
+        if current_timestamp is None:
             return False
+        return last_known_timestamp != current_timestamp
 
     def _add_to_held_paths(self, path):
         self._held_paths.add(path)
@@ -261,49 +1361,366 @@ class HeldFilesMonitor(object):
         )
 
     def has_synced(self, fs_event):
-        if fs_event.event_type == ChangeEventType.DELETED:
-            self._remote_timestamps.remove(fs_event.path)
-        elif fs_event.event_type == ChangeEventType.MOVED:
-            self._remote_timestamps.remove(fs_event.path)
-            dest_path = fs_event.extra_args["dest_path"]
-            abs_dest_path = os.path.join(self._remote_dir, dest_path)
-            current_timestamp = get_remote_mtime(abs_dest_path, self._sftp)
-            self._remote_timestamps.update_if_newer(
-                dest_path, current_timestamp
+        self.have_synced([fs_event])
+
+    def have_synced(self, fs_events, transferred=()):
+        """
+        Record the remote state after synchronizing events
+
+        `transferred` holds the `FsObject`s that rsync reported
+        uploading, with the mtimes that it set on the remote. Other
+        synchronized paths are looked up: their parent directories are
+        listed once, rather than stat-ing each path. The listings are
+        made without holding the lock, so that other workers are not
+        held up by the round trips.
+        """
+        transferred_files = [
+            fs_object for fs_object in transferred if fs_object.is_file()
+        ]
+        for fs_object in transferred_files:
+            self._remote_metadata.update(
+                fs_object.path, fs_object.attrs.last_modified
             )
-        else:
-            path = fs_event.path
-            current_timestamp = get_remote_mtime(
-                os.path.join(self._remote_dir, path), self._sftp
+        transferred_paths = {fs_object.path for fs_object in transferred}
+        synced_paths = []
+        for fs_event in fs_events:
+            if fs_event.event_type == ChangeEventType.MOVED:
+                synced_paths.append(fs_event.extra_args["dest_path"])
+            elif fs_event.event_type != ChangeEventType.DELETED and (
+                fs_event.path not in transferred_paths
+            ):
+                synced_paths.append(fs_event.path)
+        self._remote_metadata.refresh(synced_paths)
+        current_timestamps = [
+            (path, self._remote_metadata.get_mtime(path))
+            for path in synced_paths
+        ]
+        with self._lock:
+            for fs_object in transferred_files:
+                self._remote_timestamps.update_if_newer(
+                    fs_object.path, fs_object.attrs.last_modified
+                )
+            for fs_event in fs_events:
+                if fs_event.event_type in {
+                    ChangeEventType.DELETED,
+                    ChangeEventType.MOVED,
+                }:
+                    self._remote_timestamps.remove(fs_event.path)
+            for path, current_timestamp in current_timestamps:
+                if current_timestamp is None:
+                    logging.info(
+                        "Path {} missing on remote after sync".format(path)
+                    )
+                else:
+                    self._remote_timestamps.update_if_newer(
+                        path, current_timestamp
+                    )
+
+    def changes_to_pull(self, remote_files):
+        """
+        Select remote files that changed and can be pulled safely
+
+        A changed file can be pulled if it is new on both sides, or if
+        the local copy has not changed since it was last synchronized.
+        Other changed files are held. Returns the paths to pull.
+        """
+        with self._lock:
+            paths = []
+            for fs_object in remote_files:
+                path = fs_object.path
+                remote_mtime = fs_object.attrs.last_modified
+                known_mtime = self._remote_timestamps.get(path, None)
+                if remote_mtime == known_mtime or path in self._held_paths:
+                    continue
+                local_stat = _lstat_or_none(
+                    os.path.join(self._local_dir, path)
+                )
+                if local_stat is None:
+                    local_attrs = None
+                else:
+                    local_attrs = (local_stat.st_size, _mtime(local_stat))
+                if local_attrs == (fs_object.attrs.size, remote_mtime):
+                    # Already in sync, e.g. after an upload
+                    self._set_remote_timestamp(path, remote_mtime)
+                elif (local_attrs is None and known_mtime is None) or (
+                    local_attrs is not None and local_attrs[1] == known_mtime
+                ):
+                    paths.append(path)
+                else:
+                    self._add_to_held_paths(path)
+            return paths
+
+    def hold_remote_changes(self, directory):
+        """
+        Hold the remote files below `directory` that changed unseen
+
+        Mirroring a directory overwrites or deletes remote files that
+        differ from the local ones. Remote files created or modified
+        since they were last seen, for instance after the last poll,
+        are held so that mirroring leaves them alone.
+        """
+        prefix = directory + "/" if directory else ""
+        remote_files = [
+            fs_object
+            for fs_object in self._synchronizer.iter_remote(prefix)
+            if fs_object.is_file()
+        ]
+        with self._lock:
+            held_paths = set(self._held_paths)
+            for fs_object in remote_files:
+                path = prefix + fs_object.path
+                if (
+                    self._remote_timestamps.get(path)
+                    != fs_object.attrs.last_modified
+                ):
+                    self._held_paths.add(path)
+            if self._held_paths != held_paths:
+                self._exchange.publish(
+                    Messages.HELD_FILES_CHANGED, frozenset(self._held_paths)
+                )
+
+    def have_pulled(self, transferred):
+        """
+        Record the state of files pulled from the remote
+
+        `transferred` holds the `FsObject`s that rsync reported
+        downloading. Held files that were pulled are in sync again, so
+        they are released.
+        """
+        with self._lock:
+            released = False
+            for fs_object in transferred:
+                if fs_object.is_file():
+                    self._set_remote_timestamp(
+                        fs_object.path, fs_object.attrs.last_modified
+                    )
+                    if fs_object.path in self._held_paths:
+                        self._held_paths.discard(fs_object.path)
+                        released = True
+            if released:
+                self._exchange.publish(
+                    Messages.HELD_FILES_CHANGED, frozenset(self._held_paths)
+                )
+
+    def _set_remote_timestamp(self, path, timestamp):
+        self._remote_timestamps.remove(path)
+        self._remote_timestamps.update_if_newer(path, timestamp)
+        self._remote_metadata.update(path, timestamp)
+
+
+class RemotePoller(object):
+    def __init__(
+        self,
+        synchronizer,
+        monitor,
+        echo_registry,
+        exchange,
+        since,
+        interval=DEFAULT_REMOTE_POLL_INTERVAL,
+    ):
+        """
+        Pull remote changes down while watching local changes
+
+        Every `interval` seconds, remote files that changed after the
+        previous check are listed. Those that can be pulled without
+        overwriting local changes are downloaded, while the others are
+        held by `monitor`. `since` is the remote time at which to start
+        looking for changes. An `interval` of 0 disables polling.
+        """
+        self._synchronizer = synchronizer
+        self._monitor = monitor
+        self._echo_registry = echo_registry
+        self._exchange = exchange
+        self._since = since
+        self._interval = interval
+        self._stop_event = threading.Event()
+        self._thread = None
+
+    def start(self):
+        if self._interval <= 0:
+            return
+
+        def run():
+            while not self._stop_event.wait(self._interval):
+                try:
+                    self._poll()
+                except Exception:
+                    logging.exception("Failed to pull remote changes")
+
+        self._thread = threading.Thread(target=run, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop_event.set()
+
+    def join(self):
+        if self._thread is not None:
+            self._thread.join()
+
+    def _poll(self):
+        now = self._synchronizer.remote_time()
+        remote_files = list(
+            self._synchronizer.iter_remote_changed_files(self._since)
+        )
+        paths = self._monitor.changes_to_pull(remote_files)
+        if paths:
+            self._pull(paths)
+        self._since = now
+
+    def _pull(self, paths):
+        logging.info("Pulling {} remote changes".format(len(paths)))
+        fs_events = [
+            FsChangeEvent(
+                ChangeEventType.MODIFIED,
+                False,
+                path,
+                extra_args={"pulled": True},
+            )
+            for path in paths
+        ]
+        for fs_event in fs_events:
+            self._exchange.publish(
+                Messages.STARTING_HANDLING_FS_EVENT, fs_event
+            )
+        transferred = []
+        self._echo_registry.begin()
+        try:
+            # Write files in place, so that rsync's temporary files do
+            # not show up as local events. Never replace newer files.
+            transferred = self._synchronizer.down_files(
+                paths, rsync_opts=["--update", "--inplace"]
+            )
+        except Exception:
+            for fs_event in fs_events:
+                self._exchange.publish(
+                    Messages.FAILED_HANDLING_FS_EVENT, fs_event
+                )
+            raise
+        finally:
+            self._echo_registry.end(transferred)
+        self._monitor.have_pulled(transferred)
+        for fs_event in fs_events:
+            self._exchange.publish(
+                Messages.FINISHED_HANDLING_FS_EVENT, fs_event
             )
-            self._remote_timestamps.update_if_newer(path, current_timestamp)
 
 
 class WatcherSynchronizer(object):
-    def __init__(self, sftp, synchronizer, exchange):
+    def __init__(
+        self,
+        sftp,
+        synchronizer,
+        exchange,
+        state=None,
+        quiet_period=DEFAULT_QUIET_PERIOD,
+        upload_workers=DEFAULT_UPLOAD_WORKERS,
+        high_priority_patterns=(),
+        remote_poll_interval=DEFAULT_REMOTE_POLL_INTERVAL,
+    ):
+        """
+        Replicate local changes on the remote as they happen
+
+        `state` is the `WatchSyncState` to start from. The controller
+        builds it with `watch_sync_state_from_trees` from the trees it
+        listed to show the differences, so that starting to watch does
+        not list both directories again. If it is not given, both
+        directories are listed.
+        """
         local_dir = synchronizer.local_dir
+        if state is None:
+            # Read the remote clock before listing the remote tree, so
+            # that the poller sees any change made while it is listed.
+            remote_time = synchronizer.remote_time()
+            state = watch_sync_state_from_trees(
+                synchronizer.list_local(),
+                synchronizer.list_remote(),
+                remote_time,
+            )
+        self._synchronizer = synchronizer
         self.queue = ListableQueue()
-        self.observer = watchdog.observers.Observer()
+        self.echo_registry = EchoRegistry(local_dir)
+        self.coalescer = EventCoalescer(
+            self.queue, quiet_period, echo_registry=self.echo_registry
+        )
+        self.observer = _observer(synchronizer.ignore_paths)
         self._exchange = exchange
-        monitor = HeldFilesMonitor(synchronizer, sftp, exchange)
+        self.monitor = HeldFilesMonitor(synchronizer, sftp, exchange, state)
         self.observer.schedule(
             FileSystemChangeHandler(
-                self.queue, local_dir, synchronizer.ignore_paths
+                self.coalescer, local_dir, synchronizer.ignore_paths
             ),
             local_dir,
             recursive=True,
         )
-        self.uploader = Uploader(self.queue, synchronizer, monitor, exchange)
+        self.uploader = Uploader(
+            self.queue,
+            synchronizer,
+            self.monitor,
+            exchange,
+            workers=upload_workers,
+            high_priority_patterns=high_priority_patterns,
+        )
+        self.monitor.set_pending_paths(self.uploader.pending_paths)
+        self.poller = RemotePoller(
+            synchronizer,
+            self.monitor,
+            self.echo_registry,
+            exchange,
+            state.remote_time,
+            interval=remote_poll_interval,
+        )
 
     def start(self):
         self._exchange.publish(Messages.START_WATCH_SYNC_MAIN_LOOP)
+        self.monitor.start()
         self.observer.start()
+        self.coalescer.start()
         self.uploader.start()
+        self.poller.start()
 
     def stop(self):
         self.observer.stop()
+        self.coalescer.stop()
         self.uploader.stop()
+        self.poller.stop()
+        self.monitor.stop()
 
     def join(self):
         self.observer.join()
+        self.coalescer.join()
         self.uploader.join()
+        self.poller.join()
+        self.monitor.join()
+
+    def down(self):
+        """
+        Bring all remote changes down, without uploading them back
+
+        Files are only replaced if they are newer on the remote. The
+        watcher keeps running during the transfer: the events it causes
+        are dropped by the echo registry.
+        """
+        fs_event = FsChangeEvent(
+            ChangeEventType.MODIFIED, True, "./", extra_args={"pulled": True}
+        )
+        self._exchange.publish(Messages.STARTING_HANDLING_FS_EVENT, fs_event)
+        transferred = []
+        self.echo_registry.begin()
+        try:
+            process = self._synchronizer.down(
+                rsync_opts=[
+                    "--update",
+                    "--inplace",
+                    "--out-format",
+                    LIST_OUT_FORMAT,
+                ]
+            )
+            lines = process.stdout.decode("utf-8").splitlines()
+            transferred = list(parse_list_output(lines))
+        except Exception:
+            self._exchange.publish(Messages.FAILED_HANDLING_FS_EVENT, fs_event)
+            raise
+        finally:
+            self.echo_registry.end(transferred)
+        self.monitor.have_pulled(transferred)
+        self._exchange.publish(Messages.FINISHED_HANDLING_FS_EVENT, fs_event)